@@ -2,16 +2,23 @@
 import sys
 import argparse
 import logging
+import time
 from logging.handlers import SMTPHandler
 from configparser import NoOptionError, NoSectionError
 #from threading import Thread
 from urllib.parse import urlparse
 from threading import Thread
+from uuid import uuid4
 
-from doorbot.portability import image_to_jpeg, is_frame
+from doorbot.portability import image_to_jpeg, is_frame, \
+    apply_thread_budget, merge_thread_budgets
 from doorbot.overlays.opencv import OpenCVOverlays
 from doorbot.util import FPSTimer
 from doorbot.config import DoorbotConfig
+from doorbot.capturers.pool import shutdown_encoder_pool
+from doorbot.capturers.upload import shutdown_upload_queue
+from doorbot.index import get_clip_index, close_clip_index
+from doorbot.index.retention import RetentionSweeper, get_quotas
 
 class Doorbot( object ):
 
@@ -38,15 +45,34 @@ class Doorbot( object ):
             notifier = notifier_cfg['module'].PLUGIN_CLASS( notifier_key, **notifier_cfg )
             self.notifiers[notifier_key] = notifier
 
+        # Setup the event and clip index.
+
+        self.clip_index = None
+        self.event_uids = {}
+        if 'path' in config['index']:
+            self.clip_index = get_clip_index( config['index']['path'] )
+
         # Add capturer utilities.
 
         self.capturers = {}
 
         for capturer_key in config['capturers']:
             capturer_cfg = config['capturers'][capturer_key]
+            if self.clip_index and 'clipindex' not in capturer_cfg:
+                capturer_cfg['clipindex'] = self.clip_index.db_path
             capturer = capturer_cfg['module'].PLUGIN_CLASS( capturer_key, **capturer_cfg )
             self.capturers[capturer_key] = capturer
 
+        # Retention quotas are enforced from the clip index.
+
+        self.retention = None
+        quotas = get_quotas( config['capturers'].values() )
+        if quotas and self.clip_index:
+            self.retention = RetentionSweeper(
+                self.clip_index, quotas, **config['index'] )
+        elif quotas:
+            self.logger.warning( 'retention quotas need an [index] path' )
+
         # Setup the detector and observer satellite threads.
 
         self.observer_procs= {}
@@ -99,23 +125,48 @@ class Doorbot( object ):
             jpg = image_to_jpeg( overlayed_frame )
             notifier.snapshot( subject, jpg )
 
-    def capture( self, camera_key, frame ):
+    def capture( self, camera_key, frame, motion=True ):
         for capturer_key in self.capturers:
             # TODO: Limit to instances.
             capturer = self.capturers[capturer_key]
             if capturer.camera_key != camera_key:
                 continue
-            if is_frame( frame ):
+            capturer.event_uid = self.event_uids.get( camera_key )
+            if motion and is_frame( frame ) and not capturer.wants_frame():
+                # Dropped to keep to capturefps, so don't bother copying it.
+                continue
+            if motion and is_frame( frame ):
                 overlayed_frame = frame.copy()
                 overlayed_frame = \
                     self.overlay_thread.draw(
                         camera_key, overlayed_frame, **capturer.kwargs )
                 capturer.handle_motion_frame( overlayed_frame )
             else:
-                # We get passed "None" if we just want to update capturer
+                if is_frame( frame ):
+                    # Frames without motion may be kept for pre-roll, with the
+                    # overlay drawn on the capturer's own copy.
+                    capturer.handle_idle_frame( frame,
+                        lambda f, c=capturer: self.overlay_thread.draw(
+                            camera_key, f, **c.kwargs ) )
+
+                # We get passed no motion if we just want to update capturer
                 # grace frames, etc.
                 capturer.handle_motion_frame( None )
 
+    def record_event( self, camera_key, event ):
+
+        ''' Give a new motion event a uid to tie its captures to, and add it
+        to the clip index. '''
+
+        if camera_key in self.event_uids:
+            return
+
+        self.event_uids[camera_key] = uuid4().hex
+        if self.clip_index:
+            self.clip_index.add_event( self.event_uids[camera_key],
+                camera_key, time.time(), event.position, event.dimensions,
+                event.event_type )
+
     def run_camera( self, camera_key ):
         camera = self.cameras[camera_key]
 
@@ -147,12 +198,14 @@ class Doorbot( object ):
             if detector.camera_key != camera_key:
                 continue
             if event and 'movement' == event.event_type:
+                self.record_event( camera_key, event )
                 self.capture( camera_key, frame )
                 self.notify( camera_key, 'movement', '{} at {}'.format(
                     event.dimensions, event.position ), True, frame=frame )
             else:
                 # No motion frames were found, digest capture pipeline.
-                self.capture( camera_key, None )
+                self.event_uids.pop( camera_key, None )
+                self.capture( camera_key, frame, motion=False )
 
         self.timer.loop_timer_end()
 
@@ -163,15 +216,27 @@ class Doorbot( object ):
 
         self.logger.debug( 'starting main loop...' )
 
+        # Detectors all run in the main loop, so they have to agree on its
+        # thread budget.
+        budget = merge_thread_budgets( [self.detectors[detector_key].kwargs \
+            for detector_key in self.detectors] )
+
         for camera_key in self.cameras:
             self.cameras[camera_key].start()
 
         self.overlay_thread.start()
 
+        if self.retention:
+            self.retention.start()
+
         for observer_key in self.observer_procs:
             proc = self.observer_procs[observer_key]
             proc.start()
 
+        # Apply it once everything else is started, so that other processes
+        # and threads don't inherit it.
+        apply_thread_budget( **budget )
+
         while self.running:
             for camera_key in self.cameras:
                 self.run_camera( camera_key )
@@ -268,8 +333,13 @@ def main():
             for camera_key in app.cameras:
                 app.cameras[camera_key].stop()
             app.overlay_thread.stop()
+            if app.retention:
+                app.retention.stop()
             for observer_key in app.observer_procs:
                 app.observer_procs[observer_key].stop()
+        shutdown_encoder_pool( timeout=30 )
+        shutdown_upload_queue( timeout=30 )
+        close_clip_index( timeout=30 )
         sys.exit( 0 )
 
     except Exception as exc: # pylint: disable=broad-except
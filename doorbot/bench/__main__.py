@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from tempfile import TemporaryDirectory
+
+import numpy
+
+from doorbot.capturers.video import VideoCaptureWriter
+from doorbot.detectors.motion import MotionDetector
+from doorbot.observers.reserver import ReserverProc
+from doorbot.portability import apply_thread_budget
+
+def synthetic_frames( width, height, count ):
+
+    ''' Noise background with a box moving across it, so the detector has
+    both foreground and background to chew on. '''
+
+    background = numpy.random.randint(
+        0, 32, size=(height, width, 3), dtype=numpy.uint8 )
+    frames = []
+    for i in range( count ):
+        frame = background.copy()
+        box_x = (i * 16) % (width - 64)
+        frame[height // 3:height // 3 + 64, box_x:box_x + 64] = 255
+        frames.append( frame )
+    return frames
+
+def percentiles( durations ):
+    durations = sorted( durations )
+    return [durations[min( len( durations ) - 1, int( len( durations ) * p ) )] \
+        for p in (0.5, 0.95, 0.99)]
+
+def detect_worker( budget, args, results ):
+    apply_thread_budget( **budget )
+    frames = synthetic_frames( args.width, args.height, 30 )
+    detector = MotionDetector( 'bench', camera='bench' )
+    durations = []
+    start = time.perf_counter()
+    for i in range( args.frames ):
+        frame_start = time.perf_counter()
+        detector.detect( frames[i % len( frames )] )
+        durations.append( time.perf_counter() - frame_start )
+    results.put( (time.perf_counter() - start, durations) )
+
+def bench_threads( args ):
+
+    ''' Run the motion detector in one process per simulated camera under
+    each thread budget and report aggregate throughput and latency. '''
+
+    budgets = [{'cvthreads': t, 'cpuaffinity': args.cpuaffinity} \
+        for t in args.cvthreads]
+    budgets.insert( 0, {'cpuaffinity': args.cpuaffinity} )
+
+    print( '{:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+        'cvthreads', 'fps', 'p50 ms', 'p95 ms', 'p99 ms' ) )
+
+    for budget in budgets:
+        results = multiprocessing.Queue()
+        procs = [multiprocessing.Process(
+            target=detect_worker, args=(budget, args, results) ) \
+            for i in range( args.cameras )]
+        for proc in procs:
+            proc.start()
+        runs = [results.get() for proc in procs]
+        for proc in procs:
+            proc.join()
+
+        elapsed = max( r[0] for r in runs )
+        durations = [d for r in runs for d in r[1]]
+        p50, p95, p99 = percentiles( durations )
+        print( '{:>10} {:>10.1f} {:>10.2f} {:>10.2f} {:>10.2f}'.format(
+            budget['cvthreads'] if 'cvthreads' in budget else 'default',
+            len( durations ) / elapsed, p50 * 1000, p95 * 1000, p99 * 1000 ) )
+
+def bench_encode( args ):
+
+    ''' Encode the same synthetic clip with each video encoder and report
+    encode throughput and output size per minute of video. '''
+
+    frames = synthetic_frames( args.width, args.height, args.frames )
+
+    print( '{:>10} {:>10} {:>10}'.format( 'encoder', 'fps', 'MB/min' ) )
+
+    with TemporaryDirectory() as temp_dir:
+        for encoder in args.encoders:
+            writer = VideoCaptureWriter( 'bench', encoder, args.width,
+                args.height, path=temp_dir, fps=str( args.fps ),
+                encoder=encoder, preset=args.preset, crf=str( args.crf ),
+                streaming='true' )
+
+            start = time.perf_counter()
+            for frame in frames:
+                writer.add_frame( frame )
+            writer.start()
+            elapsed = time.perf_counter() - start
+
+            size = os.path.getsize( writer.filepath )
+            minutes = len( frames ) / args.fps / 60
+            print( '{:>10} {:>10.1f} {:>10.2f}'.format(
+                writer.encoder_type, len( frames ) / elapsed,
+                size / minutes / (1024 * 1024) ) )
+
+def bench_reserver( args ):
+
+    ''' Have each number of simulated reserver clients fetch every frame, as
+    MJPEG client threads do, and report JPEG encodes and CPU time per
+    frame. '''
+
+    frames = synthetic_frames( args.width, args.height, 30 )
+    source = {'seq': 0}
+
+    @contextmanager
+    def get_frame_seq():
+        seq = source['seq']
+        yield seq, frames[seq % len( frames )]
+
+    proc = ReserverProc( 'bench', camera='bench' )
+    proc.get_frame_seq = get_frame_seq
+
+    print( '{:>10} {:>10} {:>10}'.format( 'clients', 'encodes', 'cpu ms' ) )
+
+    for clients in args.clients:
+        encodes_start = proc.jpeg_encodes
+        cpu_start = time.process_time()
+        with ThreadPoolExecutor( max_workers=clients ) as executor:
+            for i in range( args.frames ):
+                source['seq'] += 1
+                # Every client asks for the new frame at once.
+                for future in [executor.submit( proc.get_jpeg ) \
+                    for client in range( clients )]:
+                    future.result()
+        cpu = time.process_time() - cpu_start
+
+        print( '{:>10} {:>10.2f} {:>10.2f}'.format( clients,
+            (proc.jpeg_encodes - encodes_start) / args.frames,
+            cpu / args.frames * 1000 ) )
+
+    proc.stop()
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        'doorbot.bench', description='doorbot pipeline benchmarks' )
+
+    subparsers = parser.add_subparsers( dest='bench' )
+    subparsers.required = True
+
+    threads_parser = subparsers.add_parser(
+        'threads', help='detector throughput under thread budgets' )
+    threads_parser.add_argument(
+        '-t', '--cvthreads', action='store', type=int, nargs='+',
+        default=[1, 2, 4], help='opencv thread counts to compare' )
+    threads_parser.add_argument(
+        '-a', '--cpuaffinity', action='store', default=None,
+        help='cpu list to pin every detector process to (e.g. 0-3)' )
+    threads_parser.add_argument(
+        '-c', '--cameras', action='store', type=int, default=4,
+        help='number of concurrent detector processes' )
+    threads_parser.add_argument(
+        '-n', '--frames', action='store', type=int, default=200,
+        help='frames per detector process' )
+    threads_parser.add_argument(
+        '-W', '--width', action='store', type=int, default=1280 )
+    threads_parser.add_argument(
+        '-H', '--height', action='store', type=int, default=720 )
+    threads_parser.set_defaults( func=bench_threads )
+
+    encode_parser = subparsers.add_parser(
+        'encode', help='video encoder throughput and output size' )
+    encode_parser.add_argument(
+        '-e', '--encoders', action='store', nargs='+',
+        default=['opencv', 'ffmpeg'], help='encoders to compare' )
+    encode_parser.add_argument(
+        '-n', '--frames', action='store', type=int, default=300,
+        help='frames to encode with each encoder' )
+    encode_parser.add_argument(
+        '-f', '--fps', action='store', type=float, default=15.0 )
+    encode_parser.add_argument(
+        '-p', '--preset', action='store', default='veryfast',
+        help='libx264 preset for the ffmpeg encoder' )
+    encode_parser.add_argument(
+        '-q', '--crf', action='store', type=int, default=23,
+        help='libx264 crf for the ffmpeg encoder' )
+    encode_parser.add_argument(
+        '-W', '--width', action='store', type=int, default=1280 )
+    encode_parser.add_argument(
+        '-H', '--height', action='store', type=int, default=720 )
+    encode_parser.set_defaults( func=bench_encode )
+
+    reserver_parser = subparsers.add_parser(
+        'reserver', help='reserver encode cost as clients are added' )
+    reserver_parser.add_argument(
+        '-c', '--clients', action='store', type=int, nargs='+',
+        default=[1, 10, 100], help='simulated client counts to compare' )
+    reserver_parser.add_argument(
+        '-n', '--frames', action='store', type=int, default=100,
+        help='frames for the clients to fetch' )
+    reserver_parser.add_argument(
+        '-W', '--width', action='store', type=int, default=1280 )
+    reserver_parser.add_argument(
+        '-H', '--height', action='store', type=int, default=720 )
+    reserver_parser.set_defaults( func=bench_reserver )
+
+    args = parser.parse_args()
+
+    args.func( args )
+
+if '__main__' == __name__:
+    main()
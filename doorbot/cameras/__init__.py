@@ -1,6 +1,9 @@
 
 import logging
 import multiprocessing
+import zlib
+
+import numpy
 
 try:
     from cv2 import cv2
@@ -32,6 +35,49 @@ class Camera( multiprocessing.Process ):
         self._ready = False
         self._frame_queue = multiprocessing.Queue(
             maxsize=1 )
+        self.kwargs = kwargs
+
+        # Frozen cameras keep delivering the same image, so drop frames that
+        # match the previous one and reconnect after too many in a row.
+        self.drop_duplicates = False if 'dropduplicates' in kwargs and \
+            'false' == kwargs['dropduplicates'] else True
+        self.stall_frames = int( kwargs['stallframes'] ) \
+            if 'stallframes' in kwargs else 50
+        self.fingerprint_grid = int( kwargs['fingerprintgrid'] ) \
+            if 'fingerprintgrid' in kwargs else 32
+        self.duplicates = 0
+        self.duplicate_frames = multiprocessing.Value( 'L', 0 )
+        self._last_fingerprint = None
+
+    def fingerprint( self, frame : numpy.ndarray ):
+
+        ''' Cheap checksum of a grid of pixels sampled across the frame. '''
+
+        step_y = max( 1, frame.shape[0] // self.fingerprint_grid )
+        step_x = max( 1, frame.shape[1] // self.fingerprint_grid )
+        grid = numpy.ascontiguousarray( frame[::step_y, ::step_x] )
+        return zlib.crc32( grid.tobytes() ) ^ hash( frame.shape )
+
+    def is_duplicate( self, frame : numpy.ndarray ):
+
+        ''' Return True if the frame is identical to the last one checked,
+        keeping count of consecutive and total duplicates. '''
+
+        fingerprint = self.fingerprint( frame )
+        if fingerprint != self._last_fingerprint:
+            self._last_fingerprint = fingerprint
+            self.duplicates = 0
+            return False
+
+        self.duplicates += 1
+        with self.duplicate_frames.get_lock():
+            self.duplicate_frames.value += 1
+        self.timer.count( 'duplicates' )
+        return True
+
+    @property
+    def stalled( self ):
+        return 0 < self.stall_frames and self.duplicates >= self.stall_frames
 
     @property
     def frame( self ):
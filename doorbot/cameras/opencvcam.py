@@ -7,6 +7,7 @@ except ImportError:
     import cv2
 
 from doorbot.cameras import Camera
+from doorbot.portability import apply_thread_budget
 
 class OpenCVCamera( Camera ):
 
@@ -34,6 +35,8 @@ class OpenCVCamera( Camera ):
 
         self.logger.debug( 'starting camera loop...' )
 
+        apply_thread_budget( **self.kwargs )
+
         while self.running:
             self.timer.loop_timer_start()
 
@@ -50,10 +53,15 @@ class OpenCVCamera( Camera ):
 
             if not ret:
                 self.logger.warning( 'camera disconnected!' )
-                self._stream.release()
-                self.attempts += 1
-                self.logger.info( 'reconnecting (attempt %d)', self.attempts )
-                self._stream.open( self.cam_url )
+                self.reconnect()
+                self.timer.loop_timer_end()
+                continue
+
+            if self.drop_duplicates and self.is_duplicate( frame ):
+                if self.stalled:
+                    self.logger.warning( 'camera stalled for %d frames!',
+                        self.duplicates )
+                    self.reconnect()
                 self.timer.loop_timer_end()
                 continue
 
@@ -63,5 +71,13 @@ class OpenCVCamera( Camera ):
 
             self.timer.loop_timer_end()
 
+    def reconnect( self ):
+        self._stream.release()
+        self.attempts += 1
+        self.duplicates = 0
+        self._last_fingerprint = None
+        self.logger.info( 'reconnecting (attempt %d)', self.attempts )
+        self._stream.open( self.cam_url )
+
 PLUGIN_CLASS = OpenCVCamera # pylint: disable=invalid-name
 PLUGIN_TYPE = 'cameras'
@@ -1,15 +1,128 @@
 
 import logging
 import os
-import multiprocessing
 import shutil
 import time
-from queue import Empty, Full
-from ftplib import FTP, FTP_TLS
-from ftplib import all_errors, error_perm
+from concurrent.futures import Future, ThreadPoolExecutor
+from ftplib import all_errors
 from urllib.parse import urlparse
 from datetime import datetime
 
+import numpy
+try:
+    from cv2 import cv2
+except ImportError:
+    import cv2
+
+from doorbot.portability import compress_frame, decompress_frame, \
+    thread_time
+from doorbot.capturers.pool import get_encoder_pool
+from doorbot.capturers.upload import enqueue_upload, get_spool_path, \
+    get_upload_queue
+from doorbot.index import get_clip_index
+from doorbot.storage import Storage, get_storage
+
+class FrameRing( object ):
+
+    ''' Fixed-capacity ring of the most recent frames, used to seed captures
+    with the frames from before motion started. In raw mode, the slots are
+    allocated once and each frame costs a single copy into its slot. In jpeg
+    or png mode, frames are stored compressed instead. '''
+
+    def __init__( self, instance_name, capacity, compression='raw', quality=None ):
+        self.logger = logging.getLogger( 'capture.preroll.{}'.format( instance_name ) )
+        self.capacity = capacity
+        self.compression = compression
+        self.quality = quality
+        self._slots = None
+        self._next = 0
+        self._count = 0
+
+    def __len__( self ):
+        return self._count
+
+    @property
+    def nbytes( self ):
+        if None is self._slots:
+            return 0
+        elif 'raw' == self.compression:
+            return self._slots.nbytes
+        return sum( len( s ) for s in self._slots if s )
+
+    def push( self, frame : numpy.ndarray, prepare=None ):
+
+        ''' Store a frame, overwriting the oldest one if the ring is full.
+        If given, prepare is called to e.g. draw an overlay on the stored
+        frame without touching the original. '''
+
+        if 'raw' == self.compression:
+            if None is self._slots or self._slots.shape[1:] != frame.shape:
+                self._slots = numpy.empty(
+                    (self.capacity,) + frame.shape, dtype=frame.dtype )
+                self._next = 0
+                self._count = 0
+                self.logger.info( 'pre-roll buffer allocated: %d frames, %d bytes',
+                    self.capacity, self._slots.nbytes )
+            slot = self._slots[self._next]
+            numpy.copyto( slot, frame )
+            if prepare:
+                prepare( slot )
+        else:
+            if None is self._slots:
+                self._slots = [None] * self.capacity
+            if prepare:
+                frame = frame.copy()
+                prepare( frame )
+            self._slots[self._next] = \
+                compress_frame( frame, self.compression, self.quality )
+
+        self._next = (self._next + 1) % self.capacity
+        self._count = min( self._count + 1, self.capacity )
+
+    def drain( self, copy=False ):
+
+        ''' Return the stored frames, oldest first, and empty the ring. The
+        slots are kept for the frames that come next, so raw frames are
+        returned as views of them that only last until the next push, unless
+        copy is set. '''
+
+        start = (self._next - self._count) % self.capacity
+        indexes = [(start + i) % self.capacity for i in range( self._count )]
+
+        if 'raw' == self.compression:
+            frames = [self._slots[i].copy() if copy else self._slots[i] \
+                for i in indexes]
+        else:
+            frames = [decompress_frame( self._slots[i] ) for i in indexes]
+            for i in indexes:
+                self._slots[i] = None
+
+        self._next = 0
+        self._count = 0
+
+        return frames
+
+def compress_frame_timed( frame, compression, quality ):
+    start = thread_time()
+    data = compress_frame( frame, compression, quality )
+    return data, frame.nbytes, thread_time() - start
+
+compressor = None # pylint: disable=invalid-name
+compressor_pid = None # pylint: disable=invalid-name
+
+def get_compressor( **kwargs ) -> ThreadPoolExecutor:
+
+    ''' Return the thread pool that compresses buffered frames in this
+    process, starting it with the given capturer configuration if it isn't
+    running yet. '''
+
+    global compressor, compressor_pid # pylint: disable=global-statement, invalid-name
+    if None == compressor or os.getpid() != compressor_pid:
+        compressor = ThreadPoolExecutor( max_workers=int(
+            kwargs['bufferthreads'] ) if 'bufferthreads' in kwargs else 2 )
+        compressor_pid = os.getpid()
+    return compressor
+
 class Capture( object ):
 
     ''' Abstract module for capturing and storing frames for archival. '''
@@ -24,23 +137,92 @@ class Capture( object ):
         self.multiproc = False if 'multiproc' in kwargs \
             and 'false' == kwargs['multiproc'] else True
         self.writer = None
+        self.writer_timestamp = None
+        self.event_uid = None
+        self.preroll = None
         self.frame_type = frame_type
         self.kwargs = kwargs
         self.instance_name = instance_name
         self.camera_key = kwargs['camera']
 
+        # Frames may be recorded at a lower rate and size than the camera's.
+        capture_fps = float( kwargs['capturefps'] ) \
+            if 'capturefps' in kwargs else 0
+        self.capture_interval = 1.0 / capture_fps if 0 < capture_fps else 0
+        self.next_capture = 0
+        self.capture_size = tuple( int( d ) for d in \
+            kwargs['capturesize'].split( 'x' ) ) \
+            if 'capturesize' in kwargs else None
+
+        # Start the uploader before any captures need it.
+        if 'path' in kwargs and get_storage( kwargs['path'], **kwargs ).remote \
+        and not ('uploadqueue' in kwargs and 'false' == kwargs['uploadqueue']):
+            get_upload_queue( **kwargs )
+
     def create_or_append_to_writer( self, frame, writer_type ):
         if None == self.writer:
             timestamp = datetime.now().strftime( self.ts_format )
+            self.writer_timestamp = timestamp
             writer = writer_type( self.instance_name, timestamp,
                 frame.shape[1], frame.shape[0], **self.kwargs )
+            writer.event_uid = self.event_uid
             if self.multiproc:
-                self.writer = CaptureWriterProcess( self.instance_name, writer, self.frame_type )
+                self.writer = get_encoder_pool( **self.kwargs ).submit( writer )
             else:
                 self.writer = writer
 
         self.writer.add_frame( frame )
 
+    def wants_frame( self ):
+
+        ''' Return False if the next frame would be dropped to keep to
+        capturefps, so that callers can skip preparing it. '''
+
+        return time.time() >= self.next_capture
+
+    def take_frame( self ):
+
+        ''' Return True if a frame arriving now should be recorded at
+        capturefps, and count it if so. '''
+
+        if not self.capture_interval:
+            return True
+        now = time.time()
+        if now < self.next_capture:
+            return False
+        # Keep to the schedule, unless frames stopped coming for a while.
+        self.next_capture += self.capture_interval
+        if self.next_capture <= now:
+            self.next_capture = now + self.capture_interval
+        return True
+
+    def copy_frame( self, frame ):
+
+        ''' Return a copy of a frame for recording, scaled to capturesize if
+        set. Scaling makes the copy in that case. '''
+
+        if None != self.capture_size and \
+        self.capture_size != (frame.shape[1], frame.shape[0]):
+            return cv2.resize( frame, self.capture_size,
+                interpolation=cv2.INTER_AREA )
+        return frame.copy()
+
+    def handle_idle_frame( self, frame, prepare=None ):
+
+        ''' Keep a frame without motion in the pre-roll buffer, if enabled.
+        prepare is passed on to FrameRing.push(). '''
+
+        if None == self.preroll or not self.take_frame():
+            return
+
+        if None != self.capture_size:
+            frame = frame.copy()
+            if prepare:
+                prepare( frame )
+            self.preroll.push( self.copy_frame( frame ) )
+        else:
+            self.preroll.push( frame, prepare )
+
     def handle_motion_frame( self, frame ):
 
         ''' Append a frame to the current animation, or handle it
@@ -67,125 +249,174 @@ class CaptureWriter( object ):
         self.path = kwargs['path'] if 'path' in kwargs else '/tmp'
         self.backup_path = \
             kwargs['backuppath'] if 'backuppath' in kwargs else None
-        self.ftp_ssl = bool( 'path' in kwargs and \
-            kwargs['path'].startswith( 'ftps://' ) )
+        self.upload_queue = False if 'uploadqueue' in kwargs \
+            and 'false' == kwargs['uploadqueue'] else True
+        # Writers are pickled over to the encoder pool, so only keep the
+        # options themselves, not the plugin module the config carries.
+        self.kwargs = {k: v for k, v in kwargs.items() if isinstance( v, str )}
+
+        # Where to record the files written, and the event they're for.
+        self.clip_index_path = kwargs['clipindex'] \
+            if 'clipindex' in kwargs else None
+        self.camera_key = kwargs['camera'] if 'camera' in kwargs else None
+        self.event_uid = None
 
         self.width = width
         self.height = height
 
         self.frame_array = []
+        self.frames_added = 0
         self.process = None
 
+        # Streaming writers consume each frame in add_frame(), so frames
+        # passed to them may be reused as soon as it returns.
+        self.streaming = False
+
+        # Buffered frames may be compressed in the background until needed.
+        self.buffer_compression = kwargs['buffercompression'] \
+            if 'buffercompression' in kwargs else 'none'
+        self.buffer_quality = kwargs['bufferquality'] \
+            if 'bufferquality' in kwargs else None
+        self.buffer_stats = {
+            'raw': 0, 'compressed': 0, 'compress_cpu': 0.0, 'decode_cpu': 0.0,
+            'frames': 0}
+
     def add_frame( self, frame ):
+        if 'none' != self.buffer_compression:
+            frame = get_compressor( **self.kwargs ).submit(
+                compress_frame_timed, frame, self.buffer_compression,
+                self.buffer_quality )
         self.frame_array.append( frame )
+        self.frames_added += 1
+
+    def unbuffer( self, frame ):
+
+        ''' Return a frame taken from frame_array, decompressing it if it was
+        compressed. '''
+
+        if not isinstance( frame, Future ):
+            return frame
+
+        data, raw_bytes, compress_cpu = frame.result()
+        start = thread_time()
+        frame = decompress_frame( data )
+        self.buffer_stats['decode_cpu'] += thread_time() - start
+        self.buffer_stats['raw'] += raw_bytes
+        self.buffer_stats['compressed'] += len( data )
+        self.buffer_stats['compress_cpu'] += compress_cpu
+        self.buffer_stats['frames'] += 1
+        return frame
+
+    def log_buffer_stats( self ):
+        stats = self.buffer_stats
+        if not stats['frames']:
+            return
+        self.logger.info( 'buffered %d frames as %s: %d bytes raw, %d '
+            'compressed (%.1fx); %.2fms CPU per frame to compress, %.2fms to '
+            'decode', stats['frames'], self.buffer_compression, stats['raw'],
+            stats['compressed'], stats['raw'] / max( 1, stats['compressed'] ),
+            stats['compress_cpu'] * 1000 / stats['frames'],
+            stats['decode_cpu'] * 1000 / stats['frames'] )
 
     def start( self ):
 
         ''' Implementation should override this and begin processing. '''
 
-    def upload_ftp_or_backup( self, filepath, filename, temp_dir ):
+    def record_artefact( self, path, kind, duration=None, size=None,
+        upload_status=None ):
+
+        ''' Add a file written by this writer to the clip index, if there is
+        one. '''
+
+        if None == self.clip_index_path:
+            return None
+        clip_index = get_clip_index( self.clip_index_path )
+        clip_index.add_artefact( path, kind, self.camera_key,
+            datetime.strptime( self.timestamp, self.ts_format ).timestamp(),
+            duration, size, upload_status, self.event_uid )
+        return clip_index
+
+    def upload_or_backup( self, filepath, filename, temp_dir, kind=None,
+        duration=None ):
+
+        artefact = self.storage_url( filename )
+        clip_index = None
+        if kind:
+            clip_index = self.record_artefact( artefact, kind, duration,
+                os.path.getsize( filepath ),
+                'queued' if self.upload_queue else 'uploading' )
+
+        if self.upload_queue:
+            # Hand the file to the upload queue to retry until it succeeds.
+            try:
+                if clip_index:
+                    # The uploader updates this row from its own process.
+                    clip_index.flush()
+                enqueue_upload(
+                    get_spool_path( **self.kwargs ), filepath,
+                    path=self.path, timestamp=self.timestamp,
+                    tsformat=self.ts_format, filename=filename,
+                    backuppath=self.backup_path,
+                    clipindex=self.clip_index_path if kind else None,
+                    artefact=artefact, options=self.kwargs )
+                temp_dir.cleanup()
+                return
+            except OSError as exc:
+                self.logger.error( 'could not queue %s for upload: %s',
+                    filename, exc )
+
         try:
-            self.upload_ftp( filepath )
-        except (ConnectionRefusedError,) as exc:
-            self.logger.error( 'ftp upload failure: %s', exc )
+            self.upload( filepath )
+            if clip_index:
+                clip_index.set_upload_status( artefact, 'uploaded' )
+        except all_errors as exc:
+            self.logger.error( 'upload failure: %s', exc )
             if self.backup_path:
                 backup_filepath = os.path.join( self.backup_path, filename )
                 self.logger.info( 'moving %s to %s...', filepath, backup_filepath )
                 shutil.move( filepath, backup_filepath )
+                if clip_index:
+                    clip_index.set_upload_status(
+                        artefact, 'backup', backup_filepath )
+            elif clip_index:
+                clip_index.set_upload_status( artefact, 'failed' )
         temp_dir.cleanup()
 
-    def login_ftp( self ) -> FTP:
-        # FTP login.
-        parsed = urlparse( self.path )
-        self.logger.info( 'logging into ftp at %s as %s...',
-            parsed.hostname, parsed.username )
-        ftp = None
-        if self.ftp_ssl:
-            ftp_class = FTP_TLS
-        else:
-            ftp_class = FTP
-        ftp = ftp_class()
-        connect_args = { 'host': parsed.hostname }
-        if parsed.port:
-            connect_args['port'] = parsed.port
-        ftp.connect( **connect_args )
-        ftp.login( user=parsed.username, passwd=parsed.password )
-        if self.ftp_ssl:
-            ftp.prot_p()
-        return ftp
-
-    def chdir_ftp( self, ftp : FTP, path ):
-
-        if not path:
-            return
+    @property
+    def storage( self ) -> Storage:
 
-        try:
-            ftp.cwd( path )
-        except error_perm:
-            parent_path = os.path.dirname( path )
-            self.chdir_ftp( ftp, parent_path )
-            self.logger.info( 'creating missing remote directory: %s', path )
-            try:
-                ftp.mkd( path )
-            except error_perm:
-                pass
-            ftp.cwd( path )
+        ''' The storage for path. This is looked up rather than kept, as
+        writers are passed between processes and storage can't be. '''
 
-    def upload_ftp( self, filepath ):
+        return get_storage( self.path, **self.kwargs )
 
-        ''' Upload the given file to the FTP server configured in the
-        application configuration (path under [videocap]). '''
+    def remote_dir( self ):
 
-        ftp = self.login_ftp()
+        ''' Return the directory on the storage to upload to, with %date%
+        filled in. '''
 
-        # Tokenize FTP CWD path and create missing directories.
-        parsed = urlparse( self.path )
-        cwd_path = parsed.path
         datestamp = datetime.strftime(
             datetime.strptime( self.timestamp, self.ts_format ), '%Y-%m-%d' )
-        cwd_path = cwd_path.replace( '%date%', datestamp )
+        return urlparse( self.path ).path.replace( '%date%', datestamp )
 
-        self.chdir_ftp( ftp, cwd_path )
+    def remote_path( self, filename ):
+        return '{}/{}'.format( self.remote_dir().rstrip( '/' ), filename )
 
-        self.logger.info( 'uploading %s to %s...', filepath, cwd_path )
+    def storage_url( self, filename ):
 
-        # Upload the file.
-        with open( filepath, 'rb' ) as upload_file:
-            dest_filename = os.path.basename( filepath )
-            ftp.storbinary( 'STOR {}'.format( dest_filename ), upload_file )
-
-class CaptureWriterProcess( multiprocessing.Process ):
-    def __init__( self, instance_name, writer : CaptureWriter, frame_type : type ):
-        super().__init__()
-        self.frames = multiprocessing.Queue()
-        self.writer = writer
-        self.writer.process = self
-        self.logger = logging.getLogger( 'capture.process.{}'.format( instance_name ) )
-        self.frame_type = frame_type
-        self.instance_name = instance_name
+        ''' Return the URL a file will be uploaded to, without login
+        details. '''
 
-    def add_frame( self, frame ):
-        try:
-            self.frames.put_nowait( frame )
-        except Full:
-            self.logger.warning( 'queue full; skipping...' )
+        return self.storage.public_url( self.remote_path( filename ) )
 
-    def run( self ):
+    def upload( self, filepath, dest_filename=None, resume=False ):
 
-        kickstart = True
-        frame = None
-        while isinstance( frame, self.frame_type ) or kickstart:
-            try:
-                frame = self.frames.get( block=True, timeout=1.0 )
-                self.writer.frame_array.insert( 0, frame )
-                kickstart = False
-            except Empty:
-                self.logger.warning( 'queue empty; skipping...' )
-                break
-
-        self.logger.info( 'encoder thread received %d frames',
-            len( self.writer.frame_array ) )
-        self.frames.close()
-
-        self.writer.start()
-        self.writer = None
+        ''' Upload the given file to the storage at path, as dest_filename
+        if given. If resume is True, a partial upload of the same name is
+        continued rather than started over. Returns the bytes sent. '''
+
+        if None == dest_filename:
+            dest_filename = os.path.basename( filepath )
+
+        return self.storage.upload(
+            filepath, self.remote_path( dest_filename ), resume )
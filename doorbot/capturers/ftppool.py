@@ -0,0 +1,155 @@
+
+import logging
+import os
+import threading
+import time
+from ftplib import all_errors
+
+class FTPSession( object ):
+
+    ''' An authenticated FTP connection, remembering the remote directory it
+    is in so that consecutive uploads to the same place skip the CWD. '''
+
+    def __init__( self, key, ftp ):
+        self.key = key
+        self.ftp = ftp
+        self.cwd = None
+        self.uses = 0
+        self.last_used = time.time()
+        self.last_noop = self.last_used
+
+    def close( self ):
+        try:
+            self.ftp.quit()
+        except all_errors:
+            self.ftp.close()
+
+class FTPPool( object ):
+
+    ''' Keeps idle FTP sessions open per destination (scheme, host, port and
+    user), so a burst of uploads pays for a single login and TLS handshake.
+    Idle sessions are kept alive with NOOPs and closed once they have been
+    idle for too long. Directories known to exist on each destination are
+    cached so they aren't walked again. '''
+
+    def __init__( self, **kwargs ):
+
+        self.logger = logging.getLogger( 'capture.ftppool' )
+
+        self.keepalive = float( kwargs['ftpkeepalive'] ) \
+            if 'ftpkeepalive' in kwargs else 30.0
+        self.idle_timeout = float( kwargs['ftpidle'] ) \
+            if 'ftpidle' in kwargs else 300.0
+        self.max_idle = int( kwargs['ftppool'] ) \
+            if 'ftppool' in kwargs else 2
+
+        self.pid = os.getpid()
+        self.logins = 0
+
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._known_dirs = {}
+        self._stopped = threading.Event()
+
+        self._keepalive_thread = threading.Thread(
+            target=self.run_keepalive, daemon=True )
+        self._keepalive_thread.start()
+
+    def acquire( self, key, login ) -> FTPSession:
+
+        ''' Return an idle session for the given destination, or a new one
+        from calling login() if there are none. '''
+
+        with self._lock:
+            idle = self._idle.get( key, [] )
+            if idle:
+                session = idle.pop()
+                self.logger.debug( 'reusing ftp session to %s', key[1] )
+                return session
+
+        self.logins += 1
+        return FTPSession( key, login() )
+
+    def release( self, session : FTPSession, broken=False ):
+
+        ''' Return a session to the pool, or close it if it failed or the
+        pool for its destination is full. '''
+
+        if broken:
+            session.ftp.close()
+            return
+
+        session.last_used = time.time()
+        session.uses += 1
+        with self._lock:
+            idle = self._idle.setdefault( session.key, [] )
+            if len( idle ) < self.max_idle:
+                idle.append( session )
+                return
+        session.close()
+
+    def known_dirs( self, key ) -> set:
+        with self._lock:
+            return self._known_dirs.setdefault( key, set() )
+
+    def reset( self, key ):
+
+        ''' Drop the idle sessions and known directories for a destination,
+        once one of its sessions has turned out to be stale. '''
+
+        with self._lock:
+            self._known_dirs.pop( key, None )
+            sessions = self._idle.pop( key, [] )
+        for session in sessions:
+            session.ftp.close()
+
+    def run_keepalive( self ):
+
+        while not self._stopped.wait( min( self.keepalive, self.idle_timeout ) ):
+
+            # Take idle sessions out of the pool so they aren't used while
+            # the NOOP is in flight.
+            with self._lock:
+                sessions = [s for idle in self._idle.values() for s in idle]
+                for idle in self._idle.values():
+                    idle.clear()
+
+            now = time.time()
+            for session in sessions:
+                if now - session.last_used >= self.idle_timeout:
+                    self.logger.debug( 'closing idle ftp session to %s',
+                        session.key[1] )
+                    session.close()
+                    continue
+                if now - session.last_noop >= self.keepalive:
+                    try:
+                        session.ftp.voidcmd( 'NOOP' )
+                        session.last_noop = now
+                    except all_errors as exc:
+                        self.logger.debug( 'ftp session to %s lost: %s',
+                            session.key[1], exc )
+                        session.ftp.close()
+                        continue
+                with self._lock:
+                    self._idle.setdefault( session.key, [] ).append( session )
+
+    def close( self ):
+        self._stopped.set()
+        with self._lock:
+            sessions = [s for idle in self._idle.values() for s in idle]
+            self._idle = {}
+        for session in sessions:
+            session.close()
+
+ftp_pool = None # pylint: disable=invalid-name
+
+def get_ftp_pool( **kwargs ):
+
+    ''' Return the FTP pool for this process, starting it with the given
+    capturer configuration if it isn't running yet. A pool inherited from a
+    parent process is replaced, as its sessions and thread can't be shared. '''
+
+    global ftp_pool # pylint: disable=global-statement, invalid-name
+    if None == ftp_pool or os.getpid() != ftp_pool.pid:
+        ftp_pool = FTPPool( **kwargs )
+    return ftp_pool
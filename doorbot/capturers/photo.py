@@ -1,6 +1,10 @@
 
 import logging
 import os
+import time
+from queue import Queue, Full
+from tempfile import TemporaryDirectory
+from threading import Thread
 
 import numpy
 try:
@@ -8,6 +12,7 @@ try:
 except ImportError:
     import cv2
 
+from doorbot.portability import is_frame
 from doorbot.capturers import Capture, CaptureWriter
 
 class PhotoCaptureWriter( CaptureWriter ):
@@ -15,37 +20,113 @@ class PhotoCaptureWriter( CaptureWriter ):
     def __init__( self, instance_name, timestamp, width, height, **kwargs ):
         super().__init__( instance_name, timestamp, width, height, **kwargs )
 
-        self.logger = logging.getLogger('capture.photo.{}'.format( instance_name ) ) 
+        self.logger = logging.getLogger('capture.photo.{}'.format( instance_name ) )
+
+        self.quality = int( kwargs['quality'] ) if 'quality' in kwargs else 95
 
         self.logger.info( 'creating photo writer for %s.jpg...',
             os.path.join( self.path, self.timestamp ) )
 
     def start( self ):
 
-        filename = '{}/{}.jpg'.format( self.path, self.timestamp )
+        filename = '{}.jpg'.format( self.timestamp )
+
+        # Photos for remote storage are written to a temporary directory to
+        # be uploaded from.
+        temp_dir = None
+        if self.storage.remote:
+            temp_dir = TemporaryDirectory()
+            filepath = os.path.join( temp_dir.name, filename )
+        else:
+            filepath = os.path.join( self.path, filename )
 
-        self.logger.info( 'writing %s...', filename )
+        self.logger.info( 'writing %s...', filepath )
 
         assert( 1 == len( self.frame_array ) )
-        cv2.imwrite( filename, self.frame_array[0] )
+        cv2.imwrite( filepath, self.unbuffer( self.frame_array[0] ),
+            [cv2.IMWRITE_JPEG_QUALITY, self.quality] )
 
-        self.logger.info( 'writing %s complete', filename )
+        if None != temp_dir:
+            self.upload_or_backup( filepath, filename, temp_dir, 'photo' )
+        else:
+            self.record_artefact( filepath, 'photo',
+                size=os.path.getsize( filepath ), upload_status='local' )
+
+        self.logger.info( 'writing %s complete', filepath )
 
 class PhotoCapture( Capture ):
 
+    ''' Writes each motion frame kept by capturefps and maxpersec to a JPEG
+    file, scaled to capturesize if set. Writes happen in the encoder
+    pool or, without multiproc, in a background thread fed by a bounded
+    queue, so the main loop never waits on the disk. Photos are dropped
+    rather than queued once the queue is full. '''
+
     def __init__( self, instance_name, **kwargs ):
         super().__init__( instance_name, numpy.ndarray, **kwargs )
 
+        self.logger = logging.getLogger(
+            'capture.photo.{}'.format( self.instance_name ) )
+
+        max_per_sec = float( kwargs['maxpersec'] ) \
+            if 'maxpersec' in kwargs else 0
+        self.min_interval = 1.0 / max_per_sec if 0 < max_per_sec else 0
+        self.last_photo = None
+        self.dropped_photos = 0
+
+        self.queue = Queue( maxsize=int( kwargs['photoqueue'] ) \
+            if 'photoqueue' in kwargs else 10 )
+        self.thread = None
+
+    def run_writer( self ):
+        while True:
+            writer = self.queue.get()
+            try:
+                if None is writer:
+                    break
+                writer.start()
+            except Exception as exc: # pylint: disable=broad-except
+                self.logger.exception( exc )
+            finally:
+                self.queue.task_done()
+
     def handle_motion_frame( self, frame : numpy.ndarray ):
 
-        # Individually process the last snapshot.
-        super().create_or_append_to_writer( frame, PhotoCaptureWriter )
-        self.writer.start()
+        if not is_frame( frame ):
+            return
+
+        # Throttle bursts to maxpersec, then drop frames over capturefps.
+        now = time.time()
+        if None != self.last_photo and now - self.last_photo < self.min_interval:
+            return
+        if not self.take_frame():
+            return
+        self.last_photo = now
+
+        # Individually process the last snapshot, scaled to capturesize.
+        super().create_or_append_to_writer(
+            self.copy_frame( frame ), PhotoCaptureWriter )
+        writer = self.writer
         self.writer = None
 
+        if self.multiproc:
+            writer.start()
+            return
+
+        if None == self.thread:
+            self.thread = Thread( target=self.run_writer, daemon=True )
+            self.thread.start()
+        try:
+            self.queue.put_nowait( writer )
+        except Full:
+            self.dropped_photos += 1
+            self.logger.warning( 'photo queue full; skipping...' )
+
     def finalize_motion( self, frame : numpy.ndarray ):
 
-        pass
+        # Wait for queued photos to be written.
+        if None != self.thread:
+            self.queue.join()
 
 PLUGIN_TYPE = 'capturers'
 PLUGIN_CLASS = PhotoCapture
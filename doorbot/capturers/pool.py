@@ -0,0 +1,261 @@
+
+import logging
+import multiprocessing
+import os
+from queue import Empty
+
+import numpy
+
+from doorbot.index import close_clip_index
+from doorbot.portability import apply_thread_budget, shared_memory
+
+try:
+    from multiprocessing import resource_tracker
+except ImportError:
+    resource_tracker = None # pylint: disable=invalid-name
+
+class EncoderJob( object ):
+
+    ''' Handle for a capture writer running in the encoder pool, with the same
+    add_frame()/start() interface as the writer itself. '''
+
+    def __init__( self, pool, worker, job_id ):
+        self.pool = pool
+        self.worker = worker
+        self.job_id = job_id
+
+    def add_frame( self, frame ):
+        self.pool.send_frame( self.worker, self.job_id, frame )
+
+    def start( self ):
+        self.pool.close_job( self.worker, self.job_id )
+
+class EncoderWorker( multiprocessing.Process ):
+
+    ''' Long-lived process that runs the writers of any number of capture
+    jobs. Frames arrive either in one of the slots of a shared memory slab,
+    which is handed back once the frame has been taken, or pickled. The job
+    queue is unbounded so the camera loop never blocks on it; the pool
+    limits how many frames it puts there instead. '''
+
+    def __init__( self, index, **kwargs ):
+        super().__init__()
+        self.daemon = True
+        self.index = index
+        self.jobs = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.kwargs = kwargs
+        self.logger = logging.getLogger( 'capture.encoder.{}'.format( index ) )
+
+    def run( self ):
+
+        apply_thread_budget( **self.kwargs )
+
+        writers = {}
+        slab = None
+        slab_gen = 0
+        slot_size = 0
+
+        while True:
+            msg = self.jobs.get()
+            if None is msg:
+                break
+
+            cmd = msg[0]
+            if 'open' == cmd:
+                writers[msg[1]] = msg[2]
+
+            elif 'slab' == cmd:
+                if slab:
+                    slab.close()
+                slab_gen, name, slot_size = msg[1:]
+                slab = shared_memory.SharedMemory( name=name )
+
+            elif 'shm' == cmd:
+                job_id, gen, slot, shape, dtype = msg[1:]
+                frame = numpy.ndarray( shape, dtype=dtype, buffer=slab.buf,
+                    offset=slot * slot_size )
+                if job_id in writers:
+                    writer = writers[job_id]
+                    writer.add_frame( frame if writer.streaming else frame.copy() )
+                del frame
+                self.results.put( ('slot', gen, slot) )
+
+            elif 'frame' == cmd:
+                if msg[1] in writers:
+                    writers[msg[1]].add_frame( msg[2] )
+                self.results.put( ('taken',) )
+
+            elif 'close' == cmd:
+                writer = writers.pop( msg[1], None )
+                try:
+                    if writer:
+                        self.logger.info( 'encoder received %d frames',
+                            writer.frames_added )
+                        writer.start()
+                except Exception as exc: # pylint: disable=broad-except
+                    self.logger.exception( exc )
+                self.results.put( ('done', msg[1]) )
+
+        if slab:
+            slab.close()
+
+        close_clip_index()
+
+class EncoderPool( object ):
+
+    ''' Persistent set of encoder processes shared by all capturers in this
+    process. Each capture job is assigned to the worker with the fewest jobs
+    open or encoding, so concurrent encodes are capped at the worker count.
+    Frames are dropped rather than queued once a worker falls behind. '''
+
+    def __init__( self, **kwargs ):
+
+        self.logger = logging.getLogger( 'capture.encoders' )
+
+        self.worker_count = int( kwargs['encoders'] ) if 'encoders' in kwargs \
+            else max( 1, (os.cpu_count() or 2) - 1 )
+        self.queue_size = int( kwargs['encoderqueue'] ) \
+            if 'encoderqueue' in kwargs else 50
+        self.slot_count = int( kwargs['encoderslots'] ) \
+            if 'encoderslots' in kwargs else 8
+        self.kwargs = kwargs
+
+        self.workers = []
+        self._loads = []
+        self._queued = []
+        self._slabs = []
+        self._job_id = 0
+
+        if shared_memory and resource_tracker:
+            # Share the tracker with the workers so attaching to a slab in a
+            # worker doesn't get it cleaned up when the worker exits.
+            resource_tracker.ensure_running()
+
+        for index in range( self.worker_count ):
+            worker = EncoderWorker( index, **kwargs )
+            worker.start()
+            self.workers.append( worker )
+            self._loads.append( 0 )
+            self._queued.append( 0 )
+            self._slabs.append( {
+                'gen': 0, 'shm': None, 'slot_size': 0, 'free': [], 'old': {}} )
+
+        self.logger.info( 'started %d encoder workers', self.worker_count )
+
+    def _poll( self, worker ):
+        slab = self._slabs[worker]
+        while True:
+            try:
+                result = self.workers[worker].results.get_nowait()
+            except Empty:
+                return
+            if 'done' == result[0]:
+                self._loads[worker] -= 1
+            elif 'taken' == result[0]:
+                self._queued[worker] -= 1
+            elif 'slot' == result[0]:
+                self._queued[worker] -= 1
+                if result[1] == slab['gen']:
+                    slab['free'].append( result[2] )
+                elif result[1] in slab['old']:
+                    # Release an old slab once its last slot comes back.
+                    old = slab['old'][result[1]]
+                    old['busy'] -= 1
+                    if 0 >= old['busy']:
+                        self._release_slab( slab['old'].pop( result[1] )['shm'] )
+
+    def submit( self, writer ):
+        for worker in range( self.worker_count ):
+            self._poll( worker )
+        worker = min( range( self.worker_count ), key=lambda w: self._loads[w] )
+        self._loads[worker] += 1
+        self._job_id += 1
+        self.workers[worker].jobs.put_nowait( ('open', self._job_id, writer) )
+        return EncoderJob( self, worker, self._job_id )
+
+    def _release_slab( self, shm ):
+        shm.close()
+        shm.unlink()
+
+    def _alloc_slab( self, worker, slot_size ):
+        slab = self._slabs[worker]
+        if slab['shm']:
+            # Frames in flight may still use the old slab, so it is kept
+            # until the last of their slots is handed back.
+            busy = self.slot_count - len( slab['free'] )
+            if busy:
+                slab['old'][slab['gen']] = {'shm': slab['shm'], 'busy': busy}
+            else:
+                self._release_slab( slab['shm'] )
+        slab['gen'] += 1
+        slab['shm'] = shared_memory.SharedMemory(
+            create=True, size=slot_size * self.slot_count )
+        slab['slot_size'] = slot_size
+        slab['free'] = list( range( self.slot_count ) )
+        self.workers[worker].jobs.put_nowait(
+            ('slab', slab['gen'], slab['shm'].name, slot_size) )
+        self.logger.info( 'encoder %d: allocated %d frame slots (%d bytes)',
+            worker, self.slot_count, slot_size * self.slot_count )
+
+    def send_frame( self, worker, job_id, frame ):
+        self._poll( worker )
+
+        if self._queued[worker] >= self.queue_size:
+            self.logger.warning( 'encoder %d queue full; skipping...', worker )
+            return
+
+        if not shared_memory or not isinstance( frame, numpy.ndarray ):
+            msg = ('frame', job_id, frame)
+        else:
+            slab = self._slabs[worker]
+            if frame.nbytes > slab['slot_size']:
+                self._alloc_slab( worker, frame.nbytes )
+            if not slab['free']:
+                self.logger.warning( 'encoder %d slots full; skipping...', worker )
+                return
+            slot = slab['free'].pop()
+            slot_view = numpy.ndarray( frame.shape, dtype=frame.dtype,
+                buffer=slab['shm'].buf, offset=slot * slab['slot_size'] )
+            numpy.copyto( slot_view, frame )
+            del slot_view
+            msg = ('shm', job_id, slab['gen'], slot, frame.shape, frame.dtype.str)
+
+        self.workers[worker].jobs.put_nowait( msg )
+        self._queued[worker] += 1
+
+    def close_job( self, worker, job_id ):
+        self.workers[worker].jobs.put_nowait( ('close', job_id) )
+
+    def shutdown( self, timeout=None ):
+
+        ''' Finish all queued jobs and stop the workers. '''
+
+        for worker in self.workers:
+            worker.jobs.put( None )
+        for worker in self.workers:
+            worker.join( timeout )
+        for slab in self._slabs:
+            for old in slab['old'].values():
+                self._release_slab( old['shm'] )
+            if slab['shm']:
+                self._release_slab( slab['shm'] )
+        self.logger.info( 'encoder workers stopped' )
+
+encoder_pool = None # pylint: disable=invalid-name
+
+def get_encoder_pool( **kwargs ):
+
+    ''' Return the encoder pool for this process, starting it with the given
+    capturer configuration if it isn't running yet. '''
+
+    global encoder_pool # pylint: disable=global-statement, invalid-name
+    if None == encoder_pool:
+        encoder_pool = EncoderPool( **kwargs )
+    return encoder_pool
+
+def shutdown_encoder_pool( timeout=None ):
+    global encoder_pool # pylint: disable=global-statement, invalid-name
+    if None != encoder_pool:
+        encoder_pool.shutdown( timeout )
+        encoder_pool = None
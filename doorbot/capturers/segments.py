@@ -0,0 +1,128 @@
+
+import logging
+import os
+from array import array
+from bisect import bisect_left, bisect_right
+
+class SegmentIndex( object ):
+
+    ''' Start and end times of continuous recording segments, with the times
+    of motion events during them, kept sorted so that time lookups are a
+    binary search. Backed by an append-only text file of one record per
+    line:
+
+        S <start> <filename>    segment started
+        E <end>                 last started segment ended
+        M <timestamp>           motion event
+
+    A segment that was never ended (e.g. on a crash) is taken to have ended
+    at the start of the next one, or to still be recording if it is the
+    last. '''
+
+    def __init__( self, index_path ):
+
+        self.logger = logging.getLogger( 'capture.segments' )
+
+        self.index_path = index_path
+
+        self.starts = array( 'd' )
+        self.ends = array( 'd' )
+        self.names = []
+        self.events = array( 'd' )
+
+        if os.path.exists( index_path ):
+            self.load()
+
+        self._index_file = open( index_path, 'a' )
+
+    def __len__( self ):
+        return len( self.starts )
+
+    def load( self ):
+        with open( self.index_path, 'r' ) as index_file:
+            for line in index_file:
+                fields = line.split( ' ', 2 )
+                try:
+                    if 'S' == fields[0]:
+                        self._begin( float( fields[1] ), fields[2].strip() )
+                    elif 'E' == fields[0] and self.names:
+                        self.ends[-1] = float( fields[1] )
+                    elif 'M' == fields[0]:
+                        self._add_event( float( fields[1] ) )
+                except (IndexError, ValueError):
+                    self.logger.warning( 'skipping bad index line: %s',
+                        line.strip() )
+        self.logger.info( 'loaded %d segments and %d events from %s',
+            len( self.starts ), len( self.events ), self.index_path )
+
+    def _write( self, line ):
+        self._index_file.write( line + '\n' )
+        self._index_file.flush()
+
+    def _begin( self, start, name ):
+        if self.starts and 0 > self.ends[-1]:
+            # The previous segment was never ended.
+            self.ends[-1] = start
+        self.starts.append( start )
+        self.ends.append( -1 )
+        self.names.append( name )
+
+    def _add_event( self, timestamp ):
+        if self.events and timestamp < self.events[-1]:
+            self.events.insert( bisect_right( self.events, timestamp ),
+                timestamp )
+        else:
+            self.events.append( timestamp )
+
+    def begin( self, start, name ):
+        self._begin( start, name )
+        self._write( 'S {:.3f} {}'.format( start, name ) )
+
+    def end( self, end ):
+        self.ends[-1] = end
+        self._write( 'E {:.3f}'.format( end ) )
+
+    def add_event( self, timestamp ):
+        self._add_event( timestamp )
+        self._write( 'M {:.3f}'.format( timestamp ) )
+
+    def _end_of( self, index ):
+        # Segments still open run until now.
+        return self.ends[index] if 0 <= self.ends[index] else float( 'inf' )
+
+    def locate( self, timestamp ):
+
+        ''' Return the filename of the segment recorded at timestamp and the
+        offset in seconds into it, or None if nothing was recording. '''
+
+        index = bisect_right( self.starts, timestamp ) - 1
+        if 0 > index or timestamp >= self._end_of( index ):
+            return None
+        return self.names[index], timestamp - self.starts[index]
+
+    def segments_between( self, start, end ):
+
+        ''' Return (filename, start, end) of every segment overlapping the
+        given time range. end is None for a segment still recording. '''
+
+        first = max( 0, bisect_right( self.starts, start ) - 1 )
+        last = bisect_left( self.starts, end )
+        return [(self.names[i], self.starts[i],
+            self.ends[i] if 0 <= self.ends[i] else None) \
+            for i in range( first, last ) if self._end_of( i ) > start]
+
+    def events_between( self, start, end ):
+
+        ''' Return (timestamp, filename, offset) of every motion event in
+        the given time range. filename and offset are None for events that
+        weren't recorded. '''
+
+        events = []
+        for timestamp in self.events[bisect_left( self.events, start ):
+            bisect_left( self.events, end )]:
+            located = self.locate( timestamp )
+            events.append( (timestamp,) + (located if located else (None, None)) )
+        return events
+
+    def close( self ):
+        self._index_file.close()
@@ -0,0 +1,261 @@
+
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from uuid import uuid4
+
+from doorbot.index import close_clip_index, get_clip_index
+
+def get_spool_path( **kwargs ):
+    return kwargs['uploadspool'] if 'uploadspool' in kwargs \
+        else os.path.join( tempfile.gettempdir(), 'doorbot-uploads' )
+
+def write_entry( spool_path, entry ):
+
+    ''' Atomically write a journal entry, so a crash never leaves a half
+    written entry behind. '''
+
+    entry_path = os.path.join( spool_path, '{}.json'.format( entry['id'] ) )
+    with open( entry_path + '.tmp', 'w' ) as entry_file:
+        json.dump( entry, entry_file )
+        entry_file.flush()
+        os.fsync( entry_file.fileno() )
+    os.replace( entry_path + '.tmp', entry_path )
+
+def enqueue_upload( spool_path, filepath, **entry ):
+
+    ''' Move a finished capture into the spool directory and journal it for
+    upload. The file is in place before its entry is written, so the
+    uploader never sees an entry without its file. '''
+
+    os.makedirs( spool_path, exist_ok=True )
+
+    entry['id'] = uuid4().hex
+    entry['data'] = '{}.data'.format( entry['id'] )
+    entry['attempts'] = 0
+    entry['next_attempt'] = 0
+
+    shutil.move( filepath, os.path.join( spool_path, entry['data'] ) )
+    write_entry( spool_path, entry )
+
+    return entry['id']
+
+class UploadQueue( multiprocessing.Process ):
+
+    ''' Uploads captures journaled in the spool directory from a pool of
+    threads, retrying failures with capped exponential backoff. Partial
+    uploads are resumed where the server left off. Since the journal lives
+    on disk, anything not yet uploaded is picked up again on restart. '''
+
+    def __init__( self, **kwargs ):
+        super().__init__()
+        self.daemon = True
+
+        self.spool_path = get_spool_path( **kwargs )
+        self.worker_count = int( kwargs['uploadworkers'] ) \
+            if 'uploadworkers' in kwargs else 2
+        self.retries = int( kwargs['uploadretries'] ) \
+            if 'uploadretries' in kwargs else 10
+        self.retry_base = float( kwargs['uploadretry'] ) \
+            if 'uploadretry' in kwargs else 5.0
+        self.retry_max = float( kwargs['uploadretrymax'] ) \
+            if 'uploadretrymax' in kwargs else 600.0
+        self.poll = float( kwargs['uploadpoll'] ) \
+            if 'uploadpoll' in kwargs else 1.0
+        self.kwargs = kwargs
+
+        self.logger = logging.getLogger( 'capture.upload' )
+
+        self._pending = multiprocessing.Value( 'i', 0 )
+        self._bytes_sent = multiprocessing.Value( 'L', 0 )
+        self._stopped = multiprocessing.Event()
+
+        self._in_flight = set()
+        self._lock = threading.Lock()
+
+    @property
+    def depth( self ):
+
+        ''' Number of captures waiting in the journal. '''
+
+        return self._pending.value
+
+    @property
+    def bytes_sent( self ):
+        return self._bytes_sent.value
+
+    def run( self ):
+
+        self.logger = logging.getLogger( 'capture.upload' )
+
+        os.makedirs( self.spool_path, exist_ok=True )
+
+        entries = queue.Queue()
+        threads = [threading.Thread( target=self.run_worker, args=(entries,) ) \
+            for i in range( self.worker_count )]
+        for thread in threads:
+            thread.start()
+
+        while True:
+            self.scan( entries )
+            if self._stopped.wait( self.poll ):
+                break
+
+        # Leave anything not yet started in the journal.
+        try:
+            while True:
+                entries.get_nowait()
+        except queue.Empty:
+            pass
+
+        for thread in threads:
+            entries.put( None )
+        for thread in threads:
+            thread.join()
+
+        close_clip_index()
+
+    def scan( self, entries : queue.Queue ):
+
+        now = time.time()
+        pending = 0
+        for dir_entry in os.scandir( self.spool_path ):
+            if not dir_entry.name.endswith( '.json' ):
+                continue
+            pending += 1
+            with self._lock:
+                if dir_entry.name in self._in_flight:
+                    continue
+            try:
+                with open( dir_entry.path, 'r' ) as entry_file:
+                    entry = json.load( entry_file )
+            except (OSError, ValueError) as exc:
+                self.logger.error( 'could not read %s: %s', dir_entry.name, exc )
+                continue
+            if entry['next_attempt'] > now:
+                continue
+            with self._lock:
+                self._in_flight.add( dir_entry.name )
+            entries.put( entry )
+
+        if pending != self._pending.value:
+            self.logger.info( '%d uploads pending', pending )
+        self._pending.value = pending
+
+    def run_worker( self, entries : queue.Queue ):
+
+        while True:
+            entry = entries.get()
+            if None is entry:
+                break
+
+            try:
+                self.upload_entry( entry )
+            except Exception as exc: # pylint: disable=broad-except
+                # Retry anything, not just network errors, so one bad entry
+                # can't take this worker down with it.
+                if not isinstance( exc, OSError ):
+                    self.logger.exception( exc )
+                try:
+                    self.retry( entry, exc )
+                except Exception as retry_exc: # pylint: disable=broad-except
+                    self.logger.error( 'could not reschedule upload %s: %s',
+                        entry.get( 'id' ), retry_exc )
+
+            finally:
+                with self._lock:
+                    self._in_flight.discard( entry['id'] + '.json' )
+
+    def upload_entry( self, entry ):
+
+        # Import here to avoid a circular import.
+        from doorbot.capturers import CaptureWriter
+
+        # Upload with the options of the capturer that queued the file.
+        # Entries from before these were stored fall back to ours.
+        options = entry['options'] if 'options' in entry else self.kwargs
+
+        data_path = os.path.join( self.spool_path, entry['data'] )
+        writer = CaptureWriter( 'upload', entry['timestamp'], 0, 0,
+            **dict( options, path=entry['path'],
+                tsformat=entry['tsformat'] ) )
+
+        start = time.perf_counter()
+        sent = writer.upload( data_path, entry['filename'], resume=True )
+        elapsed = time.perf_counter() - start
+        with self._bytes_sent.get_lock():
+            self._bytes_sent.value += sent
+        os.unlink( data_path )
+        os.unlink( os.path.join( self.spool_path, entry['id'] + '.json' ) )
+        self.set_upload_status( entry, 'uploaded' )
+        self.logger.info(
+            'uploaded %s (%d bytes at %.1f KB/s, %d pending)',
+            entry['filename'], sent,
+            sent / 1024 / max( elapsed, 0.001 ), self.depth - 1 )
+
+    def retry( self, entry, exc ):
+
+        entry['attempts'] += 1
+        data_path = os.path.join( self.spool_path, entry['data'] )
+
+        if entry['attempts'] >= self.retries and entry.get( 'backuppath' ):
+            backup_filepath = os.path.join(
+                entry['backuppath'], entry['filename'] )
+            self.logger.error(
+                'upload of %s failed %d times: %s; moving to %s...',
+                entry['filename'], entry['attempts'], exc, backup_filepath )
+            try:
+                shutil.move( data_path, backup_filepath )
+                os.unlink(
+                    os.path.join( self.spool_path, entry['id'] + '.json' ) )
+                self.set_upload_status( entry, 'backup', backup_filepath )
+                return
+            except OSError as move_exc:
+                self.logger.error( 'could not move %s to %s: %s',
+                    data_path, backup_filepath, move_exc )
+
+        delay = min( self.retry_max,
+            self.retry_base * (2 ** (entry['attempts'] - 1)) )
+        entry['next_attempt'] = time.time() + delay
+        self.logger.warning(
+            'upload of %s failed (attempt %d): %s; retrying in %.1fs...',
+            entry['filename'], entry['attempts'], exc, delay )
+        write_entry( self.spool_path, entry )
+
+    def set_upload_status( self, entry, upload_status, new_path=None ):
+        if entry.get( 'clipindex' ):
+            get_clip_index( entry['clipindex'] ).set_upload_status(
+                entry['artefact'], upload_status, new_path )
+
+    def stop( self, timeout=None ):
+
+        ''' Stop once in-flight uploads finish. Anything else stays in the
+        journal for next time. '''
+
+        self._stopped.set()
+        self.join( timeout )
+
+upload_queue = None # pylint: disable=invalid-name
+
+def get_upload_queue( **kwargs ):
+
+    ''' Return the upload queue for this process, starting it with the given
+    capturer configuration if it isn't running yet. '''
+
+    global upload_queue # pylint: disable=global-statement, invalid-name
+    if None == upload_queue:
+        upload_queue = UploadQueue( **kwargs )
+        upload_queue.start()
+    return upload_queue
+
+def shutdown_upload_queue( timeout=None ):
+    global upload_queue # pylint: disable=global-statement, invalid-name
+    if None != upload_queue:
+        upload_queue.stop( timeout )
+        upload_queue = None
@@ -1,7 +1,12 @@
 
 import os
 import logging
+import shutil
+import subprocess
+import tempfile
+import time
 from tempfile import TemporaryDirectory
+from threading import Thread
 
 import numpy
 
@@ -11,7 +16,87 @@ except ImportError:
     import cv2
 
 from doorbot.portability import is_frame
-from doorbot.capturers import Capture, CaptureWriter
+from doorbot.capturers import Capture, CaptureWriter, FrameRing
+from doorbot.capturers.segments import SegmentIndex
+from doorbot.storage import SpoolingStream, get_storage
+
+class FFmpegVideoWriter( object ):
+
+    ''' Drop-in for cv2.VideoWriter that pipes raw BGR frames into an ffmpeg
+    subprocess encoding H.264 with libx264. If output is given instead of a
+    filepath, the video is written to it as it is encoded, as fragmented
+    MP4 that needs no seeking back. '''
+
+    def __init__( self, filepath, fps, size, preset='veryfast', crf=23,
+        threads=0, ffmpeg='ffmpeg', output=None ):
+
+        self.logger = logging.getLogger( 'capture.video.ffmpeg' )
+
+        self.size = size
+        self.output = output
+        self.output_thread = None
+
+        if None != output:
+            destination = ['-movflags',
+                'frag_keyframe+empty_moov+default_base_moof', '-f', 'mp4',
+                'pipe:1']
+        else:
+            destination = [filepath]
+
+        self.process = subprocess.Popen( [
+            ffmpeg, '-hide_banner', '-loglevel', 'error', '-y',
+            '-f', 'rawvideo', '-pix_fmt', 'bgr24',
+            '-s', '{}x{}'.format( *size ), '-r', str( fps ),
+            '-i', '-',
+            '-an', '-c:v', 'libx264', '-preset', preset, '-crf', str( crf ),
+            '-threads', str( threads ), '-pix_fmt', 'yuv420p'] + destination,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE if None != output else None )
+
+        if None != output:
+            # Drain ffmpeg's output as it comes, or it would block.
+            self.output_thread = Thread(
+                target=self.copy_output, args=(self.process.stdout,) )
+            self.output_thread.start()
+
+    def copy_output( self, stdout ):
+        while True:
+            data = stdout.read1( 65536 )
+            if not data:
+                break
+            try:
+                self.output.write( data )
+            except Exception as exc: # pylint: disable=broad-except
+                self.logger.exception( exc )
+        stdout.close()
+
+    def isOpened( self ): # pylint: disable=invalid-name
+        return None != self.process and None == self.process.poll()
+
+    def write( self, frame : numpy.ndarray ):
+        if not self.isOpened():
+            return
+        try:
+            self.process.stdin.write(
+                numpy.ascontiguousarray( frame ).data )
+        except BrokenPipeError:
+            self.logger.error( 'ffmpeg exited with code %s',
+                self.process.poll() )
+
+    def release( self ):
+        if None == self.process:
+            return
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        if None != self.output_thread:
+            self.output_thread.join()
+            self.output_thread = None
+        code = self.process.wait()
+        if 0 != code:
+            self.logger.error( 'ffmpeg exited with code %d', code )
+        self.process = None
 
 class VideoCaptureWriter( CaptureWriter ):
     def __init__( self, instance_name, timestamp, width, height, **kwargs ):
@@ -19,50 +104,216 @@ class VideoCaptureWriter( CaptureWriter ):
 
         self.logger = logging.getLogger('capture.video.{}'.format( instance_name ) )
 
-        self.fps = float( kwargs['fps'] ) if 'fps' in kwargs else 15.0
+        self.fps = float( kwargs['capturefps'] ) if 'capturefps' in kwargs \
+            else float( kwargs['fps'] ) if 'fps' in kwargs else 15.0
         self.fourcc = kwargs['fourcc'] if 'fourcc' in kwargs else 'mp4v'
         self.container = kwargs['container'] if 'container' in kwargs else 'mp4'
+        self.kind = 'segment' if 'continuous' in kwargs and \
+            'true' == kwargs['continuous'] else 'video'
 
-        self.logger.debug( 'creating video writer for %s.mp4...',
-            os.path.join( self.path, self.timestamp ) )
+        self.encoder_type = kwargs['encoder'] if 'encoder' in kwargs \
+            else 'opencv'
+        self.preset = kwargs['preset'] if 'preset' in kwargs else 'veryfast'
+        self.crf = int( kwargs['crf'] ) if 'crf' in kwargs else 23
+        self.ffmpeg_threads = int( kwargs['ffmpegthreads'] ) \
+            if 'ffmpegthreads' in kwargs else 0
 
-    def start( self ):
+        # In streaming mode, each frame is encoded as soon as it arrives
+        # instead of being buffered until the capture ends. Continuous
+        # segments always stream, as a whole segment could be a lot of frames
+        # to hold in memory.
+        self.streaming = True if ('streaming' in kwargs and \
+            'true' == kwargs['streaming']) or 'segment' == self.kind else False
+        # Contact sheet of sheetframes evenly spaced thumbnails, sampled as
+        # frames are encoded. Thumbnails are kept at every thumb_stride-th
+        # frame, and every other one is dropped (doubling the stride) when
+        # there are twice as many as needed, so the number of frames needn't
+        # be known up front.
+        self.sheet_frames = int( kwargs['sheetframes'] ) \
+            if 'sheetframes' in kwargs else 0
+        self.sheet_columns = int( kwargs['sheetcolumns'] ) \
+            if 'sheetcolumns' in kwargs else self.sheet_frames
+        self.sheet_width = int( kwargs['sheetwidth'] ) \
+            if 'sheetwidth' in kwargs else 160
+        self.sheet_quality = int( kwargs['sheetquality'] ) \
+            if 'sheetquality' in kwargs else 80
+        self.thumbs = []
+        self.thumb_stride = 1
+        self.frames_written = 0
 
-        # This will run in its own process. The queue is used to pass frames
-        # in.
+        # Stream the ffmpeg encoder's output straight to remote storage,
+        # rather than encoding to a temporary file to upload afterwards.
+        self.remote_stream = True if 'remotestream' in kwargs and \
+            'true' == kwargs['remotestream'] else False
+        self.stream_backlog = int( kwargs['streambacklog'] ) \
+            if 'streambacklog' in kwargs else 4 * 1024 * 1024
+        self.sink = None
 
-        temp_dir = TemporaryDirectory()
+        self.encoder = None
+        self.temp_dir = None
+        self.filename = '{}.{}'.format( self.timestamp, self.container )
+        self.filepath = None
+
+        self.logger.debug( 'creating video writer for %s.mp4...',
+            os.path.join( self.path, self.timestamp ) )
+
+    def open_encoder( self ):
 
         # Determine path for saved video/temporary video.
-        filename = '{}.{}'.format( self.timestamp, self.container )
-        filepath = filename
-        if self.path.startswith( 'ftp:' ) or self.path.startswith( 'ftps:' ):
-            filepath = os.path.join( temp_dir.name, filename )
+        if self.storage.remote:
+            self.temp_dir = TemporaryDirectory()
+            self.filepath = os.path.join( self.temp_dir.name, self.filename )
         else:
-            filepath = os.path.join( self.path, filename )
+            self.filepath = os.path.join( self.path, self.filename )
+
+        self.logger.info( 'encoding %s (%s, %d fps)...', self.filepath,
+            'streaming' if self.streaming else \
+                '{} frames'.format( len( self.frame_array ) ),
+            self.fps )
 
-        self.logger.info( 'encoding %s (%d frames, %d fps)...',
-            filepath, len( self.frame_array ), self.fps )
+        if 'ffmpeg' == self.encoder_type:
+            ffmpeg = shutil.which( 'ffmpeg' )
+            if ffmpeg:
+                if self.remote_stream and self.storage.remote:
+                    # The temporary file is only written if streaming fails.
+                    self.sink = SpoolingStream( self.storage,
+                        self.remote_path( self.filename ), self.filepath,
+                        self.stream_backlog )
+                self.encoder = FFmpegVideoWriter(
+                    self.filepath, self.fps, (self.width, self.height),
+                    self.preset, self.crf, self.ffmpeg_threads, ffmpeg,
+                    self.sink )
+                return
+            self.logger.warning( 'ffmpeg not found; falling back to opencv' )
+            self.encoder_type = 'opencv'
+
+        if self.remote_stream and self.storage.remote:
+            self.logger.warning( 'remotestream needs the ffmpeg encoder; '
+                'encoding to a temporary file' )
 
-        # Encode the video file.
         fourcc = cv2.VideoWriter_fourcc( *(self.fourcc) )
-        encoder = \
+        self.encoder = \
             cv2.VideoWriter(
-                filepath, fourcc, self.fps, (self.width, self.height) )
+                self.filepath, fourcc, self.fps, (self.width, self.height) )
+
+    def write_frame( self, frame ):
+        self.logger.debug( 'writing frame %dx%d to video %dx%d...',
+            frame.shape[1], frame.shape[0], self.width, self.height )
+        assert( self.width == frame.shape[1] )
+        assert( self.height == frame.shape[0] )
+        self.encoder.write( frame )
+
+        if 0 < self.sheet_frames:
+            self.sample_thumb( frame )
+        self.frames_written += 1
+
+    def sample_thumb( self, frame ):
+        if 0 != self.frames_written % self.thumb_stride:
+            return
+        self.thumbs.append( cv2.resize( frame, (self.sheet_width,
+            max( 1, round( self.height * self.sheet_width / self.width ) )),
+            interpolation=cv2.INTER_AREA ) )
+        if len( self.thumbs ) >= 2 * self.sheet_frames:
+            self.thumbs = self.thumbs[::2]
+            self.thumb_stride *= 2
+
+    def write_sheet( self, dir_path ):
+
+        ''' Tile the sampled thumbnails into a JPEG in dir_path, and return
+        its filename, or None if there is nothing to tile. '''
+
+        if not self.thumbs:
+            return None
+
+        picks = numpy.linspace( 0, len( self.thumbs ) - 1,
+            min( self.sheet_frames, len( self.thumbs ) ) ).round().astype( int )
+        thumbs = [self.thumbs[i] for i in picks]
+        self.thumbs = []
+
+        # Fill out the last row with blank tiles.
+        columns = min( self.sheet_columns, len( thumbs ) )
+        thumbs += [numpy.zeros_like( thumbs[0] )] * (-len( thumbs ) % columns)
+        sheet = numpy.vstack( [numpy.hstack( thumbs[i:i + columns] ) \
+            for i in range( 0, len( thumbs ), columns )] )
+
+        filename = '{}.sheet.jpg'.format( self.timestamp )
+        cv2.imwrite( os.path.join( dir_path, filename ), sheet,
+            [cv2.IMWRITE_JPEG_QUALITY, self.sheet_quality] )
+        return filename
+
+    def add_frame( self, frame ):
+        if not self.streaming:
+            super().add_frame( frame )
+            return
+
+        if None == self.encoder:
+            self.open_encoder()
+        self.write_frame( frame )
+        self.frames_added += 1
+
+    def start( self ):
+
+        # This will run in its own process. The queue is used to pass frames
+        # in.
+
+        if None == self.encoder:
+            if self.streaming:
+                # No frames were ever written.
+                return
+            self.open_encoder()
+
+        # Encode any buffered frames, popping them off the end in order to
+        # free each once it's written.
+        self.frame_array.reverse()
         while 0 < len( self.frame_array ):
-            frame = self.frame_array.pop()
-            self.logger.debug( 'writing frame %dx%d to video %dx%d...',
-                frame.shape[1], frame.shape[0], self.width, self.height )
-            assert( self.width == frame.shape[1] )
-            assert( self.height == frame.shape[0] )
-            encoder.write( frame )
-        encoder.release()
+            self.write_frame( self.unbuffer( self.frame_array.pop() ) )
+        self.encoder.release()
+        self.encoder = None
+        self.log_buffer_stats()
+
+        duration = self.frames_added / self.fps
 
         # Try to upload file if remote path specified.
-        if self.path.startswith( 'ftp:' ) or self.path.startswith( 'ftps:' ):
-            self.upload_ftp_or_backup( filepath, filename, temp_dir )
+        if self.storage.remote:
+            sheet_dir = TemporaryDirectory()
+            sheet_filename = self.write_sheet( sheet_dir.name )
+            if sheet_filename:
+                self.upload_or_backup(
+                    os.path.join( sheet_dir.name, sheet_filename ),
+                    sheet_filename, sheet_dir, 'sheet', duration )
+            else:
+                sheet_dir.cleanup()
+            if None != self.sink:
+                self.finish_stream( duration )
+            else:
+                self.upload_or_backup( self.filepath, self.filename,
+                    self.temp_dir, self.kind, duration )
+        else:
+            sheet_filename = self.write_sheet( self.path )
+            if sheet_filename:
+                sheet_path = os.path.join( self.path, sheet_filename )
+                self.record_artefact( sheet_path, 'sheet', duration,
+                    os.path.getsize( sheet_path ), 'local' )
+            self.record_artefact( self.filepath, self.kind, duration,
+                os.path.getsize( self.filepath ), 'local' )
+
+        self.logger.info( 'encoding %s completed', self.filename )
 
-        self.logger.info( 'encoding %s completed', filename )
+    def finish_stream( self, duration ):
+
+        self.sink.close()
+
+        if self.sink.spooled:
+            # Upload what was spooled the usual way.
+            self.upload_or_backup( self.filepath, self.filename,
+                self.temp_dir, self.kind, duration )
+        else:
+            self.record_artefact( self.storage_url( self.filename ),
+                self.kind, duration, self.sink.bytes_written,
+                'failed' if self.sink.failed else 'uploaded' )
+            self.temp_dir.cleanup()
+
+        self.sink = None
 
 class VideoCapture( Capture ):
 
@@ -80,28 +331,137 @@ class VideoCapture( Capture ):
             if 'graceframes' in kwargs else 10
         self.grace_remaining = 0
 
+        preroll_frames = int( kwargs['prerollframes'] ) \
+            if 'prerollframes' in kwargs else 0
+        if 0 < preroll_frames:
+            self.preroll = FrameRing( instance_name, preroll_frames,
+                kwargs['prerollformat'] if 'prerollformat' in kwargs else 'raw',
+                kwargs['prerollquality'] if 'prerollquality' in kwargs else None )
+
+        # Streaming writers and the encoder pool are done with each frame as
+        # soon as they're handed it, so pre-roll frames needn't be copied out
+        # of the ring for them.
+        self.streaming = True if 'streaming' in kwargs and \
+            'true' == kwargs['streaming'] else False
+
+        # In continuous mode every frame is recorded, into segments of
+        # segmentlength seconds.
+        self.continuous = True if 'continuous' in kwargs and \
+            'true' == kwargs['continuous'] else False
+        self.segment_length = float( kwargs['segmentlength'] ) \
+            if 'segmentlength' in kwargs else 60.0
+        self.segment_start = None
+        self.segments = None
+        self.motion_active = False
+        if self.continuous:
+            container = kwargs['container'] if 'container' in kwargs else 'mp4'
+            self.segment_filename = lambda ts: '{}.{}'.format( ts, container )
+            path = kwargs['path'] if 'path' in kwargs else '/tmp'
+            if get_storage( path, **kwargs ).remote:
+                path = tempfile.gettempdir()
+            self.segments = SegmentIndex( kwargs['segmentindex'] \
+                if 'segmentindex' in kwargs else os.path.join(
+                    path, '{}.segments'.format( instance_name ) ) )
+
     def create_or_append_to_writer( self, frame ):
         if None == self.writer:
             self.grace_remaining = self.grace_frames
+
+            # Start the capture with the frames from before the motion.
+            if None != self.preroll:
+                for preroll_frame in self.preroll.drain(
+                    copy=not self.multiproc and not self.streaming ):
+                    super().create_or_append_to_writer(
+                        preroll_frame, VideoCaptureWriter )
+                    self.frames_count += 1
         else:
             self.grace_remaining -= 1
         super().create_or_append_to_writer( frame, VideoCaptureWriter )
         self.frames_count += 1
 
+    def record_segment_frame( self, frame : numpy.ndarray ):
+
+        ''' Add a frame to the current segment. Cameras only hand over decoded
+        frames, so every frame is encoded again here. '''
+
+        now = time.time()
+
+        # Roll over on the frame that crosses the boundary, so each segment
+        # ends where the next begins.
+        if None != self.writer and \
+        now - self.segment_start >= self.segment_length:
+            self.segments.end( now )
+            self.frames_count = 0
+            self.writer.start()
+            self.writer = None
+
+        if None == self.writer:
+            self.segment_start = now
+            super().create_or_append_to_writer( frame, VideoCaptureWriter )
+            self.segments.begin(
+                now, self.segment_filename( self.writer_timestamp ) )
+        else:
+            super().create_or_append_to_writer( frame, VideoCaptureWriter )
+        self.frames_count += 1
+
+        return now
+
+    def handle_idle_frame( self, frame, prepare=None ):
+
+        if not self.continuous:
+            super().handle_idle_frame( frame, prepare )
+            return
+
+        if not self.take_frame():
+            return
+
+        frame = frame.copy()
+        if prepare:
+            prepare( frame )
+        if None != self.capture_size:
+            frame = self.copy_frame( frame )
+        self.record_segment_frame( frame )
+
     def handle_motion_frame( self, frame : numpy.ndarray ):
 
+        # Drop frames over capturefps before they're copied.
+        if is_frame( frame ) and not self.take_frame():
+            return
+
+        if self.continuous:
+            if not is_frame( frame ):
+                self.motion_active = False
+                return
+            now = self.record_segment_frame( self.copy_frame( frame ) )
+            if not self.motion_active:
+                # Note where in the recording each motion event starts.
+                self.motion_active = True
+                self.segments.add_event( now )
+                self.logger.info( 'motion in %s at %.1fs',
+                    *self.segments.locate( now ) )
+            return
+
         if self.frames_count >= self.max_frames:
             # Finalize motion to break up video into chunks.
             self.grace_remaining = 0
             self.finalize_motion( frame )
         elif is_frame( frame ):
-            self.create_or_append_to_writer( frame.copy() )
+            self.create_or_append_to_writer( self.copy_frame( frame ) )
         else:
             self.finalize_motion( frame )
 
     def finalize_motion( self, frame : numpy.ndarray ):
+        if self.continuous:
+            # Close off the current segment.
+            if None != self.writer:
+                self.segments.end( time.time() )
+                self.frames_count = 0
+                self.writer.start()
+                self.writer = None
+            return
+
         if None == self.writer and isinstance( frame, numpy.ndarray ):
-            self.create_or_append_to_writer( frame.copy() )
+            self.create_or_append_to_writer( self.copy_frame( frame ) )
 
         # Ship the frames off to a separate thread to write out.
         if 0 < self.frames_count:
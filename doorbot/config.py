@@ -29,9 +29,13 @@ class DoorbotConfig( object ):
             'detectors': {},
             'overlays': {},
             'capturers': {},
-            'notifiers': {}
+            'notifiers': {},
+            'index': {}
         }
 
+        if self.parser.has_section( 'index' ):
+            self._config['index'] = dict( self.parser.items( 'index' ) )
+
         for section_name in self.parser.sections():
             if section_name.startswith( 'instance.' ):
                 continue
@@ -46,7 +50,11 @@ class DoorbotConfig( object ):
 
                 assert( '.' not in instance )
 
-                item_config = dict( self.parser.items( 'instance.{}.{}'.format(
+                # Options in the plugin's own stanza are defaults for all of
+                # its instances.
+                item_config = {k: v for k, v in \
+                    self.parser.items( section_name ) if 'instances' != k}
+                item_config.update( self.parser.items( 'instance.{}.{}'.format(
                     section_name, instance ) ) )
 
                 # Apply any applicable overrides.
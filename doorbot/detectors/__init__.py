@@ -26,6 +26,7 @@ class Detector( object ):
 
         self.camera_key = kwargs['camera']
         self.instance_name = instance_name
+        self.kwargs = kwargs
 
     def detect( self, frame ):
 
@@ -35,17 +35,43 @@ class MotionDetector( Detector ):
         self.threshold = \
             int( kwargs['threshold'] ) if 'threshold' in kwargs else 127
 
+        self.history = int( kwargs['history'] ) if 'history' in kwargs else 150
+        self.var_threshold = int( kwargs['varthreshold'] ) \
+            if 'varthreshold' in kwargs else 25
+
         # Setup OpenCV stuff.
-        self.back_sub = cv2.createBackgroundSubtractorMOG2(
-            history=int( kwargs['history'] ) if 'history' in kwargs else 150,
-            varThreshold=int( kwargs['varthreshold'] ) \
-                if 'varthreshold' in kwargs else 25,
-            detectShadows=True )
+        self.back_sub = self.create_back_sub()
         self.kernel = numpy.ones( (20, 20), numpy.uint8 )
 
         self.logger.debug( 'threshold: %d', self.threshold )
         self.logger.debug( 'blur: %d', self.blur )
 
+        # In pyramid mode, the whole frame is checked at a reduced scale and
+        # only areas of interest are checked at full resolution.
+        self.pyramid = True if 'pyramid' in kwargs and \
+            'true' == kwargs['pyramid'] else False
+        self.pyramid_scale = float( kwargs['pyramidscale'] ) \
+            if 'pyramidscale' in kwargs else 0.25
+        self.refine_threshold = int( kwargs['refinethreshold'] ) \
+            if 'refinethreshold' in kwargs else 25
+        self.far_zones = [tuple( int( x ) for x in zone.split( ',' ) ) \
+            for zone in kwargs['farzones'].split( ';' ) if zone.strip()] \
+            if 'farzones' in kwargs else []
+        coarse_kernel = max( 3, int( 20 * self.pyramid_scale ) )
+        self.coarse_kernel = numpy.ones( (coarse_kernel, coarse_kernel), numpy.uint8 )
+        self.zone_back_subs = [self.create_back_sub() for z in self.far_zones] \
+            if self.pyramid else []
+        self._last_gray = None
+
+        if self.pyramid:
+            self.logger.debug( 'pyramid scale: %f, far zones: %s',
+                self.pyramid_scale, self.far_zones )
+
+    def create_back_sub( self ):
+        return cv2.createBackgroundSubtractorMOG2(
+            history=self.history, varThreshold=self.var_threshold,
+            detectShadows=True )
+
     def handle_movement( self, frame : numpy.ndarray, rect_x, rect_y, rect_w, rect_h ):
 
         ''' Motion frames were found. '''
@@ -73,11 +99,14 @@ class MotionDetector( Detector ):
             return DetectionEvent(
                 'movement', (rect_w, rect_h), (rect_x, rect_y), frame )
 
-    def detect( self, frame : numpy.ndarray ):
+    def find_motion( self, back_sub, frame : numpy.ndarray, kernel ):
+
+        ''' Update the given background model with the frame and return the
+        bounding rectangle of the largest moving area, if any. '''
 
         # Convert to foreground mask, close gaps, remove noise.
-        fg_mask = self.back_sub.apply( frame )
-        fg_mask = cv2.morphologyEx( fg_mask, cv2.MORPH_CLOSE, self.kernel )
+        fg_mask = back_sub.apply( frame )
+        fg_mask = cv2.morphologyEx( fg_mask, cv2.MORPH_CLOSE, kernel )
         fg_mask = cv2.medianBlur( fg_mask, self.blur )
 
         # Flatten mask to B&W.
@@ -94,9 +123,77 @@ class MotionDetector( Detector ):
             max_idx = numpy.argmax( areas )
 
             cnt_iter = contours[max_idx]
-            rect_x, rect_y, rect_w, rect_h = cv2.boundingRect( cnt_iter )
+            return cv2.boundingRect( cnt_iter )
+
+        return None
+
+    def refine( self, gray : numpy.ndarray, rect ):
+
+        ''' Tighten a rectangle scaled up from the coarse pass to the pixels
+        that changed since the last frame at full resolution. This is a plain
+        frame difference over the rectangle, not a second background model
+        pass, so it is cheap but also picks up noise and lighting changes
+        there. '''
+
+        if None is self._last_gray or self._last_gray.shape != gray.shape:
+            return rect
+
+        margin = int( 1 / self.pyramid_scale )
+        x1 = max( 0, rect[0] - margin )
+        y1 = max( 0, rect[1] - margin )
+        x2 = min( gray.shape[1], rect[0] + rect[2] + margin )
+        y2 = min( gray.shape[0], rect[1] + rect[3] + margin )
+
+        diff = cv2.absdiff( gray[y1:y2, x1:x2], self._last_gray[y1:y2, x1:x2] )
+        ret, diff = cv2.threshold(
+            diff, self.refine_threshold, 255, cv2.THRESH_BINARY )
+        changed = cv2.findNonZero( diff )
+        if None is changed:
+            return rect
+
+        rect_x, rect_y, rect_w, rect_h = cv2.boundingRect( changed )
+        return (x1 + rect_x, y1 + rect_y, rect_w, rect_h)
+
+    def find_motion_pyramid( self, frame : numpy.ndarray ):
+
+        rects = []
+
+        # Coarse pass over the whole frame.
+        coarse = cv2.resize( frame, None,
+            fx=self.pyramid_scale, fy=self.pyramid_scale,
+            interpolation=cv2.INTER_AREA )
+        gray = cv2.cvtColor( frame, cv2.COLOR_BGR2GRAY )
+        rect = self.find_motion( self.back_sub, coarse, self.coarse_kernel )
+        if rect:
+            rect = tuple( int( round( x / self.pyramid_scale ) ) for x in rect )
+            rects.append( self.refine( gray, rect ) )
+        self._last_gray = gray
+
+        # Full resolution passes over zones where subjects are small. These
+        # run on every frame, whatever the coarse pass found.
+        for zone, back_sub in zip( self.far_zones, self.zone_back_subs ):
+            zone_x, zone_y, zone_w, zone_h = zone
+            rect = self.find_motion( back_sub,
+                frame[zone_y:zone_y + zone_h, zone_x:zone_x + zone_w],
+                self.kernel )
+            if rect:
+                rects.append( (zone_x + rect[0], zone_y + rect[1],
+                    rect[2], rect[3]) )
+
+        if not rects:
+            return None
+
+        return max( rects, key=lambda r: r[2] * r[3] )
+
+    def detect( self, frame : numpy.ndarray ):
+
+        if self.pyramid:
+            rect = self.find_motion_pyramid( frame )
+        else:
+            rect = self.find_motion( self.back_sub, frame, self.kernel )
 
-            return self.handle_movement( frame, rect_x, rect_y, rect_w, rect_h )
+        if rect:
+            return self.handle_movement( frame, *rect )
 
         return None
 
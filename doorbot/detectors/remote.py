@@ -0,0 +1,327 @@
+
+import argparse
+import json
+import logging
+import socket
+import struct
+import threading
+import time
+from importlib import import_module
+from socketserver import BaseRequestHandler, TCPServer, ThreadingMixIn
+
+import numpy
+try:
+    from cv2 import cv2
+except ImportError:
+    import cv2
+
+from doorbot.detectors import Detector, DetectionEvent
+from doorbot.portability import image_to_jpeg
+
+# Every message is a header of type, sequence number and payload length,
+# followed by the payload.
+HEADER = struct.Struct( '!BII' )
+RAW_HEADER = struct.Struct( '!HHB' )
+
+MSG_HELLO = 1
+MSG_FRAME_JPEG = 2
+MSG_FRAME_RAW = 3
+MSG_EVENT = 4
+MSG_NONE = 5
+
+# Options consumed by the remote detector itself and not passed on.
+REMOTE_OPTIONS = ['workers', 'detector', 'encoding', 'quality', 'window',
+    'wait', 'retry', 'enable', 'module', 'type']
+
+def recv_exactly( sock : socket.socket, size ):
+    buf = bytearray( size )
+    view = memoryview( buf )
+    received = 0
+    while received < size:
+        count = sock.recv_into( view[received:] )
+        if not count:
+            raise ConnectionError( 'connection closed' )
+        received += count
+    return buf
+
+def send_message( sock : socket.socket, msg_type, seq, payload=b'' ):
+    sock.sendall( HEADER.pack( msg_type, seq, len( payload ) ) + payload )
+
+def recv_message( sock : socket.socket ):
+    msg_type, seq, length = HEADER.unpack( recv_exactly( sock, HEADER.size ) )
+    payload = recv_exactly( sock, length ) if length else b''
+    return msg_type, seq, payload
+
+def encode_frame( frame : numpy.ndarray, encoding, quality ):
+    if 'raw' == encoding:
+        channels = frame.shape[2] if 3 == len( frame.shape ) else 1
+        return MSG_FRAME_RAW, RAW_HEADER.pack(
+            frame.shape[0], frame.shape[1], channels ) + frame.tobytes()
+    return MSG_FRAME_JPEG, image_to_jpeg( frame, quality )
+
+def decode_frame( msg_type, payload ):
+    if MSG_FRAME_RAW == msg_type:
+        height, width, channels = RAW_HEADER.unpack_from( payload )
+        frame = numpy.frombuffer(
+            payload, dtype=numpy.uint8, offset=RAW_HEADER.size )
+        return frame.reshape( (height, width, channels) )
+    return cv2.imdecode(
+        numpy.frombuffer( payload, dtype=numpy.uint8 ), cv2.IMREAD_COLOR )
+
+class WorkerPool( object ):
+
+    ''' Tracks which workers each remote detector stream is assigned to, so
+    that new streams go to the worker with the fewest. Workers that fail are
+    skipped until their retry delay has passed. '''
+
+    def __init__( self ):
+        self._lock = threading.Lock()
+        self._streams = {}
+        self._failed = {}
+
+    def assign( self, workers ):
+        with self._lock:
+            now = time.time()
+            available = [w for w in workers \
+                if self._failed.get( w, 0 ) <= now]
+            if not available:
+                return None
+            worker = min( available, key=lambda w: self._streams.get( w, 0 ) )
+            self._streams[worker] = self._streams.get( worker, 0 ) + 1
+            return worker
+
+    def release( self, worker, failed=False, retry=5.0 ):
+        with self._lock:
+            self._streams[worker] = max( 0, self._streams.get( worker, 0 ) - 1 )
+            if failed:
+                self._failed[worker] = time.time() + retry
+
+worker_pool = WorkerPool() # pylint: disable=invalid-name
+
+class RemoteDetector( Detector ):
+
+    ''' Ships frames to a detection worker and returns the events it sends
+    back. Results arrive asynchronously, so detect() returns the newest
+    result received since the last call. Frames are dropped rather than
+    queued when the worker already has window frames in flight. '''
+
+    def __init__( self, instance_name, **kwargs ):
+
+        super().__init__( instance_name, **kwargs )
+
+        self.logger = logging.getLogger(
+            'detector.remote.{}'.format( instance_name ) )
+
+        self.workers = [tuple( w.strip().rsplit( ':', 1 ) ) \
+            for w in kwargs['workers'].split( ',' )]
+        self.workers = [(host, int( port )) for host, port in self.workers]
+        self.detector_module = kwargs['detector'] \
+            if 'detector' in kwargs else 'doorbot.detectors.motion'
+        self.encoding = kwargs['encoding'] if 'encoding' in kwargs else 'jpeg'
+        self.quality = int( kwargs['quality'] ) if 'quality' in kwargs else 90
+        self.window = int( kwargs['window'] ) if 'window' in kwargs else 2
+        self.wait = float( kwargs['wait'] ) if 'wait' in kwargs else 0.0
+        self.retry = float( kwargs['retry'] ) if 'retry' in kwargs else 5.0
+
+        self.detector_kwargs = {k: v for k, v in kwargs.items() \
+            if k not in REMOTE_OPTIONS and isinstance( v, str )}
+
+        self.worker = None
+        self._sock = None
+        self._seq = 0
+        self._in_flight = {}
+        self._result = None
+        self._result_ready = threading.Condition()
+        self.dropped_frames = 0
+
+    def connect( self ):
+        worker = worker_pool.assign( self.workers )
+        if not worker:
+            return False
+
+        try:
+            sock = socket.create_connection( worker, timeout=self.retry )
+            sock.settimeout( None )
+            sock.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
+            send_message( sock, MSG_HELLO, 0, json.dumps( {
+                'detector': self.detector_module,
+                'instance': self.instance_name,
+                'kwargs': self.detector_kwargs } ).encode( 'utf-8' ) )
+        except OSError as exc:
+            self.logger.error( 'could not connect to worker %s:%d: %s',
+                worker[0], worker[1], exc )
+            worker_pool.release( worker, failed=True, retry=self.retry )
+            return False
+
+        self.logger.info( 'connected to worker %s:%d', *worker )
+        self.worker = worker
+        self._sock = sock
+        self._in_flight = {}
+        threading.Thread( target=self.receive, args=(sock,), daemon=True ).start()
+        return True
+
+    def disconnect( self, failed=False ):
+        with self._result_ready:
+            if not self._sock:
+                return
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+            self._in_flight = {}
+            worker_pool.release( self.worker, failed=failed, retry=self.retry )
+            self._result_ready.notify_all()
+
+    def receive( self, sock : socket.socket ):
+        try:
+            while True:
+                msg_type, seq, payload = recv_message( sock )
+                with self._result_ready:
+                    frame = self._in_flight.pop( seq, None )
+                    if MSG_EVENT == msg_type:
+                        event = json.loads( payload.decode( 'utf-8' ) )
+                        self._result = (seq, DetectionEvent(
+                            event['event_type'],
+                            tuple( event['dimensions'] ),
+                            tuple( event['position'] ), frame ))
+                    elif None == self._result or None == self._result[1]:
+                        # Don't lose movement detect() hasn't seen yet.
+                        self._result = (seq, None)
+                    self._result_ready.notify_all()
+        except (OSError, ValueError) as exc:
+            if sock is self._sock:
+                self.logger.error( 'lost connection to worker: %s', exc )
+                self.disconnect( failed=True )
+
+    def detect( self, frame : numpy.ndarray ):
+
+        if not self._sock and not self.connect():
+            return None
+
+        with self._result_ready:
+            if len( self._in_flight ) >= self.window:
+                # Backpressure: the worker is behind, so skip this frame.
+                self.dropped_frames += 1
+                seq = None
+            else:
+                self._seq = (self._seq + 1) & 0xffffffff
+                seq = self._seq
+                self._in_flight[seq] = frame
+
+        if None != seq:
+            msg_type, payload = encode_frame( frame, self.encoding, self.quality )
+            try:
+                send_message( self._sock, msg_type, seq, payload )
+            except (OSError, AttributeError) as exc:
+                self.logger.error( 'could not send frame to worker: %s', exc )
+                self.disconnect( failed=True )
+                return None
+
+        with self._result_ready:
+            if None != seq and 0 < self.wait:
+                self._result_ready.wait_for(
+                    lambda: seq not in self._in_flight, self.wait )
+            result = self._result
+            self._result = None
+
+        return result[1] if result else None
+
+class DetectionWorkerHandler( BaseRequestHandler ):
+
+    ''' Serves a single remote detector stream, running its frames through a
+    local detector built from the configuration sent on connect. '''
+
+    def handle( self ):
+
+        self.request.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
+
+        try:
+            msg_type, seq, payload = recv_message( self.request )
+            if MSG_HELLO != msg_type:
+                raise ValueError( 'expected hello, got {}'.format( msg_type ) )
+            hello = json.loads( payload.decode( 'utf-8' ) )
+            detector = self.server.create_detector( **hello )
+
+            while self.server.running:
+                msg_type, seq, payload = recv_message( self.request )
+                event = detector.detect( decode_frame( msg_type, payload ) )
+                if event:
+                    send_message( self.request, MSG_EVENT, seq, json.dumps( {
+                        'event_type': event.event_type,
+                        'dimensions': [int( x ) for x in event.dimensions],
+                        'position': [int( x ) for x in event.position]
+                    } ).encode( 'utf-8' ) )
+                else:
+                    send_message( self.request, MSG_NONE, seq )
+
+        except ConnectionError:
+            self.server.logger.info( 'client %s disconnected',
+                self.client_address[0] )
+        except (OSError, ValueError, ImportError, KeyError) as exc:
+            self.server.logger.error( 'client %s: %s',
+                self.client_address[0], exc )
+
+class DetectionWorker( ThreadingMixIn, TCPServer ):
+
+    ''' Runs detectors on behalf of remote detectors, one thread per
+    connected stream. '''
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__( self, *args, **kwargs ):
+        super().__init__( *args, **kwargs )
+
+        self.logger = logging.getLogger( 'detector.worker' )
+        self.running = True
+
+    def create_detector( self, detector, instance, kwargs ):
+
+        # Only build detectors shipped with doorbot.
+        if not detector.startswith( 'doorbot.detectors.' ) or \
+        __name__ == detector:
+            raise ValueError( 'invalid detector: {}'.format( detector ) )
+
+        self.logger.info( 'starting %s for %s (camera %s)',
+            detector, instance, kwargs['camera'] )
+        return import_module( detector ).PLUGIN_CLASS( instance, **kwargs )
+
+    def stop( self ):
+        self.running = False
+        self.shutdown()
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        'doorbot-worker', description='remote detection worker' )
+
+    parser.add_argument(
+        '-l', '--listen', action='store', default='0.0.0.0',
+        help='address to listen on' )
+
+    parser.add_argument(
+        '-p', '--port', action='store', type=int, default=8889,
+        help='port to listen on' )
+
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='show debug messages on stdout' )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO )
+
+    server = DetectionWorker( (args.listen, args.port), DetectionWorkerHandler )
+    server.logger.info( 'listening on %s:%d...', args.listen, args.port )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.logger.info( 'quitting on ctrl-c' )
+
+PLUGIN_TYPE = 'detectors'
+PLUGIN_CLASS = RemoteDetector
+
+if '__main__' == __name__:
+    main()
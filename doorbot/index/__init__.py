@@ -0,0 +1,237 @@
+
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from urllib.request import pathname2url
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS events (
+        uid TEXT PRIMARY KEY,
+        camera TEXT NOT NULL,
+        ts REAL NOT NULL,
+        x INTEGER, y INTEGER, w INTEGER, h INTEGER,
+        event_type TEXT )''',
+    '''CREATE INDEX IF NOT EXISTS events_camera_ts ON events ( camera, ts )''',
+    '''CREATE INDEX IF NOT EXISTS events_ts ON events ( ts )''',
+    '''CREATE TABLE IF NOT EXISTS artefacts (
+        path TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        camera TEXT,
+        ts REAL NOT NULL,
+        duration REAL,
+        size INTEGER,
+        upload_status TEXT,
+        event_uid TEXT )''',
+    '''CREATE INDEX IF NOT EXISTS artefacts_camera_ts ON artefacts ( camera, ts )''',
+    '''CREATE INDEX IF NOT EXISTS artefacts_ts ON artefacts ( ts )''',
+    '''CREATE INDEX IF NOT EXISTS artefacts_event ON artefacts ( event_uid )''']
+
+COLUMNS = {
+    'events': ('uid', 'camera', 'ts', 'x', 'y', 'w', 'h', 'event_type'),
+    'artefacts': ('path', 'kind', 'camera', 'ts', 'duration', 'size',
+        'upload_status', 'event_uid') }
+
+INSERT_EVENT = '''INSERT OR REPLACE INTO events
+    ( uid, camera, ts, x, y, w, h, event_type )
+    VALUES ( ?, ?, ?, ?, ?, ?, ?, ? )'''
+
+INSERT_ARTEFACT = '''INSERT OR REPLACE INTO artefacts
+    ( path, kind, camera, ts, duration, size, upload_status, event_uid )
+    VALUES ( ?, ?, ?, ?, ?, ?, ?, ? )'''
+
+DELETE_ARTEFACT = '''DELETE FROM artefacts WHERE path = ?'''
+
+UPDATE_STATUS = '''UPDATE artefacts SET upload_status = ?,
+    path = COALESCE( ?, path ) WHERE path = ?'''
+
+class ClipIndex( object ):
+
+    ''' SQLite database of detection events and the files captured for
+    them. Writes are queued and committed in batches from a background
+    thread, so recording them never waits on the disk. The database is in
+    WAL mode so that any number of processes can write to it while it is
+    being queried.
+
+    With read_only, an existing index is opened for queries only. It is
+    never created, and sqlite3.Error is raised if it isn't there. '''
+
+    def __init__( self, db_path, batch_size=100, flush_interval=0.5,
+        read_only=False ):
+
+        self.logger = logging.getLogger( 'index' )
+
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.read_only = read_only
+        self.pid = os.getpid()
+
+        if read_only:
+            self._queue = None
+            self._thread = None
+            conn = self.connect()
+            try:
+                # Fail now on something that isn't an index.
+                conn.execute( 'SELECT 1 FROM events LIMIT 1' )
+            finally:
+                conn.close()
+            return
+
+        conn = self.connect()
+        try:
+            with conn:
+                for statement in SCHEMA:
+                    conn.execute( statement )
+        finally:
+            conn.close()
+
+        self._queue = queue.Queue()
+        self._thread = threading.Thread( target=self.run, daemon=True )
+        self._thread.start()
+
+    def connect( self ) -> sqlite3.Connection:
+        if self.read_only:
+            conn = sqlite3.connect( 'file:{}?mode=ro'.format(
+                pathname2url( os.path.abspath( self.db_path ) ) ),
+                timeout=30, uri=True )
+            conn.row_factory = sqlite3.Row
+            return conn
+        conn = sqlite3.connect( self.db_path, timeout=30 )
+        conn.execute( 'PRAGMA journal_mode=WAL' )
+        conn.execute( 'PRAGMA synchronous=NORMAL' )
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def run( self ):
+
+        conn = self.connect()
+        running = True
+
+        while running:
+            batch = [self._queue.get()]
+            try:
+                while len( batch ) < self.batch_size and \
+                not (None is batch[-1] or isinstance( batch[-1], threading.Event )):
+                    batch.append( self._queue.get( timeout=self.flush_interval ) )
+            except queue.Empty:
+                pass
+
+            # Group consecutive rows for the same statement so each group is
+            # a single executemany().
+            flushed = []
+            groups = []
+            for item in batch:
+                if None is item:
+                    running = False
+                elif isinstance( item, threading.Event ):
+                    flushed.append( item )
+                elif groups and groups[-1][0] == item[0]:
+                    groups[-1][1].append( item[1] )
+                else:
+                    groups.append( (item[0], [item[1]]) )
+
+            try:
+                with conn:
+                    for statement, rows in groups:
+                        conn.executemany( statement, rows )
+            except sqlite3.Error as exc:
+                self.logger.error( 'could not write %d rows to %s: %s',
+                    sum( len( g[1] ) for g in groups ), self.db_path, exc )
+
+            for event in flushed:
+                event.set()
+
+        conn.close()
+
+    def add_event( self, uid, camera, timestamp, position, dimensions,
+        event_type ):
+
+        self._queue.put( (INSERT_EVENT, (uid, camera, timestamp,
+            int( position[0] ), int( position[1] ),
+            int( dimensions[0] ), int( dimensions[1] ), event_type)) )
+
+    def add_artefact( self, path, kind, camera, timestamp, duration=None,
+        size=None, upload_status=None, event_uid=None ):
+
+        self._queue.put( (INSERT_ARTEFACT, (path, kind, camera, timestamp,
+            duration, size, upload_status, event_uid)) )
+
+    def set_upload_status( self, path, upload_status, new_path=None ):
+
+        ''' Update the upload status of an artefact, and its path if it was
+        moved. '''
+
+        self._queue.put( (UPDATE_STATUS, (upload_status, new_path, path)) )
+
+    def remove_artefacts( self, paths ):
+        for path in paths:
+            self._queue.put( (DELETE_ARTEFACT, (path,)) )
+
+    def flush( self, timeout=None ):
+
+        ''' Wait until everything queued so far has been committed. '''
+
+        event = threading.Event()
+        self._queue.put( event )
+        return event.wait( timeout )
+
+    def close( self, timeout=None ):
+        if self.read_only:
+            return
+        self._queue.put( None )
+        self._thread.join( timeout )
+
+    def query( self, table, camera=None, start=None, end=None, **columns ):
+
+        ''' Return rows from events or artefacts for the given camera and
+        time range, oldest first. Other columns are matched exactly. '''
+
+        assert table in ('events', 'artefacts')
+
+        clauses = []
+        params = []
+        if None != camera:
+            clauses.append( 'camera = ?' )
+            params.append( camera )
+        if None != start:
+            clauses.append( 'ts >= ?' )
+            params.append( start )
+        if None != end:
+            clauses.append( 'ts < ?' )
+            params.append( end )
+        for column in sorted( columns ):
+            assert column in COLUMNS[table]
+            clauses.append( '{} = ?'.format( column ) )
+            params.append( columns[column] )
+
+        sql = 'SELECT * FROM {}'.format( table )
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join( clauses )
+        sql += ' ORDER BY ts'
+
+        conn = self.connect()
+        try:
+            return [dict( row ) for row in conn.execute( sql, params )]
+        finally:
+            conn.close()
+
+clip_index = None # pylint: disable=invalid-name
+
+def get_clip_index( db_path ):
+
+    ''' Return the clip index for this process. A clip index inherited from
+    a parent process is replaced, as its thread doesn't come along. '''
+
+    global clip_index # pylint: disable=global-statement, invalid-name
+    if None == clip_index or os.getpid() != clip_index.pid or \
+    db_path != clip_index.db_path:
+        clip_index = ClipIndex( db_path )
+    return clip_index
+
+def close_clip_index( timeout=None ):
+    global clip_index # pylint: disable=global-statement, invalid-name
+    if None != clip_index and os.getpid() == clip_index.pid:
+        clip_index.close( timeout )
+    clip_index = None
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import argparse
+import sqlite3
+from datetime import datetime
+
+from doorbot.index import ClipIndex
+
+TIME_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d']
+
+def parse_time( value ):
+    for time_format in TIME_FORMATS:
+        try:
+            return datetime.strptime( value, time_format ).timestamp()
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError( 'invalid time: {}'.format( value ) )
+
+def format_time( timestamp ):
+    return datetime.fromtimestamp( timestamp ).strftime( '%Y-%m-%d %H:%M:%S' )
+
+def list_events( index : ClipIndex, args ):
+    events = index.query( 'events', args.camera, args.start, args.end )
+    for event in events:
+        clips = index.query( 'artefacts', event_uid=event['uid'] )
+        print( '{} {:<12} {:<10} {}x{} at {},{} {}'.format(
+            format_time( event['ts'] ), event['camera'], event['event_type'],
+            event['w'], event['h'], event['x'], event['y'], event['uid'] ) )
+        for clip in clips:
+            print( '    {:<8} {}'.format( clip['kind'], clip['path'] ) )
+
+def list_clips( index : ClipIndex, args ):
+    columns = {'kind': args.kind} if args.kind else {}
+    for clip in index.query( 'artefacts', args.camera, args.start, args.end,
+        **columns ):
+        print( '{} {:<12} {:<8} {:>8} {:>10} {:<9} {}'.format(
+            format_time( clip['ts'] ), clip['camera'] or '-', clip['kind'],
+            '{:.1f}s'.format( clip['duration'] ) \
+                if None != clip['duration'] else '-',
+            clip['size'] if None != clip['size'] else '-',
+            clip['upload_status'] or '-', clip['path'] ) )
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        'doorbot.index', description='search the event and clip index' )
+
+    parser.add_argument(
+        '-d', '--database', action='store', required=True,
+        help='path to the index database' )
+
+    parser.add_argument(
+        '-c', '--camera', action='store', default=None,
+        help='only show this camera' )
+
+    parser.add_argument(
+        '-s', '--start', action='store', type=parse_time, default=None,
+        help='only show from this time (YYYY-MM-DD[ HH:MM[:SS]])' )
+
+    parser.add_argument(
+        '-e', '--end', action='store', type=parse_time, default=None,
+        help='only show until this time (YYYY-MM-DD[ HH:MM[:SS]])' )
+
+    subparsers = parser.add_subparsers( dest='table' )
+    subparsers.required = True
+
+    events_parser = subparsers.add_parser(
+        'events', help='detection events and the clips captured for them' )
+    events_parser.set_defaults( func=list_events )
+
+    clips_parser = subparsers.add_parser(
+        'clips', help='captured files' )
+    clips_parser.add_argument(
+        '-k', '--kind', action='store', default=None,
+        help='only show this kind of file (video, photo, segment)' )
+    clips_parser.set_defaults( func=list_clips )
+
+    args = parser.parse_args()
+
+    try:
+        index = ClipIndex( args.database, read_only=True )
+    except sqlite3.Error as exc:
+        parser.error( 'cannot open index {}: {}'.format( args.database, exc ) )
+    args.func( index, args )
+    index.close()
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,164 @@
+
+import logging
+import os
+import threading
+import time
+
+SIZE_SUFFIXES = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+
+def parse_size( size ):
+
+    ''' Parse a size such as "500G" into bytes. '''
+
+    size = size.strip().lower().rstrip( 'b' )
+    if size and size[-1] in SIZE_SUFFIXES:
+        return int( float( size[:-1] ) * SIZE_SUFFIXES[size[-1]] )
+    return int( size )
+
+def get_quotas( capturer_configs ):
+
+    ''' Collect the retaindays and retainsize options of the given capturer
+    configurations into per-camera (max age in seconds, max bytes) quotas.
+    Where several capturers on one camera set the same quota, the strictest
+    wins. '''
+
+    quotas = {}
+    for capturer_cfg in capturer_configs:
+        camera_key = capturer_cfg['camera']
+        max_age, max_bytes = quotas.get( camera_key, (None, None) )
+        if 'retaindays' in capturer_cfg:
+            age = float( capturer_cfg['retaindays'] ) * 86400
+            max_age = age if None == max_age else min( max_age, age )
+        if 'retainsize' in capturer_cfg:
+            size = parse_size( capturer_cfg['retainsize'] )
+            max_bytes = size if None == max_bytes else min( max_bytes, size )
+        if None != max_age or None != max_bytes:
+            quotas[camera_key] = (max_age, max_bytes)
+    return quotas
+
+class RetentionSweeper( threading.Thread ):
+
+    ''' Deletes the oldest local files recorded in the clip index for each
+    camera once they pass its age quota, or while the camera's files add up
+    to more than its byte quota. Nothing on disk is walked or stat()ed: the
+    index has every file's time and size. Deletions are spread out to
+    retainrate per second so the sweep never competes with capture writes
+    for the disk. '''
+
+    def __init__( self, clip_index, quotas, **kwargs ):
+        super().__init__()
+        self.daemon = True
+
+        self.logger = logging.getLogger( 'index.retention' )
+
+        self.clip_index = clip_index
+        self.quotas = quotas
+
+        self.interval = float( kwargs['retaininterval'] ) \
+            if 'retaininterval' in kwargs else 300.0
+        self.rate = float( kwargs['retainrate'] ) \
+            if 'retainrate' in kwargs else 20.0
+        self.batch_size = int( kwargs['retainbatch'] ) \
+            if 'retainbatch' in kwargs else 100
+
+        self.deleted_files = 0
+        self.deleted_bytes = 0
+
+        self._stopped = threading.Event()
+
+    def run( self ):
+
+        self.logger.info( 'enforcing retention for %d cameras every %ds',
+            len( self.quotas ), self.interval )
+
+        while not self._stopped.is_set():
+            try:
+                self.sweep()
+            except Exception as exc: # pylint: disable=broad-except
+                self.logger.exception( exc )
+            self._stopped.wait( self.interval )
+
+    def sweep( self ):
+
+        ''' Run one pass over every camera with a quota. '''
+
+        for camera_key, (max_age, max_bytes) in self.quotas.items():
+            if None != max_age:
+                self.sweep_age( camera_key, time.time() - max_age )
+            if None != max_bytes:
+                self.sweep_bytes( camera_key, max_bytes )
+
+    def sweep_age( self, camera_key, cutoff ):
+        while not self._stopped.is_set():
+            expired = self.query(
+                '''SELECT path, size FROM artefacts
+                WHERE camera = ? AND ts < ? AND path NOT LIKE '%://%'
+                ORDER BY ts LIMIT ?''',
+                (camera_key, cutoff, self.batch_size) )
+            if not expired:
+                return
+            self.logger.info( 'deleting %d files for camera %s older than %s',
+                len( expired ), camera_key, time.ctime( cutoff ) )
+            self.delete( expired )
+
+    def sweep_bytes( self, camera_key, max_bytes ):
+
+        total = self.query(
+            '''SELECT COALESCE( SUM( size ), 0 ) FROM artefacts
+            WHERE camera = ? AND path NOT LIKE '%://%' ''',
+            (camera_key,) )[0][0]
+
+        while total > max_bytes and not self._stopped.is_set():
+
+            # Take just enough of the oldest files to get under the quota.
+            excess = total - max_bytes
+            oldest = []
+            for path, size in self.query(
+                '''SELECT path, size FROM artefacts
+                WHERE camera = ? AND path NOT LIKE '%://%'
+                ORDER BY ts LIMIT ?''',
+                (camera_key, self.batch_size) ):
+                oldest.append( (path, size) )
+                excess -= size or 0
+                if 0 >= excess:
+                    break
+            if not oldest:
+                return
+
+            self.logger.info(
+                'deleting %d files for camera %s over quota by %d bytes',
+                len( oldest ), camera_key, total - max_bytes )
+            self.delete( oldest )
+            total -= sum( size or 0 for path, size in oldest )
+
+    def query( self, sql, params ):
+        conn = self.clip_index.connect()
+        try:
+            return [tuple( row ) for row in conn.execute( sql, params )]
+        finally:
+            conn.close()
+
+    def delete( self, artefacts ):
+
+        removed = []
+        for path, size in artefacts:
+            if self._stopped.is_set():
+                break
+            try:
+                os.unlink( path )
+                self.deleted_bytes += size or 0
+            except FileNotFoundError:
+                pass
+            except OSError as exc:
+                # Drop it from the index anyway, so the sweep can move on.
+                self.logger.error( 'could not delete %s: %s', path, exc )
+            removed.append( path )
+            self.deleted_files += 1
+            self._stopped.wait( 1.0 / self.rate )
+
+        self.clip_index.remove_artefacts( removed )
+        self.clip_index.flush()
+
+    def stop( self, timeout=None ):
+        self._stopped.set()
+        self.join( timeout )
@@ -1,37 +1,221 @@
 
 import logging
 import multiprocessing
+import os
 import threading
-from queue import Full
+from queue import Empty, Full
 from contextlib import contextmanager
+from uuid import uuid4
 
+import numpy
 try:
     from cv2 import cv2
 except ImportError:
     import cv2
 
 from ..util import FPSTimer, FrameLock
+from ..portability import apply_thread_budget, shared_memory
+
+try:
+    from multiprocessing import resource_tracker
+except ImportError:
+    resource_tracker = None # pylint: disable=invalid-name
+
+class SharedFrame( object ):
+
+    ''' Latest-frame slot shared between the process setting frames and the
+    process using them, without pickling. Frames are copied into one of two
+    shared memory slots, each with its own lock: the writer never waits for
+    readers, taking whichever slot is free and dropping the frame if a
+    reader is somehow holding both. Readers get a view of the newest slot,
+    so they see the newest frame and make no copies of their own. A
+    sequence number counts the frames set, and wait() blocks until there's
+    a new one. Must be created before the reading process is started. '''
+
+    SLOTS = 2
+    META = 5 # generation, ndim, shape[0..2]
+
+    def __init__( self ):
+
+        self.logger = logging.getLogger( 'observer.sharedframe' )
+
+        self.name = 'doorbot_{}'.format( uuid4().hex[:12] )
+        self._owner_pid = None
+
+        self._cond = multiprocessing.Condition()
+        self._seq = multiprocessing.Value( 'Q', 0, lock=False )
+        self._latest = multiprocessing.Value( 'i', 0, lock=False )
+        self._slot_locks = [multiprocessing.Lock() for i in range( self.SLOTS )]
+        self._slot_seqs = multiprocessing.Array( 'Q', self.SLOTS, lock=False )
+        self._slot_meta = multiprocessing.Array(
+            'q', self.SLOTS * self.META, lock=False )
+
+        # Each side keeps its own handles on the slots, by slot generation.
+        self._shms = [None] * self.SLOTS
+        self._gens = [0] * self.SLOTS
+
+        if resource_tracker:
+            # Share the tracker with the reader so attaching to a slot there
+            # doesn't get it cleaned up when the reader exits.
+            resource_tracker.ensure_running()
+
+    def __getstate__( self ):
+        # Slot handles are per process; the other side attaches its own.
+        state = self.__dict__.copy()
+        state['_shms'] = [None] * self.SLOTS
+        state['_gens'] = [0] * self.SLOTS
+        return state
+
+    @property
+    def seq( self ):
+        return self._seq.value
+
+    def _shm_name( self, slot, gen ):
+        return '{}_{}_{}'.format( self.name, slot, gen )
+
+    def set_frame( self, frame : numpy.ndarray ):
+
+        ''' Copy a frame into a free slot and publish it. Returns False if
+        the frame was dropped. '''
+
+        # Prefer the slot readers aren't on, so they can carry on.
+        slot = None
+        for candidate in (1 - self._latest.value, self._latest.value):
+            if self._slot_locks[candidate].acquire( False ):
+                slot = candidate
+                break
+        if None == slot:
+            return False
+
+        try:
+            meta = self._slot_meta[slot * self.META:(slot + 1) * self.META]
+            shape = tuple( frame.shape ) + (0,) * (3 - frame.ndim)
+            if None == self._shms[slot] or \
+            self._shms[slot].size < frame.nbytes or \
+            (frame.ndim, shape) != (meta[1], tuple( meta[2:] )):
+                self._alloc( slot, frame )
+            view = numpy.ndarray( frame.shape, dtype=numpy.uint8,
+                buffer=self._shms[slot].buf )
+            numpy.copyto( view, frame )
+            del view
+            self._slot_seqs[slot] = self._seq.value + 1
+        finally:
+            self._slot_locks[slot].release()
+
+        with self._cond:
+            self._seq.value += 1
+            self._latest.value = slot
+            self._cond.notify_all()
+
+        return True
+
+    def _alloc( self, slot, frame ):
+
+        if None != self._shms[slot]:
+            # The reader reattaches when it sees the new generation.
+            self._shms[slot].close()
+            self._shms[slot].unlink()
+
+        self._owner_pid = os.getpid()
+        gen = self._gens[slot] + 1
+        self._shms[slot] = shared_memory.SharedMemory(
+            name=self._shm_name( slot, gen ), create=True, size=frame.nbytes )
+        self._gens[slot] = gen
+        self._slot_meta[slot * self.META:(slot + 1) * self.META] = \
+            [gen, frame.ndim] + list( frame.shape ) + [0] * (3 - frame.ndim)
+        self.logger.info( 'allocated frame slot %d: %s (%d bytes)',
+            slot, frame.shape, frame.nbytes )
+
+    def wait( self, last_seq=0, timeout=None ):
+
+        ''' Block until there is a frame newer than last_seq, or timeout
+        seconds pass. Returns the newest sequence number. '''
+
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self._seq.value != last_seq, timeout )
+            return self._seq.value
+
+    @contextmanager
+    def get_frame_seq( self ):
+
+        ''' Yield the sequence number of the newest frame and a view of it,
+        which may only be used inside the context. Anything needed after
+        should be copied. '''
+
+        slot = self._latest.value
+        with self._slot_locks[slot]:
+            meta = self._slot_meta[slot * self.META:(slot + 1) * self.META]
+            if 0 == meta[0]:
+                yield 0, None
+                return
+            if meta[0] != self._gens[slot]:
+                if None != self._shms[slot]:
+                    self._shms[slot].close()
+                self._shms[slot] = shared_memory.SharedMemory(
+                    name=self._shm_name( slot, meta[0] ) )
+                self._gens[slot] = meta[0]
+            view = numpy.ndarray( tuple( meta[2:2 + meta[1]] ),
+                dtype=numpy.uint8, buffer=self._shms[slot].buf )
+            try:
+                yield self._slot_seqs[slot], view
+            finally:
+                del view
+
+    @contextmanager
+    def get_frame( self ):
+        with self.get_frame_seq() as (seq, frame): # pylint: disable=unused-variable
+            yield frame
+
+    def close( self ):
+
+        ''' Release the slots, and remove them if this is the process that
+        set frames. '''
+
+        for slot, shm in enumerate( self._shms ):
+            if None == shm:
+                continue
+            shm.close()
+            self._shms[slot] = None
+            if os.getpid() == self._owner_pid:
+                try:
+                    shm.unlink()
+                except FileNotFoundError:
+                    pass
 
 class ObserverProc( multiprocessing.Process ):
 
     def __init__( self, instance_name, **kwargs ):
         super().__init__()
         self.daemon = True
-        self._frame = FrameLock()
         self.timer = FPSTimer( self, **kwargs )
         self._running = True
         self._frame_update_thread : threading.Thread
         self.logger = logging.getLogger( 'observer.{}'.format( instance_name ) )
-        self._frame_queue = multiprocessing.Queue(
-            maxsize=int( kwargs['queuesize'] ) \
-                if 'queuesize' in kwargs else 20 )
         self.camera_key = kwargs['camera']
         self.instance_name = instance_name
 
+        # Frames are passed to the subprocess through shared memory or, where
+        # that's not available, pickled through a queue.
+        self._shared = None
+        self._frame = None
+        self._frame_queue = None
+        if shared_memory:
+            self._shared = SharedFrame()
+        else:
+            self._frame = FrameLock()
+            self._frame_queue = multiprocessing.Queue(
+                maxsize=int( kwargs['queuesize'] ) \
+                    if 'queuesize' in kwargs else 20 )
+        self._frame_seq = 0
+        self._frame_cond = None
+
         # These are only defined for the subprocess, as they are only usable
         # on the other side of the queue.
         self.get_frame = None
+        self.get_frame_seq = None
         self.frame_ready = None
+        self.wait_frame = None
 
         # Save these to pass to overlays, later.
         self.kwargs = kwargs
@@ -41,7 +225,10 @@ class ObserverProc( multiprocessing.Process ):
         return self._running
 
     def set_frame( self, value ):
-        #self._frame.set_frame( value )
+        if None != self._shared:
+            if not self._shared.set_frame( value ):
+                self.logger.debug( 'frame slots busy; skipping...' )
+            return
         try:
             self._frame_queue.put_nowait( value )
         except Full:
@@ -55,27 +242,57 @@ class ObserverProc( multiprocessing.Process ):
 
     def run( self ):
 
-        def frame_update():
-            while self._running:
-                frame = None
-                found_frame = False
-                while not self._frame_queue.empty():
-                    frame = self._frame_queue.get()
-                    found_frame = True
-                if found_frame:
-                    self._frame.set_frame( frame )
+        apply_thread_budget( **self.kwargs )
 
         # These handlers are needed to "wrap" camera inside process.
-        self.get_frame = lambda: self._frame.get_frame() #pylint: disable=unnecessary-lambda
-        self.frame_ready = lambda: self._frame.frame_ready
-
-        self._frame_update_thread = threading.Thread( target=frame_update, daemon=True )
-        self._frame_update_thread.start()
+        if None != self._shared:
+            self.get_frame = self._shared.get_frame
+            self.get_frame_seq = self._shared.get_frame_seq
+            self.frame_ready = lambda: 0 < self._shared.seq
+            self.wait_frame = self._shared.wait
+        else:
+            self._frame_cond = threading.Condition()
+            self.get_frame = lambda: self._frame.get_frame() #pylint: disable=unnecessary-lambda
+            self.get_frame_seq = self.get_queued_frame_seq
+            self.frame_ready = lambda: self._frame.frame_ready
+            self.wait_frame = self.wait_queued_frame
+            self._frame_update_thread = threading.Thread(
+                target=self.update_queued_frame, daemon=True )
+            self._frame_update_thread.start()
 
         try:
             self.loop()
         except Exception as exc: #pylint: disable=broad-except
             self.logger.exception( exc )
 
+    def update_queued_frame( self ):
+        while self._running:
+            # Skip to the newest frame waiting.
+            frame = self._frame_queue.get()
+            try:
+                while True:
+                    frame = self._frame_queue.get_nowait()
+            except Empty:
+                pass
+            self._frame.set_frame( frame )
+            with self._frame_cond:
+                self._frame_seq += 1
+                self._frame_cond.notify_all()
+
+    def wait_queued_frame( self, last_seq=0, timeout=None ):
+        with self._frame_cond:
+            self._frame_cond.wait_for(
+                lambda: self._frame_seq != last_seq, timeout )
+            return self._frame_seq
+
+    @contextmanager
+    def get_queued_frame_seq( self ):
+        with self._frame_cond:
+            seq = self._frame_seq
+        with self._frame.get_frame() as frame:
+            yield seq, frame
+
     def stop( self ):
         self._running = False
+        if None != self._shared:
+            self._shared.close()
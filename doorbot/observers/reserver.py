@@ -1,56 +1,141 @@
 
+import asyncio
 import logging
 import threading
+from collections import OrderedDict
+from http import HTTPStatus
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+from uuid import uuid4
+
+try:
+    from cv2 import cv2
+except ImportError:
+    import cv2
 
 from doorbot.portability import image_to_jpeg
 from doorbot.observers import ObserverProc
 from doorbot.util import FPSTimer
 
+def parse_variant( query ):
+
+    ''' Return the width, quality and fps asked for in a request query
+    string, each None if not given. Raises ValueError if they're bad. '''
+
+    params = parse_qs( query )
+
+    width = int( params['width'][0] ) if 'width' in params else None
+    if None != width and 16 > width:
+        raise ValueError( 'width too small: {}'.format( width ) )
+
+    quality = int( params['quality'][0] ) if 'quality' in params else None
+    if None != quality and not 1 <= quality <= 100:
+        raise ValueError( 'quality out of range: {}'.format( quality ) )
+
+    fps = float( params['fps'][0] ) if 'fps' in params else None
+    if None != fps and 0 >= fps:
+        raise ValueError( 'fps out of range: {}'.format( fps ) )
+
+    return width, quality, fps
+
+def etag_matches( if_none_match, etag ):
+
+    ''' Return True if the given If-None-Match header lists etag. '''
+
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split( ',' ):
+        tag = tag.strip()
+        if tag.startswith( 'W/' ):
+            tag = tag[2:]
+        if '*' == tag or etag == tag:
+            return True
+    return False
+
+class JPEGVariant( object ):
+
+    ''' The latest frame encoded at one size and quality. '''
+
+    def __init__( self ):
+        self.lock = threading.Lock()
+        self.seq = None
+        self.jpg = None
+
 class ReserverHandler( BaseHTTPRequestHandler ):
 
+    # Keep connections open for clients polling for snapshots.
+    protocol_version = 'HTTP/1.1'
+
+    def send_empty( self, code ):
+        self.send_response( code )
+        self.send_header( 'Content-length', 0 )
+        self.end_headers()
+
     def do_GET( self ): # pylint: disable=invalid-name
 
         self.server.logger.debug( 'connection from %s...', self.address_string() )
 
-        if self.path.endswith( '.jpg' ) or \
-        self.path.endswith( '.jpeg' ):
-            return self.serve_jpeg()
-        elif self.path.endswith( '.mjpg' ) or \
-        self.path.endswith( '.mjpeg' ):
-            return self.serve_mjpeg()
+        parsed = urlparse( self.path )
+        try:
+            width, quality, fps = parse_variant( parsed.query )
+        except ValueError as exc:
+            self.server.logger.warning( 'bad request from %s: %s',
+                self.address_string(), exc )
+            self.send_empty( 400 )
+            return
+
+        if parsed.path.endswith( '.jpg' ) or \
+        parsed.path.endswith( '.jpeg' ):
+            return self.serve_jpeg( width, quality )
+        elif parsed.path.endswith( '.mjpg' ) or \
+        parsed.path.endswith( '.mjpeg' ):
+            return self.serve_mjpeg( width, quality, fps )
+        self.send_empty( 404 )
 
     def log_message( self, format, *args ): # pylint: disable=redefined-builtin
         return
 
-    def serve_jpeg( self ):
+    def serve_jpeg( self, width=None, quality=None ):
 
-        if not self.server.proc.frame_ready:
+        if not self.server.proc.frame_ready():
             self.server.logger.error( 'frame not ready' )
-            self.send_response( 500 )
+            self.send_empty( 500 )
             return
 
-        jpg = None
-        with self.server.proc.get_frame() as orig_frame:
-            jpg = image_to_jpeg( orig_frame )
+        seq, jpg = self.server.proc.get_jpeg_seq(
+            width, quality, self.headers.get( 'If-None-Match' ) )
+        etag = self.server.proc.etag( seq, width, quality )
+
+        if None == jpg:
+            # The client already has this frame.
+            self.send_response( 304 )
+            self.send_header( 'ETag', etag )
+            self.send_header( 'Cache-Control', 'no-cache' )
+            self.end_headers()
+            return
 
         self.send_response( 200 )
         self.send_header( 'Content-type', 'image/jpeg' )
         self.send_header( 'Content-length', len( jpg ) )
+        self.send_header( 'ETag', etag )
+        self.send_header( 'Cache-Control', 'no-cache' )
         self.end_headers()
 
         self.wfile.write( jpg )
 
-    def serve_mjpeg( self ):
+    def serve_mjpeg( self, width=None, quality=None, fps=None ):
 
         # Crude mjpeg server.
 
+        # The stream has no length, so it ends with the connection.
+        self.close_connection = True
         self.send_response( 200 )
         self.send_header(
             'Content-type',
             'multipart/x-mixed-replace; boundary=--jpgboundary'
         )
+        self.send_header( 'Connection', 'close' )
         self.end_headers()
 
         client_addr = self.client_address[0]
@@ -63,6 +148,10 @@ class ReserverHandler( BaseHTTPRequestHandler ):
         timer_kwargs = {}
         if self.server.fps:
             timer_kwargs['fps'] = self.server.fps
+        if fps:
+            # Clients may slow their stream down, but not speed it up.
+            timer_kwargs['fps'] = min( fps, self.server.fps ) \
+                if self.server.fps else fps
 
         timer = FPSTimer( self, **timer_kwargs )
         while self.server.proc.running:
@@ -74,8 +163,7 @@ class ReserverHandler( BaseHTTPRequestHandler ):
                 timer.loop_timer_end()
                 continue
 
-            with self.server.proc.get_frame() as orig_frame:
-                jpg = image_to_jpeg( orig_frame )
+            jpg = self.server.proc.get_jpeg( width, quality )
 
             try:
                 self.wfile.write( '--jpgboundary'.encode( 'utf-8' ) )
@@ -102,6 +190,261 @@ class Reserver( ThreadingMixIn, HTTPServer ):
 
         self.proc = thread
 
+class StreamClient( object ):
+
+    ''' An MJPEG client of the asyncio server. It only ever holds the newest
+    frame offered to it, so a client that can't keep up skips frames rather
+    than queueing them. '''
+
+    def __init__( self, writer : asyncio.StreamWriter, width=None,
+        quality=None, fps=None ):
+        self.writer = writer
+        self.variant = (width, quality)
+        self.interval = 1.0 / fps if fps else 0
+        self.ready = asyncio.Event()
+        self.dropped = 0
+        self._jpg = None
+        self._next_frame = 0
+
+    def offer( self, jpg, now ):
+        if now < self._next_frame:
+            # Not due yet at the fps this client asked for.
+            return
+        self._next_frame = now + self.interval
+        if None != self._jpg:
+            self.dropped += 1
+        self._jpg = jpg
+        self.ready.set()
+
+    def take( self ):
+        jpg = self._jpg
+        self._jpg = None
+        self.ready.clear()
+        return jpg
+
+class AsyncReserver( object ):
+
+    ''' This serves the same as Reserver, but from one event loop. A single
+    task waits for new frames and hands each one to every stream client,
+    instead of each client polling from its own thread. Sticks to asyncio
+    as it was in Python 3.6. '''
+
+    # Don't let more than this pile up unsent in a client's socket buffer.
+    WRITE_BUFFER_HIGH = 64 * 1024
+
+    def __init__( self, proc, instance_name, fps ):
+        self.logger = logging.getLogger(
+            'observer.reserver.{}'.format( instance_name ) )
+        self.fps = fps
+        self.proc = proc
+        self.clients = set()
+        self.port = None
+        self._have_clients : asyncio.Event
+        # Open connections, and futures set as each one's handler ends.
+        self._writers = set()
+        self._handlers = set()
+
+    async def serve( self, hostname, port ):
+
+        self._have_clients = asyncio.Event()
+
+        server = await asyncio.start_server(
+            self.handle_client, hostname, port )
+        self.port = server.sockets[0].getsockname()[1]
+
+        try:
+            await self.broadcast()
+        finally:
+            server.close()
+            await server.wait_closed()
+
+            # Hang up on everyone and let their handlers finish.
+            for writer in list( self._writers ):
+                writer.close()
+            for client in list( self.clients ):
+                client.ready.set()
+            if self._handlers:
+                await asyncio.wait( list( self._handlers ), timeout=1.0 )
+
+    async def broadcast( self ):
+
+        loop = asyncio.get_event_loop()
+        interval = 1.0 / self.fps if self.fps else 0
+        last_seq = 0
+
+        while self.proc.running:
+            if not self.clients:
+                # Don't bother encoding for nobody.
+                try:
+                    await asyncio.wait_for( self._have_clients.wait(), 1.0 )
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            start = loop.time()
+            seq = await loop.run_in_executor(
+                None, self.proc.wait_frame, last_seq, 1.0 )
+            if seq == last_seq:
+                continue
+            last_seq = seq
+
+            # Encode each variant the clients want once, for all of them.
+            jpgs = {}
+            for variant in set( client.variant for client in self.clients ):
+                jpgs[variant] = await loop.run_in_executor(
+                    None, self.proc.get_jpeg, *variant )
+            now = loop.time()
+            for client in list( self.clients ):
+                if client.variant in jpgs:
+                    client.offer( jpgs[client.variant], now )
+
+            # Limit the stream to the configured fps.
+            remaining = interval - (loop.time() - start)
+            if 0 < remaining:
+                await asyncio.sleep( remaining )
+
+    async def handle_client(
+        self, reader : asyncio.StreamReader, writer : asyncio.StreamWriter ):
+
+        client_addr = writer.get_extra_info( 'peername' )[0]
+        self.logger.debug( 'connection from %s...', client_addr )
+
+        handled = asyncio.get_event_loop().create_future()
+        self._handlers.add( handled )
+        self._writers.add( writer )
+
+        try:
+            # Keep serving requests for as long as the client keeps the
+            # connection alive.
+            keep_alive = True
+            while keep_alive and self.proc.running:
+                request = (await reader.readline()).decode( 'latin-1' ).split()
+                if not request:
+                    break
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode( 'latin-1' )
+                    if not line.strip():
+                        break
+                    key, _, value = line.partition( ':' )
+                    headers[key.strip().lower()] = value.strip()
+
+                connection = headers.get( 'connection', '' ).lower()
+                keep_alive = 'keep-alive' == connection or \
+                    ('close' != connection and 2 < len( request ) and \
+                    'HTTP/1.1' == request[2])
+
+                await self.handle_request(
+                    writer, client_addr, request, headers, keep_alive )
+
+        except (ConnectionError, asyncio.IncompleteReadError) as exc:
+            self.logger.debug( 'client %s: %s', client_addr, exc )
+
+        finally:
+            writer.close()
+            self._writers.discard( writer )
+            self._handlers.discard( handled )
+            handled.set_result( None )
+
+    async def handle_request( self, writer : asyncio.StreamWriter,
+        client_addr, request, headers, keep_alive ):
+
+        parsed = urlparse( request[1] if 1 < len( request ) else '' )
+        try:
+            width, quality, fps = parse_variant( parsed.query )
+        except ValueError as exc:
+            self.logger.warning( 'bad request from %s: %s', client_addr, exc )
+            await self.send_empty( writer, 400, keep_alive )
+            return
+
+        if parsed.path.endswith( '.jpg' ) or \
+        parsed.path.endswith( '.jpeg' ):
+            await self.serve_jpeg( writer, width, quality,
+                headers.get( 'if-none-match' ), keep_alive )
+        elif parsed.path.endswith( '.mjpg' ) or \
+        parsed.path.endswith( '.mjpeg' ):
+            await self.serve_mjpeg( writer, client_addr, width, quality, fps )
+        else:
+            await self.send_empty( writer, 404, keep_alive )
+
+    def response_head( self, code, keep_alive, headers=None ):
+        status = HTTPStatus( code )
+        head = 'HTTP/1.1 {} {}\r\n'.format( status.value, status.phrase )
+        for key, value in (headers or {}).items():
+            head += '{}: {}\r\n'.format( key, value )
+        head += 'Connection: {}\r\n\r\n'.format(
+            'keep-alive' if keep_alive else 'close' )
+        return head.encode( 'latin-1' )
+
+    async def send_empty( self, writer : asyncio.StreamWriter, code,
+        keep_alive ):
+        writer.write( self.response_head(
+            code, keep_alive, {'Content-length': 0} ) )
+        await writer.drain()
+
+    async def serve_jpeg( self, writer : asyncio.StreamWriter, width=None,
+        quality=None, if_none_match=None, keep_alive=False ):
+
+        if not self.proc.frame_ready():
+            self.logger.error( 'frame not ready' )
+            await self.send_empty( writer, 500, keep_alive )
+            return
+
+        seq, jpg = await asyncio.get_event_loop().run_in_executor(
+            None, self.proc.get_jpeg_seq, width, quality, if_none_match )
+        etag = self.proc.etag( seq, width, quality )
+
+        if None == jpg:
+            # The client already has this frame.
+            writer.write( self.response_head( 304, keep_alive,
+                {'ETag': etag, 'Cache-Control': 'no-cache'} ) )
+            await writer.drain()
+            return
+
+        writer.write( self.response_head( 200, keep_alive, {
+            'Content-type': 'image/jpeg',
+            'Content-length': len( jpg ),
+            'ETag': etag,
+            'Cache-Control': 'no-cache'} ) )
+        writer.write( jpg )
+        await writer.drain()
+
+    async def serve_mjpeg( self, writer : asyncio.StreamWriter, client_addr,
+        width=None, quality=None, fps=None ):
+
+        writer.transport.set_write_buffer_limits( self.WRITE_BUFFER_HIGH )
+        # The stream has no length, so it ends with the connection.
+        writer.write( self.response_head( 200, False, {'Content-type':
+            'multipart/x-mixed-replace; boundary=--jpgboundary'} ) )
+
+        client = StreamClient( writer, width, quality, fps )
+        self.clients.add( client )
+        self._have_clients.set()
+        self.logger.info( 'serving stream to client %s (%d clients)',
+            client_addr, len( self.clients ) )
+
+        try:
+            while self.proc.running:
+                await client.ready.wait()
+                jpg = client.take()
+                if None == jpg:
+                    # Woken to shut down.
+                    continue
+                writer.write( '--jpgboundary\r\nContent-type: image/jpeg\r\n'
+                    'Content-length: {}\r\n\r\n'.format(
+                        len( jpg ) ).encode( 'utf-8' ) )
+                writer.write( jpg )
+                # Frames offered while this waits on a slow client replace
+                # each other, rather than queueing up.
+                await writer.drain()
+
+        finally:
+            self.clients.discard( client )
+            if not self.clients:
+                self._have_clients.clear()
+            self.logger.info( 'client %s disconnected (%d frames dropped)',
+                client_addr, client.dropped )
+
 class ReserverProc( ObserverProc ):
 
     def __init__( self, instance_name, **kwargs ):
@@ -113,8 +456,78 @@ class ReserverProc( ObserverProc ):
         super().__init__( instance_name, **kwargs )
         self._hostname = kwargs['listen'] if 'listen' in kwargs else '0.0.0.0'
         self._port = int( kwargs['port'] ) if 'port' in kwargs else 8888
-        self._server : Reserver
+        self._server = None
         self.fps = float( kwargs['fps'] ) if 'fps' in kwargs else None
+        self.server_mode = kwargs['server'] if 'server' in kwargs \
+            else 'threads'
+        if self.server_mode not in ('threads', 'asyncio'):
+            raise ValueError( 'invalid reserver server: {}'.format(
+                self.server_mode ) )
+
+        # The JPEGs of the latest frame, by (width, quality), shared by all
+        # clients. The least recently used are dropped past the limit.
+        self.max_variants = int( kwargs['variants'] ) \
+            if 'variants' in kwargs else 8
+        self._jpeg_lock = threading.Lock()
+        self._variants = OrderedDict()
+        self.jpeg_encodes = 0
+
+        # Frame sequence numbers start over with the process, so tell ETags
+        # from different runs apart.
+        self._etag_prefix = uuid4().hex[:8]
+
+    def etag( self, seq, width=None, quality=None ):
+
+        ''' Return the ETag of the frame with the given sequence number, in
+        the given variant. '''
+
+        return '"{}-{}-{}-{}"'.format( self._etag_prefix, seq,
+            width or '', quality or '' )
+
+    def get_jpeg( self, width=None, quality=None ):
+
+        ''' Return the latest frame as JPEG, scaled down to width and at the
+        given quality if they're given. '''
+
+        return self.get_jpeg_seq( width, quality )[1]
+
+    def get_jpeg_seq( self, width=None, quality=None, if_none_match=None ):
+
+        ''' Return the sequence number of the latest frame and the frame as
+        JPEG, as get_jpeg(). Each frame is only encoded once per variant, by
+        whichever client thread asks for it first; the rest wait for and send
+        the same bytes. If if_none_match (an If-None-Match header) matches the
+        latest frame's ETag, nothing is encoded and None is returned in place
+        of the JPEG. '''
+
+        key = (width, quality)
+
+        with self.get_frame_seq() as (seq, orig_frame):
+            if etag_matches( if_none_match, self.etag( seq, width, quality ) ):
+                return seq, None
+
+            with self._jpeg_lock:
+                variant = self._variants.get( key )
+                if None == variant:
+                    variant = JPEGVariant()
+                    self._variants[key] = variant
+                    while len( self._variants ) > self.max_variants:
+                        self._variants.popitem( last=False )
+                else:
+                    self._variants.move_to_end( key )
+
+            with variant.lock:
+                if None == variant.jpg or seq != variant.seq:
+                    frame = orig_frame
+                    if None != width and width < frame.shape[1]:
+                        frame = cv2.resize( frame, (width, max( 1, round(
+                            frame.shape[0] * width / frame.shape[1] ) )),
+                            interpolation=cv2.INTER_AREA )
+                    variant.jpg = image_to_jpeg( frame, quality )
+                    variant.seq = seq
+                    with self._jpeg_lock:
+                        self.jpeg_encodes += 1
+                return variant.seq, variant.jpg
 
     def loop( self ):
 
@@ -122,11 +535,23 @@ class ReserverProc( ObserverProc ):
         #logger.debug( 'starting reserver...' )
 
         self.logger.info( 'setting up reserver on port %d...', self._port )
+
+        if 'asyncio' == self.server_mode:
+            self._server = AsyncReserver( self, self.instance_name, self.fps )
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop( loop )
+            try:
+                loop.run_until_complete(
+                    self._server.serve( self._hostname, self._port ) )
+            finally:
+                loop.close()
+            return
+
         self._server = Reserver( self, self.instance_name, self.fps,
             (self._hostname, self._port), ReserverHandler )
 
         self._server.serve_forever()
-        self.running = False
+        self._running = False
 
 PLUGIN_CLASS = ReserverProc # pylint: disable=invalid-name
 PLUGIN_TYPE = 'observers'
@@ -1,16 +1,117 @@
 
+import os
+import logging
+import time
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8 has no shared memory, so frames are pickled instead.
+    shared_memory = None # pylint: disable=invalid-name
+
+# Python < 3.7 has no per-thread CPU clock, so count the whole process.
+thread_time = getattr( time, 'thread_time', time.process_time ) # pylint: disable=invalid-name
+
 import numpy
 try:
     from cv2 import cv2
 except ImportError:
     import cv2
 
-def image_to_jpeg( frame ):
-    ret, jpg = cv2.imencode( '.jpg', frame )
+# What this process started with, for processes that set no thread budget of
+# their own, so that they don't inherit one from whoever forked them.
+DEFAULT_CVTHREADS = cv2.getNumThreads()
+DEFAULT_CPUS = os.sched_getaffinity( 0 ) \
+    if hasattr( os, 'sched_getaffinity' ) else None
+
+def image_to_jpeg( frame, quality=None ):
+    params = [cv2.IMWRITE_JPEG_QUALITY, int( quality )] if quality else []
+    ret, jpg = cv2.imencode( '.jpg', frame, params )
     if ret:
         return jpg.tobytes()
     else:
         return {}
 
+def compress_frame( frame, compression, quality=None ):
+
+    ''' Compress a frame to "jpeg" or lossless "png" bytes. quality is the
+    JPEG quality or PNG compression level. '''
+
+    if 'png' == compression:
+        ret, data = cv2.imencode( '.png', frame, [cv2.IMWRITE_PNG_COMPRESSION,
+            int( quality ) if None != quality else 1] )
+        return data.tobytes() if ret else None
+    return image_to_jpeg( frame, quality )
+
+def decompress_frame( data ):
+    return cv2.imdecode(
+        numpy.frombuffer( data, dtype=numpy.uint8 ), cv2.IMREAD_COLOR )
+
 def is_frame( frame ):
     return isinstance( frame, numpy.ndarray )
+
+def parse_cpus( cpus ):
+
+    ''' Parse a CPU list such as "0,2-3" into a set of CPU indexes. '''
+
+    cpu_set = set()
+    for cpu_range in cpus.split( ',' ):
+        cpu_range = cpu_range.strip()
+        if not cpu_range:
+            continue
+        if '-' in cpu_range:
+            first, last = cpu_range.split( '-' )
+            cpu_set.update( range( int( first ), int( last ) + 1 ) )
+        else:
+            cpu_set.add( int( cpu_range ) )
+    return cpu_set
+
+def merge_thread_budgets( budgets ):
+
+    ''' Combine the cvthreads and cpuaffinity options of plugins that share a
+    process into one budget. Raises ValueError if any two of them differ. '''
+
+    merged = {}
+    for budget in budgets:
+        for option in ('cvthreads', 'cpuaffinity'):
+            if option not in budget or not budget[option]:
+                continue
+            if option in merged:
+                same = parse_cpus( merged[option] ) == \
+                    parse_cpus( budget[option] ) if 'cpuaffinity' == option \
+                    else int( merged[option] ) == int( budget[option] )
+                if not same:
+                    raise ValueError( 'conflicting {} ({} and {}) for one '
+                        'process'.format( option, merged[option],
+                        budget[option] ) )
+            merged[option] = budget[option]
+    return merged
+
+def apply_thread_budget( **kwargs ):
+
+    ''' Limit OpenCV's internal thread pool and pin the calling process to
+    the given CPUs, according to the cvthreads and cpuaffinity options. Either
+    one left unset goes back to what the process started with, rather than
+    what it inherited. This should be called from inside the process it
+    applies to. '''
+
+    logger = logging.getLogger( 'portability.threads' )
+
+    cv_threads = int( kwargs['cvthreads'] ) \
+        if 'cvthreads' in kwargs and kwargs['cvthreads'] else DEFAULT_CVTHREADS
+    cv2.setNumThreads( cv_threads )
+    logger.debug( 'opencv threads set to %d (pid %d)',
+        cv2.getNumThreads(), os.getpid() )
+
+    if 'cpuaffinity' in kwargs and kwargs['cpuaffinity']:
+        if not hasattr( os, 'sched_setaffinity' ):
+            logger.warning( 'cpu affinity is not supported on this platform' )
+            return
+        cpus = parse_cpus( kwargs['cpuaffinity'] )
+    elif None != DEFAULT_CPUS:
+        cpus = DEFAULT_CPUS
+    else:
+        return
+    os.sched_setaffinity( 0, cpus )
+    logger.debug( 'cpu affinity set to %s (pid %d)',
+        sorted( os.sched_getaffinity( 0 ) ), os.getpid() )
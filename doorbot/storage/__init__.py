@@ -0,0 +1,178 @@
+
+import logging
+import os
+from urllib.parse import urlparse
+
+class StorageError( OSError ):
+
+    ''' A storage server refused or botched a request. Being an OSError, it
+    is retried like any other upload failure. '''
+
+class Storage( object ):
+
+    ''' Somewhere captures are kept, addressed by URL. Subclasses implement
+    upload(), to copy a finished file there, and open_stream(), to write a
+    file there as it is produced. Paths are given from the root of the
+    storage, e.g. "/dev/2021-09-23/clip.mp4". '''
+
+    # Whether files must leave the box, i.e. can't be written in place.
+    remote = True
+
+    def __init__( self, url, **kwargs ):
+
+        self.logger = logging.getLogger( 'storage.{}'.format(
+            type( self ).__name__.lower() ) )
+
+        self.parsed = urlparse( url )
+        self.kwargs = kwargs
+        self.pid = os.getpid()
+
+    def public_url( self, path ):
+
+        ''' Return the URL of the file at path, without login details. '''
+
+        return '{}://{}{}'.format( self.parsed.scheme,
+            self.parsed.netloc.rsplit( '@', 1 )[-1], path )
+
+    def upload( self, filepath, path, resume=False ):
+
+        ''' Copy the local file at filepath to path. If resume is True, a
+        partial upload to path is continued rather than started over, where
+        the storage allows it. Returns the bytes sent. '''
+
+        raise NotImplementedError()
+
+    def open_stream( self, path ):
+
+        ''' Return a writable file object that stores everything written to
+        it at path. The file is complete once the object is closed. '''
+
+        raise NotImplementedError()
+
+    def close( self ):
+        pass
+
+class SpoolingStream( object ):
+
+    ''' Streams to path on the given storage, falling back to writing the
+    local spool_filepath if the storage fails, so the file can be uploaded
+    later instead. What was already sent is kept in memory, up to backlog
+    bytes, to start the spool file with; if the storage fails after that,
+    the file is lost. '''
+
+    def __init__( self, storage : Storage, path, spool_filepath, backlog ):
+
+        self.logger = logging.getLogger( 'storage.spooling' )
+
+        self.path = path
+        self.spool_filepath = spool_filepath
+        self.backlog_size = backlog
+        self.bytes_written = 0
+
+        # Whether the file ended up in the spool file, or nowhere.
+        self.spooled = False
+        self.failed = False
+
+        self._backlog = bytearray()
+        self._stream = None
+        self._spool_file = None
+
+        try:
+            self._stream = storage.open_stream( path )
+        except OSError as exc:
+            self.fall_back( exc )
+
+    def fall_back( self, exc ):
+
+        if None != self._stream:
+            abort = getattr( self._stream, 'abort', None )
+            if abort:
+                abort()
+            self._stream = None
+
+        if None == self._backlog:
+            self.logger.error( 'streaming to %s failed after %d bytes: %s; '
+                'too late to spool', self.path, self.bytes_written, exc )
+            self.failed = True
+            return
+
+        self.logger.warning( 'streaming to %s failed: %s; spooling to %s...',
+            self.path, exc, self.spool_filepath )
+        self.spooled = True
+        self._spool_file = open( self.spool_filepath, 'wb' )
+        self._spool_file.write( self._backlog )
+        self._backlog = None
+
+    def write( self, data ):
+
+        if None != self._stream:
+            try:
+                self._stream.write( data )
+                if None != self._backlog:
+                    self._backlog += data
+                    if len( self._backlog ) > self.backlog_size:
+                        self.logger.warning( 'streaming to %s passed %d '
+                            'bytes; it can no longer be spooled on failure',
+                            self.path, self.backlog_size )
+                        self._backlog = None
+                self.bytes_written += len( data )
+                return len( data )
+            except OSError as exc:
+                self.fall_back( exc )
+
+        if None != self._spool_file:
+            self._spool_file.write( data )
+        self.bytes_written += len( data )
+        return len( data )
+
+    def close( self ):
+
+        if None != self._stream:
+            try:
+                self._stream.close()
+            except OSError as exc:
+                self.fall_back( exc )
+            self._stream = None
+
+        if None != self._spool_file:
+            self._spool_file.close()
+            self._spool_file = None
+        self._backlog = None
+
+storages = {} # pylint: disable=invalid-name
+
+def get_storage( url, **kwargs ) -> Storage:
+
+    ''' Return the storage for the given URL, chosen by its scheme: a local
+    path (or file://), ftp:// or ftps://, or s3:// or s3+http://. Storage
+    is shared per server in each process so connections can be reused.
+    Options are taken from the capturer configuration that first used
+    it. '''
+
+    # Import here to avoid a circular import.
+    from doorbot.storage.local import LocalStorage
+    from doorbot.storage.ftp import FTPStorage
+    from doorbot.storage.s3 import S3Storage
+
+    backends = {
+        '': LocalStorage,
+        'file': LocalStorage,
+        'ftp': FTPStorage,
+        'ftps': FTPStorage,
+        's3': S3Storage,
+        's3+http': S3Storage}
+
+    parsed = urlparse( url )
+    if parsed.scheme not in backends:
+        raise ValueError( 'no storage for {}'.format( parsed.scheme ) )
+
+    key = (parsed.scheme, parsed.netloc)
+    if key not in storages or os.getpid() != storages[key].pid:
+        storages[key] = backends[parsed.scheme]( url, **kwargs )
+    return storages[key]
+
+def shutdown_storage():
+    for storage in storages.values():
+        if os.getpid() == storage.pid:
+            storage.close()
+    storages.clear()
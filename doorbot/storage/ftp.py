@@ -0,0 +1,220 @@
+
+import os
+from ftplib import FTP, FTP_TLS
+from ftplib import all_errors, error_perm
+
+from doorbot.capturers.ftppool import FTPSession, get_ftp_pool
+from doorbot.storage import Storage, StorageError
+
+def as_storage_error( exc ):
+
+    ''' Return ftplib's protocol errors, which aren't OSErrors, as
+    StorageError, so callers only need to catch OSError. '''
+
+    if isinstance( exc, OSError ):
+        return exc
+    error = StorageError( str( exc ).strip() )
+    error.__cause__ = exc
+    return error
+
+class FTPStream( object ):
+
+    ''' Sends everything written to it over an FTP data connection, holding
+    a pooled session until closed. '''
+
+    def __init__( self, pool, session, conn ):
+        self.pool = pool
+        self.session = session
+        self.bytes_written = 0
+        self._conn = conn
+
+    def write( self, data ):
+        try:
+            self._conn.sendall( data )
+        except all_errors as exc:
+            self.abort()
+            raise as_storage_error( exc )
+        self.bytes_written += len( data )
+        return len( data )
+
+    def close( self ):
+        if None == self._conn:
+            return
+        try:
+            if hasattr( self._conn, 'unwrap' ):
+                # Shut down TLS cleanly, as storbinary() does.
+                self._conn.unwrap()
+            self._conn.close()
+            self._conn = None
+            self.session.ftp.voidresp()
+        except all_errors as exc:
+            self.abort()
+            raise as_storage_error( exc )
+        self.pool.release( self.session )
+        self.session = None
+
+    def abort( self ):
+        if None != self._conn:
+            self._conn.close()
+            self._conn = None
+        if None != self.session:
+            self.pool.release( self.session, broken=True )
+            self.session = None
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+class FTPStorage( Storage ):
+
+    ''' Storage on an FTP server, or FTP over TLS for ftps:// URLs. Sessions
+    are taken from the FTP pool, so a burst of uploads logs in once. '''
+
+    def __init__( self, url, **kwargs ):
+        super().__init__( url, **kwargs )
+
+        self.ftp_ssl = 'ftps' == self.parsed.scheme
+        self.key = (self.parsed.scheme, self.parsed.hostname,
+            self.parsed.port, self.parsed.username)
+
+    def login( self ) -> FTP:
+        # FTP login.
+        self.logger.info( 'logging into ftp at %s as %s...',
+            self.parsed.hostname, self.parsed.username )
+        ftp = None
+        if self.ftp_ssl:
+            ftp_class = FTP_TLS
+        else:
+            ftp_class = FTP
+        ftp = ftp_class()
+        connect_args = { 'host': self.parsed.hostname }
+        if self.parsed.port:
+            connect_args['port'] = self.parsed.port
+        ftp.connect( **connect_args )
+        ftp.login( user=self.parsed.username, passwd=self.parsed.password )
+        if self.ftp_ssl:
+            ftp.prot_p()
+        return ftp
+
+    def chdir( self, ftp : FTP, path, known_dirs=None ):
+
+        if not path:
+            return
+
+        # Directories in known_dirs were seen to exist before, so don't
+        # bother with the walk.
+        if None != known_dirs and path in known_dirs:
+            ftp.cwd( path )
+            return
+
+        try:
+            ftp.cwd( path )
+        except error_perm:
+            parent_path = os.path.dirname( path )
+            self.chdir( ftp, parent_path, known_dirs )
+            self.logger.info( 'creating missing remote directory: %s', path )
+            try:
+                ftp.mkd( path )
+            except error_perm:
+                pass
+            ftp.cwd( path )
+
+        if None != known_dirs:
+            known_dirs.add( path )
+
+    def with_session( self, action ):
+
+        ''' Call action( pool, session ) with a pooled session and return
+        what it returns. If a reused session fails, it's retried once on a
+        new session. '''
+
+        pool = get_ftp_pool( **self.kwargs )
+        session = pool.acquire( self.key, self.login )
+        try:
+            return action( pool, session )
+        except all_errors as exc:
+            pool.release( session, broken=True )
+            if 0 == session.uses:
+                raise
+            # The pooled session was stale; try once more from scratch.
+            self.logger.info( 'pooled ftp session failed: %s', exc )
+            pool.reset( self.key )
+            session = pool.acquire( self.key, self.login )
+            try:
+                return action( pool, session )
+            except all_errors:
+                pool.release( session, broken=True )
+                raise
+
+    def enter_dir( self, pool, session : FTPSession, cwd_path ):
+        if session.cwd != cwd_path:
+            session.cwd = None
+            self.chdir( session.ftp, cwd_path, pool.known_dirs( session.key ) )
+            session.cwd = cwd_path
+
+    def upload( self, filepath, path, resume=False ):
+
+        ''' Upload the given file. Uses a pooled session to the server if one
+        is idle. If that fails, the upload is retried once on a new
+        session. '''
+
+        def upload_session( pool, session ):
+            sent = self.upload_session( pool, session, filepath, path, resume )
+            pool.release( session )
+            return sent
+
+        return self.with_session( upload_session )
+
+    def upload_session( self, pool, session : FTPSession, filepath, path,
+        resume ):
+
+        cwd_path, dest_filename = os.path.split( path )
+        self.enter_dir( pool, session, cwd_path )
+
+        local_size = os.path.getsize( filepath )
+        offset = 0
+        if resume:
+            # Pick up from the end of what the server already has.
+            try:
+                session.ftp.voidcmd( 'TYPE I' )
+                remote_size = session.ftp.size( dest_filename )
+            except error_perm:
+                remote_size = None
+            if local_size == remote_size:
+                self.logger.info( '%s already uploaded', dest_filename )
+                return 0
+            if None != remote_size and remote_size < local_size:
+                offset = remote_size
+
+        self.logger.info( 'uploading %s to %s%s...', filepath, cwd_path,
+            ' from byte {}'.format( offset ) if offset else '' )
+
+        # Upload the file.
+        with open( filepath, 'rb' ) as upload_file:
+            upload_file.seek( offset )
+            session.ftp.storbinary(
+                'STOR {}'.format( dest_filename ), upload_file,
+                rest=offset if offset else None )
+
+        return local_size - offset
+
+    def open_stream( self, path ):
+
+        cwd_path, dest_filename = os.path.split( path )
+
+        def open_session( pool, session ):
+            self.enter_dir( pool, session, cwd_path )
+            session.ftp.voidcmd( 'TYPE I' )
+            conn = session.ftp.transfercmd( 'STOR {}'.format( dest_filename ) )
+            return FTPStream( pool, session, conn )
+
+        self.logger.info( 'streaming to %s...', path )
+        try:
+            return self.with_session( open_session )
+        except all_errors as exc:
+            raise as_storage_error( exc )
@@ -0,0 +1,51 @@
+
+import os
+import shutil
+
+from doorbot.storage import Storage
+
+class LocalFileStream( object ):
+
+    ''' Writes to a .part file beside path, renamed into place on close so
+    that a half-written file is never mistaken for a finished one. '''
+
+    def __init__( self, path ):
+        self.path = path
+        self.bytes_written = 0
+        self._file = open( path + '.part', 'wb' )
+
+    def write( self, data ):
+        self._file.write( data )
+        self.bytes_written += len( data )
+        return len( data )
+
+    def close( self ):
+        if self._file.closed:
+            return
+        self._file.close()
+        os.replace( self.path + '.part', self.path )
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        self.close()
+
+class LocalStorage( Storage ):
+
+    ''' Storage on the local filesystem. Writers put files straight into
+    place here, so nothing is ever uploaded twice. '''
+
+    remote = False
+
+    def public_url( self, path ):
+        return path
+
+    def upload( self, filepath, path, resume=False ):
+        os.makedirs( os.path.dirname( path ), exist_ok=True )
+        shutil.copyfile( filepath, path )
+        return os.path.getsize( path )
+
+    def open_stream( self, path ):
+        os.makedirs( os.path.dirname( path ), exist_ok=True )
+        return LocalFileStream( path )
@@ -0,0 +1,276 @@
+
+import hashlib
+import hmac
+import os
+import threading
+from datetime import datetime, timezone
+from urllib.parse import quote, unquote
+from xml.etree import ElementTree
+
+import requests
+
+from doorbot.storage import Storage, StorageError
+
+UNSIGNED_PAYLOAD = 'UNSIGNED-PAYLOAD'
+
+def sign( key, msg ):
+    return hmac.new( key, msg.encode( 'utf-8' ), hashlib.sha256 ).digest()
+
+class S3Stream( object ):
+
+    ''' Buffers what is written to it into parts, uploading each as it
+    fills. Anything smaller than one part is sent in a single PUT on
+    close. '''
+
+    def __init__( self, storage, path ):
+        self.storage = storage
+        self.path = path
+        self.bytes_written = 0
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._etags = []
+        self._closed = False
+
+    def write( self, data ):
+        self._buffer += data
+        self.bytes_written += len( data )
+        while len( self._buffer ) >= self.storage.part_size:
+            self._send_part( bytes( self._buffer[:self.storage.part_size] ) )
+            del self._buffer[:self.storage.part_size]
+        return len( data )
+
+    def _send_part( self, data ):
+        try:
+            if None == self._upload_id:
+                self._upload_id = self.storage.start_multipart( self.path )
+            self._etags.append( self.storage.upload_part(
+                self.path, self._upload_id, len( self._etags ) + 1, data ) )
+        except OSError:
+            self.abort()
+            raise
+
+    def close( self ):
+        if self._closed:
+            return
+        if None == self._upload_id:
+            self.storage.put( self.path, bytes( self._buffer ) )
+        else:
+            if self._buffer:
+                self._send_part( bytes( self._buffer ) )
+            try:
+                self.storage.complete_multipart(
+                    self.path, self._upload_id, self._etags )
+            except OSError:
+                self.abort()
+                raise
+        self._buffer = bytearray()
+        self._closed = True
+
+    def abort( self ):
+        if None != self._upload_id:
+            self.storage.abort_multipart( self.path, self._upload_id )
+            self._upload_id = None
+        self._buffer = bytearray()
+        self._closed = True
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+class S3Storage( Storage ):
+
+    ''' Storage in an S3-compatible object store, addressed as
+    s3://access key:secret key@host:port/bucket/prefix, or s3+http:// for a
+    server without TLS. Requests are signed with AWS signature version 4
+    and use path-style bucket addressing, which works with most S3
+    stand-ins as well as S3 itself. Files bigger than one part are uploaded
+    as multipart uploads, a part at a time. Each thread keeps its own HTTP
+    session so connections are reused. '''
+
+    def __init__( self, url, **kwargs ):
+        super().__init__( url, **kwargs )
+
+        self.endpoint = '{}://{}'.format(
+            'http' if 's3+http' == self.parsed.scheme else 'https',
+            self.parsed.netloc.rsplit( '@', 1 )[-1] )
+        self.host = self.parsed.netloc.rsplit( '@', 1 )[-1]
+        self.access_key = unquote( self.parsed.username or '' )
+        self.secret_key = unquote( self.parsed.password or '' )
+        self.region = kwargs['s3region'] if 's3region' in kwargs \
+            else 'us-east-1'
+        # S3 won't take parts under 5MiB, other than the last.
+        self.part_size = max( 5 * 1024 * 1024, int( kwargs['s3partsize'] ) \
+            if 's3partsize' in kwargs else 8 * 1024 * 1024 )
+        self.timeout = float( kwargs['s3timeout'] ) \
+            if 's3timeout' in kwargs else 60.0
+
+        self._local = threading.local()
+        self._sessions = []
+        self._lock = threading.Lock()
+
+    @property
+    def session( self ) -> requests.Session:
+        if not hasattr( self._local, 'session' ):
+            self._local.session = requests.Session()
+            with self._lock:
+                self._sessions.append( self._local.session )
+        return self._local.session
+
+    def sign_headers( self, method, path, query, now=None,
+        payload_hash=UNSIGNED_PAYLOAD, extra_headers=None ):
+
+        ''' Return the headers authorizing the given request, signed at now
+        (the current time by default) along with any extra_headers. By
+        default the payload isn't hashed, so that files can be streamed from
+        disk. '''
+
+        if None == now:
+            now = datetime.now( timezone.utc )
+        amz_date = now.strftime( '%Y%m%dT%H%M%SZ' )
+        datestamp = now.strftime( '%Y%m%d' )
+
+        headers = {
+            'host': self.host,
+            'x-amz-content-sha256': payload_hash,
+            'x-amz-date': amz_date}
+        headers.update( extra_headers or {} )
+        signed_headers = ';'.join( sorted( headers ) )
+
+        canonical_request = '\n'.join( [
+            method,
+            quote( path, safe='/-_.~' ),
+            query,
+            ''.join( '{}:{}\n'.format( k, headers[k] ) \
+                for k in sorted( headers ) ),
+            signed_headers,
+            payload_hash] )
+
+        scope = '{}/{}/s3/aws4_request'.format( datestamp, self.region )
+        string_to_sign = '\n'.join( [
+            'AWS4-HMAC-SHA256', amz_date, scope,
+            hashlib.sha256( canonical_request.encode( 'utf-8' ) ).hexdigest()] )
+
+        key = sign( ('AWS4' + self.secret_key).encode( 'utf-8' ), datestamp )
+        for part in (self.region, 's3', 'aws4_request'):
+            key = sign( key, part )
+        signature = hmac.new( key, string_to_sign.encode( 'utf-8' ),
+            hashlib.sha256 ).hexdigest()
+
+        del headers['host']
+        headers['Authorization'] = \
+            'AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, ' \
+            'Signature={}'.format(
+                self.access_key, scope, signed_headers, signature )
+        return headers
+
+    def request( self, method, path, params=None, data=None, headers=None,
+        expect=(200,) ) -> requests.Response:
+
+        query = '&'.join( '{}={}'.format(
+            quote( k, safe='-_.~' ), quote( str( v ), safe='-_.~' ) ) \
+            for k, v in sorted( (params or {}).items() ) )
+
+        all_headers = self.sign_headers( method, path, query )
+        all_headers.update( headers or {} )
+
+        url = self.endpoint + quote( path, safe='/-_.~' )
+        if query:
+            url += '?' + query
+
+        response = self.session.request( method, url, data=data,
+            headers=all_headers, timeout=self.timeout )
+        if response.status_code not in expect:
+            raise StorageError( '{} {} failed: {} {}'.format(
+                method, path, response.status_code, response.text[:200] ) )
+        return response
+
+    def put( self, path, data ):
+        self.request( 'PUT', path, data=data,
+            headers={'Content-Length': str( len( data ) )} )
+
+    def start_multipart( self, path ):
+        response = self.request( 'POST', path, {'uploads': ''} )
+        try:
+            root = ElementTree.fromstring( response.content )
+        except ElementTree.ParseError as exc:
+            raise StorageError( 'bad multipart response: {}'.format( exc ) )
+        for element in root.iter():
+            if element.tag.endswith( 'UploadId' ):
+                return element.text
+        raise StorageError( 'no upload id for {}'.format( path ) )
+
+    def upload_part( self, path, upload_id, part_number, data ):
+        response = self.request( 'PUT', path,
+            {'partNumber': part_number, 'uploadId': upload_id}, data=data,
+            headers={'Content-Length': str( len( data ) )} )
+        return response.headers.get( 'ETag' )
+
+    def complete_multipart( self, path, upload_id, etags ):
+        body = '<CompleteMultipartUpload>{}</CompleteMultipartUpload>'.format(
+            ''.join( '<Part><PartNumber>{}</PartNumber><ETag>{}</ETag></Part>'\
+                .format( i + 1, etag ) for i, etag in enumerate( etags ) ) )
+        response = self.request( 'POST', path, {'uploadId': upload_id},
+            data=body.encode( 'utf-8' ) )
+        # Failures can come back as a 200 with an error in the body.
+        if b'<Error>' in response.content:
+            raise StorageError( 'multipart upload of {} failed: {}'.format(
+                path, response.text[:200] ) )
+
+    def abort_multipart( self, path, upload_id ):
+        try:
+            self.request( 'DELETE', path, {'uploadId': upload_id},
+                expect=(200, 204, 404) )
+        except OSError as exc:
+            self.logger.warning( 'could not abort upload of %s: %s',
+                path, exc )
+
+    def size( self, path ):
+
+        ''' Return the size of the object at path, or None if there isn't
+        one. '''
+
+        response = self.request( 'HEAD', path, expect=(200, 404) )
+        if 404 == response.status_code:
+            return None
+        return int( response.headers.get( 'Content-Length', 0 ) )
+
+    def upload( self, filepath, path, resume=False ):
+
+        ''' Upload the given file, in parts if it is bigger than one part.
+        Objects can't be appended to, so resuming only skips files that are
+        already there in full. '''
+
+        local_size = os.path.getsize( filepath )
+        if resume and local_size == self.size( path ):
+            self.logger.info( '%s already uploaded', path )
+            return 0
+
+        self.logger.info( 'uploading %s to %s...', filepath, path )
+
+        with open( filepath, 'rb' ) as upload_file:
+            if local_size <= self.part_size:
+                self.put( path, upload_file.read() )
+                return local_size
+            with S3Stream( self, path ) as stream:
+                while True:
+                    data = upload_file.read( self.part_size )
+                    if not data:
+                        break
+                    stream.write( data )
+
+        return local_size
+
+    def open_stream( self, path ):
+        self.logger.info( 'streaming to %s...', path )
+        return S3Stream( self, path )
+
+    def close( self ):
+        with self._lock:
+            for session in self._sessions:
+                session.close()
+            self._sessions = []
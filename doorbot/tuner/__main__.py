@@ -1,14 +1,11 @@
 #!/usr/bin/env python3
 
-import random
+import argparse
+import glob
 import logging
+import os
 
-try:
-    from cv2 import cv2
-except ImportError:
-    import cv2
-
-from doorbot.detector import MotionDetector
+from doorbot.tuner.search import Tuner, STRATEGIES
 
 person_seq = [
     'testdata/motion1/2021-01-10-14-09-45-065179.jpg',
@@ -90,105 +87,84 @@ shadow_seq = [
     'testdata/motion2/2021-01-12-23-09-40-766118.jpg']
 
 initial_config = {
-    'threshold': 50,
-    'varthreshold': 200,
-    'blur': 5,
     'minw': 20,
     'minh': 20,
-    'fps': 5.0,
-    'ignoreedges': False }
-
-CHILDREN_PER_GEN = 20
-MAX_GEN = 100
-
-class TunerNotifier( object ):
-
-    def __init__( self ):
-        self.capturers = []
-        self.score = 0
-        self.movement_additive = 0
-
-    def notify( self, action, sz_coords, snapshot ):
-        if 'movement' == action:
-            self.score += self.movement_additive
-
-def test_sequence( seq, params, notifier, movement_additive ):
-    detector = MotionDetector( **params )
-    detector.cam = notifier
-    notifier.movement_additive = movement_additive
-
-    for path in seq:
-        frame = cv2.imread( path )
-        detector.detect( frame )
-
-def tune( config, gen=0 ):
-
-    logger = logging.getLogger( 'tuning' )
-
-    if gen > MAX_GEN:
-        return config
-
-    children = []
-    highest_gc = {}
-    for i in range( CHILDREN_PER_GEN ):
-        child = config.copy()
-        child['child_index'] = i
-        for key in child:
-            if 'child_index' == key or \
-            'score' == key or \
-            'fps' == key or \
-            'minh' == key or \
-            'minw' == key:
-                continue
-
-            if isinstance( child[key], float ):
-                addition = random.random() % 5.0
-                if random.randrange( 0, 10 ) > 5 and \
-                0 < (child[key] - addition):
-                    addition *= -1
-                logger.debug( 'child %d: prop %s: adding %f to current %f',
-                    i, key, addition, child[key] )
-                child[key] += addition
-            elif isinstance( child[key], int ):
-                addition = random.randrange( -10, 10 )
-                if 0 > (child[key] + addition):
-                    addition *= -1
-                logger.debug( 'child %d: prop %s: adding %d to current %d',
-                    i, key, addition, child[key] )
-                child[key] += addition
-
-        notifier = TunerNotifier()
-        test_sequence( shadow_seq, initial_config, notifier, -1 )
-        test_sequence( person_seq, initial_config, notifier, 1 )
-        child['score'] = notifier.score
-
-        logger.debug( 'gen %d child %d: score %d',
-            gen, child['child_index'], child['score'] )
-
-        inserted = False
-        for j in range( len( children ) ):
-            if child['score'] < children[j]['score']:
-                children.insert( j, child )
-                inserted = True
-                break
-        if not inserted:
-            children.append( child )
-
-        grandchildren = []
-        for j in range( int( len( children ) / 2 ) ):
-            k = int( (len( children ) / 2) + j )
-            grandchildren.append( tune( children[k], gen + 1 ) )
-
-        for gc in grandchildren:
-            if not highest_gc or gc['score'] > highest_gc['score']:
-                highest_gc = gc
-
-    return highest_gc
+    'ignoreedges': 'false' }
+
+param_ranges = {
+    'threshold': range( 10, 251, 20 ),
+    'varthreshold': range( 25, 401, 25 ),
+    'blur': range( 3, 16, 2 ),
+    'history': range( 50, 301, 50 ) }
+
+def load_dir( path ):
+    return sorted( glob.glob( os.path.join( path, '*.jpg' ) ) )
 
 def main():
-    logging.basicConfig( level=logging.DEBUG )
 
-    print( tune( initial_config ) )
+    parser = argparse.ArgumentParser(
+        'doorbot.tuner', description='search for motion detector parameters' )
+
+    parser.add_argument(
+        '-s', '--strategy', action='store', default='halving',
+        choices=list( STRATEGIES.keys() ),
+        help='search strategy to use' )
+
+    parser.add_argument(
+        '-p', '--positive', action='append', default=[], metavar='DIR',
+        help='directory of frames that should trigger movement' )
+
+    parser.add_argument(
+        '-n', '--negative', action='append', default=[], metavar='DIR',
+        help='directory of frames that should not trigger movement' )
+
+    parser.add_argument(
+        '-r', '--range', action='append', nargs=4, default=[],
+        metavar=('param', 'start', 'stop', 'step'),
+        help='override the searched range of a parameter' )
+
+    parser.add_argument(
+        '-S', '--samples', action='store', type=int, default=27,
+        help='number of candidates for random and halving strategies' )
+
+    parser.add_argument(
+        '-e', '--eta', action='store', type=int, default=3,
+        help='reduction factor for each successive halving rung' )
+
+    parser.add_argument(
+        '-P', '--patience', action='store', type=int, default=0,
+        help='stop after this many evaluations without improvement' )
+
+    parser.add_argument(
+        '-b', '--budget', action='store', type=float, default=0,
+        help='stop after this many seconds' )
+
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='show every evaluation' )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO )
+
+    ranges = dict( param_ranges )
+    for param, start, stop, step in args.range:
+        ranges[param] = range( int( start ), int( stop ) + 1, int( step ) )
+
+    positive = [load_dir( d ) for d in args.positive] \
+        if args.positive else [person_seq]
+    negative = [load_dir( d ) for d in args.negative] \
+        if args.negative else [shadow_seq]
+
+    tuner = Tuner( positive, negative, initial_config,
+        patience=args.patience, budget=args.budget )
+    strategy = STRATEGIES[args.strategy](
+        ranges, samples=args.samples, eta=args.eta )
+
+    best_params, best_score = tuner.run( strategy )
+
+    print( best_params, best_score )
 
 if '__main__' == __name__:
     main()
@@ -0,0 +1,209 @@
+
+import itertools
+import logging
+import math
+import random
+import time
+
+try:
+    from cv2 import cv2
+except ImportError:
+    import cv2
+
+from doorbot.detectors.motion import MotionDetector
+
+class StopSearch( Exception ):
+    pass
+
+class Tuner( object ):
+
+    ''' Holds the decoded test sequences and scores detector parameter sets
+    against them. Movement found in a positive sequence adds to the score and
+    movement found in a negative sequence subtracts from it. Tracks the best
+    result seen so far and raises StopSearch once a perfect score is found,
+    the patience runs out or the time budget is spent. '''
+
+    def __init__( self, positive, negative, fixed=None, **kwargs ):
+
+        self.logger = logging.getLogger( 'tuner' )
+
+        # Decode every frame once up front instead of once per candidate.
+        self.positive = [self.load_sequence( s ) for s in positive]
+        self.negative = [self.load_sequence( s ) for s in negative]
+        self.fixed = fixed if fixed else {}
+
+        self.patience = int( kwargs['patience'] ) \
+            if 'patience' in kwargs and kwargs['patience'] else 0
+        self.budget = float( kwargs['budget'] ) \
+            if 'budget' in kwargs and kwargs['budget'] else 0.0
+
+        self.best_params = None
+        self.best_score = None
+        self.evaluations = 0
+        self.since_improved = 0
+        self.started = time.time()
+
+    @staticmethod
+    def load_sequence( seq ):
+        frames = []
+        for frame in seq:
+            if isinstance( frame, str ):
+                frame = cv2.imread( frame )
+            frames.append( frame )
+        return frames
+
+    def max_score( self, fraction=1.0 ):
+
+        ''' Best possible score: movement on every positive frame after the
+        first (which only seeds the background) and none on negatives. '''
+
+        return sum( max( 0, self.subset_len( s, fraction ) - 1 ) \
+            for s in self.positive )
+
+    @staticmethod
+    def subset_len( seq, fraction ):
+        return max( 1, int( math.ceil( len( seq ) * fraction ) ) )
+
+    def score( self, params, fraction=1.0 ):
+
+        ''' Run a fresh detector over the first fraction of each sequence
+        and return the resulting score. '''
+
+        detector_args = dict( self.fixed )
+        detector_args.update( params )
+        detector_args['camera'] = 'tuner'
+
+        score = 0
+        for seqs, additive in ((self.positive, 1), (self.negative, -1)):
+            for seq in seqs:
+                detector = MotionDetector( 'tuner', **detector_args )
+                for frame in seq[:self.subset_len( seq, fraction )]:
+                    event = detector.detect( frame )
+                    if event and 'movement' == event.event_type:
+                        score += additive
+
+        return score
+
+    def evaluate( self, params, fraction=1.0 ):
+
+        ''' Score a candidate and update the running best. Only full-dataset
+        evaluations count towards the best result and early termination. '''
+
+        if self.budget and time.time() - self.started > self.budget:
+            raise StopSearch( 'time budget exhausted' )
+
+        score = self.score( params, fraction )
+        self.evaluations += 1
+
+        self.logger.debug( 'evaluation %d (%.2f of frames): %s: score %d',
+            self.evaluations, fraction, params, score )
+
+        if 1.0 > fraction:
+            return score
+
+        if None == self.best_score or score > self.best_score:
+            self.best_score = score
+            self.best_params = dict( params )
+            self.since_improved = 0
+            self.logger.info( 'new best score %d/%d: %s',
+                score, self.max_score(), params )
+        else:
+            self.since_improved += 1
+
+        if self.best_score >= self.max_score():
+            raise StopSearch( 'perfect score reached' )
+        if self.patience and self.since_improved >= self.patience:
+            raise StopSearch( 'no improvement in {} evaluations'.format(
+                self.patience ) )
+
+        return score
+
+    def run( self, strategy ):
+        try:
+            strategy.search( self )
+        except StopSearch as exc:
+            self.logger.info( 'stopping search: %s', exc )
+
+        self.logger.info( 'search finished after %d evaluations in %.1fs',
+            self.evaluations, time.time() - self.started )
+
+        return self.best_params, self.best_score
+
+class SearchStrategy( object ):
+
+    ''' Base for search strategies. Ranges map each parameter name to the
+    list of values it may take. '''
+
+    def __init__( self, ranges, **kwargs ): # pylint: disable=unused-argument
+        self.ranges = {k: list( v ) for k, v in ranges.items()}
+
+    def search( self, tuner : Tuner ):
+        for params in self.candidates():
+            tuner.evaluate( params )
+
+    def candidates( self ):
+        return iter( [] )
+
+class GridSearch( SearchStrategy ):
+
+    ''' Exhaustively evaluate every combination of the declared ranges. '''
+
+    def candidates( self ):
+        keys = list( self.ranges.keys() )
+        for values in itertools.product( *[self.ranges[k] for k in keys] ):
+            yield dict( zip( keys, values ) )
+
+class LatinHypercubeSearch( SearchStrategy ):
+
+    ''' Draw a fixed number of samples so that every parameter has each of
+    its value strata covered exactly once. '''
+
+    def __init__( self, ranges, **kwargs ):
+        super().__init__( ranges, **kwargs )
+        self.samples = int( kwargs['samples'] ) if 'samples' in kwargs else 20
+        self.random = random.Random( kwargs['seed'] ) \
+            if 'seed' in kwargs else random.Random()
+
+    def candidates( self ):
+        strata = {}
+        for key, values in self.ranges.items():
+            order = list( range( self.samples ) )
+            self.random.shuffle( order )
+            strata[key] = [values[int(
+                (s + self.random.random()) * len( values ) / self.samples )] \
+                for s in order]
+
+        for i in range( self.samples ):
+            yield {k: strata[k][i] for k in self.ranges}
+
+class SuccessiveHalvingSearch( LatinHypercubeSearch ):
+
+    ''' Score a Latin hypercube sample on a small subset of frames, keep the
+    best 1/eta of the candidates and repeat with eta times as many frames
+    until the survivors are scored on the full dataset. '''
+
+    def __init__( self, ranges, **kwargs ):
+        super().__init__( ranges, **kwargs )
+        self.eta = int( kwargs['eta'] ) if 'eta' in kwargs else 3
+
+    def search( self, tuner : Tuner ):
+        candidates = list( self.candidates() )
+
+        rungs = max( 0, int( math.log( len( candidates ), self.eta ) ) )
+        fraction = 1.0 / (self.eta ** rungs)
+
+        while 1.0 > fraction and 1 < len( candidates ):
+            scored = [(tuner.evaluate( c, fraction ), c) for c in candidates]
+            scored.sort( key=lambda x: x[0], reverse=True )
+            keep = max( 1, len( candidates ) // self.eta )
+            candidates = [c for s, c in scored[:keep]]
+            fraction = min( 1.0, fraction * self.eta )
+
+        for params in candidates:
+            tuner.evaluate( params )
+
+STRATEGIES = {
+    'grid': GridSearch,
+    'random': LatinHypercubeSearch,
+    'halving': SuccessiveHalvingSearch
+}
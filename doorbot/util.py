@@ -15,6 +15,17 @@ class FPSTimer( object ):
         self.parent = parent
         self.logger = logging.getLogger( 'fps.timer.{}'.format( parent.__class__.__name__ ) )
 
+    def count( self, counter, amount=1 ):
+
+        ''' Add to a named counter that is reported and reset alongside the
+        fps for the calling thread. '''
+
+        try:
+            counters = self._loop_info.counters
+        except AttributeError:
+            counters = self._loop_info.counters = {}
+        counters[counter] = counters.get( counter, 0 ) + amount
+
     def loop_timer_start( self ):
         self._loop_info.tmr_start = time.time()
 
@@ -48,10 +59,20 @@ class FPSTimer( object ):
             avg_work = sum( x[0] for x in self._loop_info.durations ) / \
                 len( self._loop_info.durations )
 
-            self.logger.debug( 'fps: %d (thread %d)',
+            # Tail latency of the work portion shows jitter the average hides.
+            work = sorted( x[0] for x in self._loop_info.durations )
+
+            counters = getattr( self._loop_info, 'counters', {} )
+
+            self.logger.debug(
+                'fps: %d, work p50 %.1fms p99 %.1fms%s (thread %d)',
                 1.0 / (avg_sleep + avg_work),
+                work[len( work ) // 2] * 1000,
+                work[min( len( work ) - 1, int( len( work ) * 0.99 ) )] * 1000,
+                ''.join( ', {} {}'.format( k, v ) for k, v in counters.items() ),
                 threading.get_ident() )
             self._loop_info.durations = []
+            self._loop_info.counters = {}
 
         return sleep_delay
 
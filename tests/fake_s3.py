@@ -0,0 +1,123 @@
+
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, unquote, urlparse
+from uuid import uuid4
+
+RE_AUTH = re.compile(
+    r'^AWS4-HMAC-SHA256 Credential=(?P<key>[^/]*)/\d{8}/[^/]+/s3/aws4_request, '
+    r'SignedHeaders=(?P<headers>[^,]*), Signature=[0-9a-f]{64}$' )
+
+class FakeS3Handler( BaseHTTPRequestHandler ):
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup( self ):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message( self, format, *args ): # pylint: disable=redefined-builtin
+        pass
+
+    def reply( self, code, body=b'', headers=None ):
+        self.send_response( code )
+        for key, value in (headers or {}).items():
+            self.send_header( key, value )
+        self.send_header( 'Content-Length', str( len( body ) ) )
+        self.end_headers()
+        if 'HEAD' != self.command:
+            self.wfile.write( body )
+
+    def handle_request( self ):
+
+        parsed = urlparse( self.path )
+        key = unquote( parsed.path )
+        query = parse_qs( parsed.query, keep_blank_values=True )
+        body = self.rfile.read( int( self.headers.get( 'Content-Length', 0 ) ) )
+
+        match = RE_AUTH.match( self.headers.get( 'Authorization', '' ) )
+        if not match or self.server.access_key != match.group( 'key' ) or \
+        'x-amz-date' not in match.group( 'headers' ).split( ';' ):
+            self.reply( 403, b'<Error><Code>AccessDenied</Code></Error>' )
+            return
+
+        with self.server.lock:
+            self.server.requests.append( (self.command, key, parsed.query) )
+
+            if 'POST' == self.command and 'uploads' in query:
+                upload_id = uuid4().hex
+                self.server.uploads[upload_id] = {}
+                self.reply( 200, '<InitiateMultipartUploadResult>'
+                    '<UploadId>{}</UploadId>'
+                    '</InitiateMultipartUploadResult>'.format(
+                        upload_id ).encode( 'utf-8' ) )
+
+            elif 'PUT' == self.command and 'uploadId' in query:
+                part_number = int( query['partNumber'][0] )
+                self.server.uploads[query['uploadId'][0]][part_number] = body
+                self.reply( 200, headers={'ETag': '"{}"'.format( part_number )} )
+
+            elif 'POST' == self.command and 'uploadId' in query:
+                parts = self.server.uploads.pop( query['uploadId'][0] )
+                numbers = [int( n ) for n in re.findall(
+                    rb'<PartNumber>(\d+)</PartNumber>', body )]
+                self.server.objects[key] = b''.join(
+                    parts[n] for n in numbers )
+                self.reply( 200, b'<CompleteMultipartUploadResult/>' )
+
+            elif 'DELETE' == self.command and 'uploadId' in query:
+                self.server.uploads.pop( query['uploadId'][0], None )
+                self.reply( 204 )
+
+            elif 'PUT' == self.command:
+                self.server.objects[key] = body
+                self.reply( 200, headers={'ETag': '"0"'} )
+
+            elif self.command in ('GET', 'HEAD'):
+                if key in self.server.objects:
+                    self.reply( 200, self.server.objects[key] )
+                else:
+                    self.reply( 404, b'<Error><Code>NoSuchKey</Code></Error>' )
+
+            else:
+                self.reply( 400 )
+
+    do_GET = handle_request
+    do_HEAD = handle_request
+    do_PUT = handle_request
+    do_POST = handle_request
+    do_DELETE = handle_request
+
+class FakeS3Server( ThreadingMixIn, HTTPServer ):
+
+    ''' Just enough of the S3 API, on localhost, to test uploads against.
+    Objects are kept in memory, keyed by "/bucket/key". Requests must carry
+    a version 4 signature for access_key, but the signature itself isn't
+    checked. '''
+
+    daemon_threads = True
+
+    def __init__( self, access_key='test' ):
+        super().__init__( ('localhost', 0), FakeS3Handler )
+        self.access_key = access_key
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = []
+        self.objects = {}
+        self.uploads = {}
+        self.thread = threading.Thread( target=self.serve_forever, daemon=True )
+
+    @property
+    def port( self ):
+        return self.server_address[1]
+
+    def __enter__( self ):
+        self.thread.start()
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        self.shutdown()
+        self.server_close()
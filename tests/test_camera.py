@@ -0,0 +1,64 @@
+
+import os
+import sys
+import unittest
+from unittest.mock import patch
+
+from faker import Faker
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( __file__) ) )
+
+from doorbot.cameras import Camera
+from doorbot.cameras.opencvcam import OpenCVCamera
+from fake_camera import FakeCamera
+
+class TestCamera( unittest.TestCase ):
+
+    def setUp( self ):
+        self.fake = Faker()
+        self.fake.add_provider( FakeCamera )
+
+    def test_duplicate_frames( self ):
+
+        camera = Camera( 'test_camera', stallframes='3' )
+        frame_a = self.fake.random_image( 640, 480 ) # pylint: disable=no-member
+        frame_b = self.fake.random_image( 640, 480 ) # pylint: disable=no-member
+
+        self.assertFalse( camera.is_duplicate( frame_a ) )
+        self.assertTrue( camera.is_duplicate( frame_a.copy() ) )
+        self.assertFalse( camera.is_duplicate( frame_b ) )
+
+        for i in range( 3 ):
+            self.assertFalse( camera.stalled )
+            self.assertTrue( camera.is_duplicate( frame_b ) )
+        self.assertTrue( camera.stalled )
+
+        self.assertEqual( camera.duplicate_frames.value, 4 )
+
+    def test_stalled_reconnect( self ):
+
+        frame = self.fake.random_image( 320, 240 ) # pylint: disable=no-member
+
+        with patch( 'doorbot.cameras.opencvcam.cv2.VideoCapture' ) as mock_cap:
+            stream = mock_cap.return_value
+            camera = OpenCVCamera( 'test_camera', url='0', fps='1000',
+                stallframes='5' )
+
+            reads = []
+            def read_frame():
+                reads.append( 1 )
+                if 6 <= len( reads ):
+                    camera.running = False
+                return True, frame
+            stream.read.side_effect = read_frame
+
+            camera.run()
+
+            # One frame published, then five duplicates dropped and a
+            # reconnect after the fifth.
+            self.assertTrue( camera.ready )
+            self.assertEqual( camera.frame.shape, frame.shape )
+            self.assertFalse( camera.ready )
+            self.assertEqual( camera.duplicate_frames.value, 5 )
+            stream.release.assert_called_once()
+            stream.open.assert_called_once_with( 0 )
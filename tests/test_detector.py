@@ -2,8 +2,12 @@
 import os
 import sys
 import unittest
+import json
 import random
+import socket
+import threading
 
+import numpy
 from faker import Faker
 
 sys.path.insert( 0, os.path.dirname( os.path.dirname( __file__) ) )
@@ -11,6 +15,8 @@ sys.path.insert( 0, os.path.dirname( os.path.dirname( __file__) ) )
 from tests.fake_camera import FakeCamera
 from doorbot.detectors import DetectionEvent
 from doorbot.detectors.motion import MotionDetector
+from doorbot.detectors.remote import RemoteDetector, DetectionWorker, \
+    DetectionWorkerHandler, MSG_EVENT, MSG_NONE, send_message
 
 class TestDetector( unittest.TestCase ):
 
@@ -84,3 +90,128 @@ class TestDetector( unittest.TestCase ):
             event = detector.detect( image )
 
             self.assertIsNone( event )
+
+    def pyramid_frames( self, box_size, box_y ):
+        background = numpy.full( (480, 640, 3), 96, dtype=numpy.uint8 )
+        frames = [background.copy() for i in range( 30 )]
+        for i in range( 10 ):
+            frame = background.copy()
+            box_x = 100 + (i * box_size)
+            frame[box_y:box_y + box_size, box_x:box_x + box_size] = 255
+            frames.append( frame )
+        return frames
+
+    def test_detect_pyramid_far_zone( self ):
+
+        config = dict( self.motion_detector_config )
+        config.update( {'minw': '4', 'minh': '4', 'pyramid': 'true'} )
+        coarse_detector = MotionDetector( 'test_detector', **config )
+        config['farzones'] = '0,0,640,120'
+        zone_detector = MotionDetector( 'test_detector', **config )
+        self.assertEqual( len( zone_detector.zone_back_subs ), 1 )
+
+        # Far zones are only used in pyramid mode.
+        config['pyramid'] = 'false'
+        self.assertEqual( MotionDetector(
+            'test_detector', **config ).zone_back_subs, [] )
+
+        # A subject too small to survive the coarse pass.
+        coarse_events = []
+        zone_events = []
+        for frame in self.pyramid_frames( 6, 50 ):
+            coarse_events.append( coarse_detector.detect( frame ) )
+            zone_events.append( zone_detector.detect( frame ) )
+
+        self.assertFalse( any( coarse_events[30:] ) )
+        for event in zone_events[31:]:
+            self.assertEqual( event.event_type, 'movement' )
+            self.assertLess( event.position[1], 120 )
+
+    def test_detect_pyramid_refine( self ):
+
+        config = dict( self.motion_detector_config )
+        config['pyramid'] = 'true'
+        detector = MotionDetector( 'test_detector', **config )
+
+        for frame in self.pyramid_frames( 40, 200 ):
+            event = detector.detect( frame )
+
+        # Refined to within one coarse pixel of the box at full resolution.
+        self.assertEqual( event.event_type, 'movement' )
+        for found, actual in zip( event.position + event.dimensions,
+        (100 + (9 * 40), 200, 40, 40) ):
+            self.assertLessEqual( abs( found - actual ), 4 )
+
+    def start_worker( self, serve=True ):
+        worker = DetectionWorker( ('127.0.0.1', 0), DetectionWorkerHandler )
+        if serve:
+            threading.Thread( target=worker.serve_forever, daemon=True ).start()
+            self.addCleanup( worker.stop )
+        self.addCleanup( worker.server_close )
+        return '127.0.0.1:{}'.format( worker.server_address[1] )
+
+    def create_remote_detector( self, workers, **kwargs ):
+        config = dict( self.motion_detector_config )
+        config['workers'] = workers
+        config.update( kwargs )
+        detector = RemoteDetector( 'test_remote', **config )
+        self.addCleanup( detector.disconnect )
+        return detector
+
+    def test_remote_detect_motion( self ):
+
+        for encoding in ['jpeg', 'raw']:
+            detector = self.create_remote_detector(
+                self.start_worker(), encoding=encoding, wait='5' )
+
+            for i in range( 10 ):
+                image = self.fake.random_image( 320, 240 ) # pylint: disable=no-member
+                event = detector.detect( image )
+
+                self.assertTrue( isinstance( event, DetectionEvent ) )
+                self.assertEqual( event.event_type, 'movement' )
+                self.assertIs( event.frame, image )
+
+    def test_remote_balance( self ):
+
+        workers = ','.join( [self.start_worker(), self.start_worker()] )
+        detector_a = self.create_remote_detector( workers, wait='5' )
+        detector_b = self.create_remote_detector( workers, wait='5' )
+
+        image = self.fake.random_image( 320, 240 ) # pylint: disable=no-member
+        detector_a.detect( image )
+        detector_b.detect( image )
+
+        self.assertNotEqual( detector_a.worker, detector_b.worker )
+
+    def test_remote_backpressure( self ):
+
+        # A worker that accepts connections but never answers.
+        detector = self.create_remote_detector(
+            self.start_worker( serve=False ), window='2' )
+
+        for i in range( 5 ):
+            image = self.fake.random_image( 320, 240 ) # pylint: disable=no-member
+            self.assertIsNone( detector.detect( image ) )
+
+        self.assertEqual( detector.dropped_frames, 3 )
+
+    def test_remote_keep_movement( self ):
+
+        detector = self.create_remote_detector( '127.0.0.1:1' )
+        image = self.fake.random_image( 320, 240 ) # pylint: disable=no-member
+        detector._in_flight = {1: image, 2: image}
+
+        # Movement, then nothing, both arriving before detect() reads them.
+        sock_detector, sock_worker = socket.socketpair()
+        send_message( sock_worker, MSG_EVENT, 1, json.dumps( {
+            'event_type': 'movement', 'dimensions': [10, 10],
+            'position': [5, 5]} ).encode( 'utf-8' ) )
+        send_message( sock_worker, MSG_NONE, 2 )
+        sock_worker.close()
+        detector.receive( sock_detector )
+        sock_detector.close()
+
+        self.assertEqual( detector._in_flight, {} )
+        self.assertEqual( detector._result[1].event_type, 'movement' )
+        self.assertIs( detector._result[1].frame, image )
@@ -0,0 +1,213 @@
+
+import os
+import sqlite3
+import sys
+import subprocess
+import time
+import unittest
+from datetime import datetime
+
+import numpy
+try:
+    from cv2 import cv2
+except ImportError:
+    import cv2
+from faker import Faker
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( __file__) ) )
+
+from doorbot.capturers.video import VideoCapture
+from doorbot.index import ClipIndex, close_clip_index, get_clip_index
+from doorbot.index.retention import RetentionSweeper, get_quotas
+from fake_camera import FakeCamera
+
+class TestIndex( unittest.TestCase ):
+
+    def setUp( self ):
+        self.fake = Faker()
+        self.fake.add_provider( FakeCamera )
+
+    def test_index_query( self ):
+
+        with self.fake.directory() as index_dir: # pylint: disable=no-member
+
+            index = ClipIndex( os.path.join( index_dir, 'index.db' ) )
+
+            for i in range( 250 ):
+                index.add_event( 'event{}'.format( i ), 'cam{}'.format( i % 2 ),
+                    1000.0 + i, (i, i + 1), (10, 20), 'movement' )
+                index.add_artefact( '/clips/{}.mp4'.format( i ), 'video',
+                    'cam{}'.format( i % 2 ), 1000.0 + i, 2.0, 1024, 'queued',
+                    'event{}'.format( i ) )
+            index.set_upload_status( '/clips/3.mp4', 'uploaded' )
+            index.set_upload_status( '/clips/5.mp4', 'backup', '/backup/5.mp4' )
+            self.assertTrue( index.flush( 10 ) )
+
+            events = index.query( 'events', 'cam1', 1000.0, 1010.0 )
+            self.assertEqual( [e['uid'] for e in events],
+                ['event1', 'event3', 'event5', 'event7', 'event9'] )
+            self.assertEqual( (events[0]['x'], events[0]['y'],
+                events[0]['w'], events[0]['h']), (1, 2, 10, 20) )
+
+            clips = index.query( 'artefacts', event_uid='event3' )
+            self.assertEqual( len( clips ), 1 )
+            self.assertEqual( clips[0]['upload_status'], 'uploaded' )
+
+            clips = index.query( 'artefacts', event_uid='event5' )
+            self.assertEqual( clips[0]['path'], '/backup/5.mp4' )
+            self.assertEqual( clips[0]['upload_status'], 'backup' )
+
+            self.assertEqual( len( index.query( 'artefacts' ) ), 250 )
+
+            index.close( 10 )
+
+    def test_index_capture( self ):
+
+        with self.fake.directory() as capture_path: # pylint: disable=no-member
+
+            db_path = os.path.join( capture_path, 'index.db' )
+
+            capturer = VideoCapture( 'test_capture', enable='true',
+                path=capture_path, fps='5.0', multiproc='false',
+                camera='test', clipindex=db_path )
+
+            capturer.event_uid = 'test_event'
+            for i in range( 10 ):
+                capturer.handle_motion_frame(
+                    numpy.full( (240, 320, 3), i * 10, dtype=numpy.uint8 ) )
+            capturer.finalize_motion( None )
+
+            get_clip_index( db_path ).flush( 10 )
+            clips = get_clip_index( db_path ).query( 'artefacts', 'test' )
+            close_clip_index( 10 )
+
+            self.assertEqual( len( clips ), 1 )
+            self.assertEqual( clips[0]['kind'], 'video' )
+            self.assertEqual( clips[0]['event_uid'], 'test_event' )
+            self.assertEqual( clips[0]['duration'], 2.0 )
+            self.assertEqual( clips[0]['upload_status'], 'local' )
+            self.assertEqual( clips[0]['size'],
+                os.path.getsize( clips[0]['path'] ) )
+            self.assertAlmostEqual( clips[0]['ts'],
+                datetime.now().timestamp(), delta=60 )
+
+            # The CLI should find the clip.
+            output = subprocess.check_output( [sys.executable, '-m',
+                'doorbot.index', '-d', db_path, '-c', 'test', 'clips'],
+                cwd=os.path.dirname( os.path.dirname( __file__ ) ) or '.' )
+            self.assertIn( clips[0]['path'].encode( 'utf-8' ), output )
+
+    def test_index_read_only( self ):
+
+        with self.fake.directory() as index_dir: # pylint: disable=no-member
+
+            db_path = os.path.join( index_dir, 'index.db' )
+
+            # A missing index is an error, and isn't created.
+            with self.assertRaises( sqlite3.Error ):
+                ClipIndex( db_path, read_only=True )
+            result = subprocess.run( [sys.executable, '-m', 'doorbot.index',
+                '-d', db_path, 'events'], stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                cwd=os.path.dirname( os.path.dirname( __file__ ) ) or '.' )
+            self.assertNotEqual( result.returncode, 0 )
+            self.assertIn( b'cannot open index', result.stderr )
+            self.assertFalse( os.path.exists( db_path ) )
+
+            index = ClipIndex( db_path )
+            index.add_event( 'event1', 'cam1', 1000.0, (1, 2), (10, 20),
+                'movement' )
+            index.close( 10 )
+
+            index = ClipIndex( db_path, read_only=True )
+            self.assertEqual( [e['uid'] for e in index.query( 'events' )],
+                ['event1'] )
+            index.close()
+
+    def test_index_sheet( self ):
+
+        with self.fake.directory() as capture_path: # pylint: disable=no-member
+
+            db_path = os.path.join( capture_path, 'index.db' )
+
+            capturer = VideoCapture( 'test_capture', enable='true',
+                path=capture_path, fps='5.0', multiproc='false',
+                camera='test', clipindex=db_path, sheetframes='4',
+                sheetcolumns='2', sheetwidth='80' )
+
+            for i in range( 10 ):
+                capturer.handle_motion_frame(
+                    numpy.full( (120, 160, 3), i * 20, dtype=numpy.uint8 ) )
+            capturer.finalize_motion( None )
+
+            get_clip_index( db_path ).flush( 10 )
+            sheets = get_clip_index( db_path ).query( 'artefacts', 'test',
+                kind='sheet' )
+            close_clip_index( 10 )
+
+            self.assertEqual( len( sheets ), 1 )
+            self.assertTrue( sheets[0]['path'].endswith( '.sheet.jpg' ) )
+
+            # Four 80x60 thumbnails, two to a row, spread over the clip.
+            sheet = cv2.imread( sheets[0]['path'] )
+            self.assertEqual( sheet.shape, (120, 160, 3) )
+            levels = [sheet[y:y + 60, x:x + 80].mean() \
+                for y in (0, 60) for x in (0, 80)]
+            for level, expected in zip( levels, (0, 40, 120, 160) ):
+                self.assertAlmostEqual( level, expected, delta=4 )
+
+    def test_quotas( self ):
+
+        quotas = get_quotas( [
+            {'camera': 'a', 'retaindays': '30', 'retainsize': '10G'},
+            {'camera': 'a', 'retaindays': '7'},
+            {'camera': 'b', 'retainsize': '512k'},
+            {'camera': 'c'}] )
+
+        self.assertEqual( quotas, {
+            'a': (7 * 86400, 10 * 1024 ** 3),
+            'b': (None, 512 * 1024)} )
+
+    def test_retention( self ):
+
+        with self.fake.directory() as capture_path: # pylint: disable=no-member
+
+            index = ClipIndex( os.path.join( capture_path, 'index.db' ) )
+
+            # Ten 1000-byte files a day apart for each camera, oldest first.
+            now = time.time()
+            paths = {'a': [], 'b': []}
+            for camera_key in paths:
+                for i in range( 10 ):
+                    path = os.path.join( capture_path,
+                        '{}{}.mp4'.format( camera_key, i ) )
+                    with open( path, 'wb' ) as clip_file:
+                        clip_file.write( b'\0' * 1000 )
+                    paths[camera_key].append( path )
+                    index.add_artefact( path, 'video', camera_key,
+                        now - ((10 - i) * 86400) + 60, 1.0, 1000, 'local' )
+            index.add_artefact( 'ftp://example.com/a.mp4', 'video', 'a',
+                now - (100 * 86400), 1.0, 1000, 'queued' )
+            index.flush()
+
+            sweeper = RetentionSweeper( index,
+                {'a': (3.5 * 86400, None), 'b': (None, 2500)},
+                retainrate='1000', retainbatch='4' )
+            sweeper.sweep()
+
+            # Camera a keeps its last three days, b its newest 2500 bytes.
+            for camera_key, kept in (('a', 3), ('b', 2)):
+                self.assertEqual( [os.path.exists( p ) \
+                    for p in paths[camera_key]],
+                    [False] * (10 - kept) + [True] * kept )
+                self.assertEqual( sorted( c['path'] for c in index.query(
+                    'artefacts', camera_key, upload_status='local' ) ),
+                    paths[camera_key][10 - kept:] )
+            self.assertEqual( sweeper.deleted_files, 15 )
+            self.assertEqual( sweeper.deleted_bytes, 15000 )
+
+            # Uploaded files are left alone.
+            self.assertEqual( len( index.query( 'artefacts', 'a',
+                upload_status='queued' ) ), 1 )
+
+            index.close()
@@ -1,6 +1,11 @@
 
 import os
+import http.client
+import multiprocessing
+import socket
 import sys
+import threading
+import time
 import unittest
 from unittest.mock import patch, Mock, MagicMock
 from contextlib import contextmanager
@@ -14,11 +19,25 @@ except ImportError:
 
 sys.path.insert( 0, os.path.dirname( os.path.dirname( __file__) ) )
 
+from doorbot.observers import SharedFrame, ObserverProc
 from doorbot.observers.framebuffer import FramebufferProc
 from doorbot.observers.reserver import ReserverHandler, ReserverProc
-from doorbot.portability import image_to_jpeg
+from doorbot.portability import image_to_jpeg, apply_thread_budget, \
+    DEFAULT_CPUS, DEFAULT_CVTHREADS
 from fake_camera import FakeCamera
 
+class BudgetProc( ObserverProc ):
+
+    ''' Reports the thread budget its process ends up with. '''
+
+    def __init__( self, instance_name, **kwargs ):
+        super().__init__( instance_name, **kwargs )
+        self.budget = multiprocessing.Queue()
+
+    def loop( self ):
+        self.budget.put( (cv2.getNumThreads(), os.sched_getaffinity( 0 ) \
+            if hasattr( os, 'sched_getaffinity' ) else None) )
+
 class TestObserver( unittest.TestCase ):
 
     def setUp( self ):
@@ -29,9 +48,11 @@ class TestObserver( unittest.TestCase ):
         #self.mock_http.
         pass
 
-    def create_reserver_handler( self, path, frame, remote_addr='127.0.0.1' ):
-        ReserverHandler.__init__ = lambda w, x, y, z: None
-        reserver = ReserverHandler( b'', ('', 0), None )
+    def create_reserver_handler( self, path, frame, remote_addr='127.0.0.1',
+        headers=None ):
+        with patch.object( ReserverHandler, '__init__',
+            lambda w, x, y, z: None ):
+            reserver = ReserverHandler( b'', ('', 0), None )
         reserver.server = MagicMock()
         reserver.server.logger = Mock()
         server_args = {
@@ -42,6 +63,9 @@ class TestObserver( unittest.TestCase ):
         reserver.server.proc.get_frame = MagicMock()
         get_frame = reserver.server.proc.get_frame.return_value
         get_frame.__enter__ = MagicMock( return_value=frame )
+        reserver.server.proc.get_frame_seq = MagicMock()
+        get_frame_seq = reserver.server.proc.get_frame_seq.return_value
+        get_frame_seq.__enter__ = MagicMock( return_value=(1, frame) )
         def reserver_loop_once():
             reserver.server.proc._running = False
             return True
@@ -50,6 +74,7 @@ class TestObserver( unittest.TestCase ):
         reserver.request_version = Mock( return_value='HTTP/1.0' )
         reserver.wfile = Mock()
         reserver.path = path
+        reserver.headers = headers or {}
         reserver.send_response = Mock()
         return reserver
 
@@ -95,3 +120,275 @@ class TestObserver( unittest.TestCase ):
         jpg_test = image_to_jpeg( frame )
         reserver.do_GET()
         reserver.wfile.write.assert_called_with( jpg_test )
+
+    def test_reserver_encode_once( self ):
+
+        frames = [self.fake.random_image( 640, 480 ), # pylint: disable=no-member
+            self.fake.random_image( 640, 480 )] # pylint: disable=no-member
+        reserver = self.create_reserver_handler( '/test.mjpg', frames[0] )
+        proc = reserver.server.proc
+
+        # Many clients asking for the same frame only encode it once.
+        jpgs = []
+        threads = [threading.Thread(
+            target=lambda: jpgs.append( proc.get_jpeg() ) ) for i in range( 10 )]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual( proc.jpeg_encodes, 1 )
+        self.assertEqual( jpgs, [image_to_jpeg( frames[0] )] * 10 )
+        self.assertTrue( all( jpg is jpgs[0] for jpg in jpgs ) )
+
+        # A new frame is encoded once more.
+        proc.get_frame_seq.return_value.__enter__.return_value = (2, frames[1])
+        for i in range( 10 ):
+            self.assertEqual( proc.get_jpeg(), image_to_jpeg( frames[1] ) )
+        self.assertEqual( proc.jpeg_encodes, 2 )
+
+    def test_reserver_variants( self ):
+
+        frame = self.fake.random_image( 640, 480 ) # pylint: disable=no-member
+        reserver = self.create_reserver_handler(
+            '/test.jpg?width=160&quality=50', frame )
+        reserver.do_GET()
+        jpg = reserver.wfile.write.call_args[0][0]
+        self.assertEqual( cv2.imdecode( numpy.frombuffer( jpg, numpy.uint8 ),
+            cv2.IMREAD_COLOR ).shape, (120, 160, 3) )
+        self.assertLess( len( jpg ), len( image_to_jpeg( frame ) ) )
+
+        # Variants are kept apart, and each encoded once per frame.
+        proc = reserver.server.proc
+        proc.max_variants = 2
+        self.assertIs( proc.get_jpeg( 160, 50 ), jpg )
+        self.assertIsNot( proc.get_jpeg( 320 ), jpg )
+        self.assertEqual( proc.jpeg_encodes, 2 )
+        # Widths past the frame's aren't scaled up.
+        self.assertEqual( proc.get_jpeg( 1280 ), image_to_jpeg( frame ) )
+
+        # The least recently used variant was dropped.
+        self.assertEqual( list( proc._variants ), [(320, None), (1280, None)] )
+        proc.get_jpeg( 160, 50 )
+        self.assertEqual( proc.jpeg_encodes, 4 )
+
+        reserver = self.create_reserver_handler( '/test.mjpg?quality=0', frame )
+        reserver.do_GET()
+        reserver.send_response.assert_called_once_with( 400 )
+        reserver.wfile.write.assert_called_once_with(
+            b'Content-length: 0\r\n\r\n' )
+
+    def test_reserver_asyncio( self ):
+
+        frames = [self.fake.random_image( 320, 240 ), # pylint: disable=no-member
+            self.fake.random_image( 320, 240 )] # pylint: disable=no-member
+        jpgs = [image_to_jpeg( frame ) for frame in frames]
+        source = {'seq': 0}
+
+        def wait_frame( last_seq, timeout ): # pylint: disable=unused-argument
+            time.sleep( 0.01 )
+            source['seq'] += 1
+            return source['seq']
+
+        @contextmanager
+        def get_frame_seq():
+            seq = source['seq']
+            yield seq, frames[seq % 2]
+
+        proc = ReserverProc( 'test_reserver', camera='test', fps='50.0',
+            listen='127.0.0.1', port='0', server='asyncio' )
+        proc.get_frame_seq = get_frame_seq
+        proc.wait_frame = wait_frame
+        proc.frame_ready = lambda: True
+        loop_thread = threading.Thread( target=proc.loop, daemon=True )
+        loop_thread.start()
+        while None == proc._server or None == proc._server.port:
+            time.sleep( 0.01 )
+        port = proc._server.port
+
+        def connect( path ):
+            sock = socket.create_connection( ('127.0.0.1', port), timeout=5 )
+            sock.sendall( 'GET {} HTTP/1.1\r\nHost: x\r\n\r\n'.format(
+                path ).encode( 'utf-8' ) )
+            stream = sock.makefile( 'rb' )
+            sock.close()
+            return stream
+
+        # A client that never reads mustn't hold up the others.
+        slow = socket.create_connection( ('127.0.0.1', port) )
+        slow.setsockopt( socket.SOL_SOCKET, socket.SO_RCVBUF, 4096 )
+        slow.sendall( b'GET /test.mjpg HTTP/1.0\r\n\r\n' )
+
+        streams = [connect( '/test.mjpg' ) for i in range( 4 )]
+        streams.append( connect( '/test.mjpg?width=160&fps=20' ) )
+        for stream in streams:
+            self.assertIn( b'200', stream.readline() )
+            self.assertIn( b'multipart/x-mixed-replace', stream.readline() )
+            self.assertEqual( stream.readline(), b'Connection: close\r\n' )
+            stream.readline()
+            for i in range( 10 ):
+                self.assertEqual( stream.readline(), b'--jpgboundary\r\n' )
+                stream.readline()
+                length = int( stream.readline().split( b':' )[1] )
+                stream.readline()
+                jpg = stream.read( length )
+                if stream is streams[-1]:
+                    self.assertEqual( cv2.imdecode( numpy.frombuffer(
+                        jpg, numpy.uint8 ), cv2.IMREAD_COLOR ).shape,
+                        (120, 160, 3) )
+                else:
+                    self.assertIn( jpg, jpgs )
+
+        # Frames were encoded once per variant for all of the clients.
+        self.assertLessEqual( proc.jpeg_encodes, 2 * source['seq'] + 1 )
+
+        proc._running = False
+        loop_thread.join( 5 )
+        self.assertFalse( loop_thread.is_alive() )
+        slow.close()
+        for stream in streams:
+            stream.close()
+
+    def test_reserver_snapshot( self ):
+
+        frame = self.fake.random_image( 640, 480 ) # pylint: disable=no-member
+        reserver = self.create_reserver_handler( '/test.jpg', frame )
+        reserver.send_header = Mock()
+        reserver.end_headers = Mock()
+        reserver.do_GET()
+        headers = dict( c[0] for c in reserver.send_header.call_args_list )
+        self.assertIn( 'ETag', headers )
+        self.assertEqual( headers['Content-length'],
+            len( image_to_jpeg( frame ) ) )
+
+        # The same frame isn't sent again to a client that has it.
+        proc = reserver.server.proc
+        reserver = self.create_reserver_handler( '/test.jpg', frame,
+            headers={'If-None-Match': headers['ETag']} )
+        reserver.server.proc = proc
+        reserver.do_GET()
+        reserver.send_response.assert_called_once_with( 304 )
+        for call in reserver.wfile.write.call_args_list:
+            self.assertNotIn( b'\xff\xd8', call[0][0] )
+
+        # Nor a different size of it.
+        reserver = self.create_reserver_handler( '/test.jpg?width=320', frame,
+            headers={'If-None-Match': headers['ETag']} )
+        reserver.server.proc = proc
+        reserver.do_GET()
+        reserver.send_response.assert_called_once_with( 200 )
+
+    def test_reserver_keepalive( self ):
+
+        frame = self.fake.random_image( 320, 240 ) # pylint: disable=no-member
+        source = {'seq': 1}
+
+        @contextmanager
+        def get_frame_seq():
+            yield source['seq'], frame
+
+        for server in ('threads', 'asyncio'):
+            proc = ReserverProc( 'test_reserver', camera='test', fps='5.0',
+                listen='127.0.0.1', port='0', server=server )
+            proc.get_frame_seq = get_frame_seq
+            proc.wait_frame = lambda last_seq, timeout: source['seq']
+            proc.frame_ready = lambda: True
+            loop_thread = threading.Thread( target=proc.loop, daemon=True )
+            loop_thread.start()
+            while None == proc._server:
+                time.sleep( 0.01 )
+            if 'threads' == server:
+                port = proc._server.server_address[1]
+            else:
+                while None == proc._server.port:
+                    time.sleep( 0.01 )
+                port = proc._server.port
+
+            conn = http.client.HTTPConnection( '127.0.0.1', port, timeout=5 )
+            conn.request( 'GET', '/test.jpg' )
+            response = conn.getresponse()
+            self.assertEqual( response.status, 200 )
+            self.assertEqual( response.read(), image_to_jpeg( frame ) )
+            etag = response.getheader( 'ETag' )
+            sock = conn.sock
+
+            # Polling on the same connection only gets new frames, without
+            # encoding the current one again after it has been evicted.
+            proc._variants.clear()
+            conn.request( 'GET', '/test.jpg', headers={'If-None-Match': etag} )
+            response = conn.getresponse()
+            self.assertEqual( response.status, 304 )
+            self.assertEqual( response.read(), b'' )
+
+            source['seq'] += 1
+            conn.request( 'GET', '/test.jpg', headers={'If-None-Match': etag} )
+            response = conn.getresponse()
+            self.assertEqual( response.status, 200 )
+            self.assertNotEqual( response.getheader( 'ETag' ), etag )
+            response.read()
+
+            conn.request( 'GET', '/test.png' )
+            response = conn.getresponse()
+            self.assertEqual( response.status, 404 )
+            response.read()
+
+            self.assertIs( conn.sock, sock )
+            self.assertEqual( proc.jpeg_encodes, 2 )
+            conn.close()
+
+            proc._running = False
+            if 'threads' == server:
+                proc._server.shutdown()
+                proc._server.server_close()
+            loop_thread.join( 5 )
+            self.assertFalse( loop_thread.is_alive() )
+
+    def test_observer_thread_budget( self ):
+
+        # A budget applied to the parent, as the main loop does for
+        # detectors, mustn't leak into an observer that sets none.
+        try:
+            apply_thread_budget( cvthreads=str( DEFAULT_CVTHREADS + 1 ),
+                cpuaffinity=str( min( DEFAULT_CPUS ) ) if DEFAULT_CPUS else None )
+            proc = BudgetProc( 'test_budget', camera='test' )
+            proc.start()
+            cv_threads, cpus = proc.budget.get( timeout=10 )
+            proc.join( 10 )
+        finally:
+            apply_thread_budget()
+
+        self.assertEqual( cv_threads, DEFAULT_CVTHREADS )
+        self.assertEqual( cpus, DEFAULT_CPUS )
+
+    def test_shared_frame( self ):
+
+        shared = SharedFrame()
+        try:
+            with shared.get_frame_seq() as (seq, frame):
+                self.assertEqual( seq, 0 )
+                self.assertIsNone( frame )
+
+            # Nothing comes, so the wait times out.
+            self.assertEqual( shared.wait( 0, timeout=0.1 ), 0 )
+
+            frames = [self.fake.random_image( 640, 480 ), # pylint: disable=no-member
+                self.fake.random_image( 640, 480 ), # pylint: disable=no-member
+                self.fake.random_image( 320, 240 )] # pylint: disable=no-member
+            for i, frame_test in enumerate( frames ):
+                self.assertTrue( shared.set_frame( frame_test ) )
+                self.assertEqual( shared.wait( i, timeout=1.0 ), i + 1 )
+                # The newest frame is always the one read.
+                with shared.get_frame_seq() as (seq, frame):
+                    self.assertEqual( seq, i + 1 )
+                    numpy.testing.assert_array_equal( frame, frame_test )
+
+            # A slot being read isn't written over; the other one is used.
+            with shared.get_frame() as frame:
+                self.assertTrue( shared.set_frame( frames[0] ) )
+                numpy.testing.assert_array_equal( frame, frames[2] )
+                # Both slots are busy now, so the frame is dropped.
+                with shared.get_frame() as frame_next:
+                    numpy.testing.assert_array_equal( frame_next, frames[0] )
+                    self.assertFalse( shared.set_frame( frames[1] ) )
+            self.assertEqual( shared.seq, 4 )
+        finally:
+            shared.close()
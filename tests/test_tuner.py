@@ -0,0 +1,86 @@
+
+import os
+import sys
+import unittest
+
+import numpy
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( __file__) ) )
+
+from doorbot.tuner.search import Tuner, GridSearch, LatinHypercubeSearch, \
+    SuccessiveHalvingSearch
+
+class TestTuner( unittest.TestCase ):
+
+    def setUp( self ) -> None:
+
+        background = numpy.full( (120, 160, 3), 64, dtype=numpy.uint8 )
+
+        # A box walking across an otherwise static scene.
+        self.positive = []
+        for i in range( 12 ):
+            frame = background.copy()
+            frame[40:80, 10 + (i * 10):40 + (i * 10)] = 255
+            self.positive.append( frame )
+
+        self.negative = [background.copy() for i in range( 12 )]
+
+        self.fixed = {'minw': 5, 'minh': 5, 'ignoreedges': 'false'}
+
+        self.ranges = {
+            'threshold': range( 10, 251, 40 ),
+            'blur': range( 3, 8, 2 ) }
+
+        return super().setUp()
+
+    def test_grid_candidates( self ):
+
+        strategy = GridSearch( self.ranges )
+        candidates = list( strategy.candidates() )
+
+        self.assertEqual( len( candidates ), 7 * 3 )
+        self.assertIn( {'threshold': 10, 'blur': 7}, candidates )
+
+    def test_latin_hypercube_strata( self ):
+
+        strategy = LatinHypercubeSearch(
+            {'threshold': range( 0, 100 )}, samples=10, seed=1 )
+        candidates = list( strategy.candidates() )
+
+        self.assertEqual( len( candidates ), 10 )
+
+        # Each tenth of the range should be sampled exactly once.
+        strata = sorted( c['threshold'] // 10 for c in candidates )
+        self.assertEqual( strata, list( range( 10 ) ) )
+
+    def test_halving( self ):
+
+        tuner = Tuner( [self.positive], [self.negative], self.fixed )
+        strategy = SuccessiveHalvingSearch( self.ranges, samples=9, seed=1 )
+
+        best_params, best_score = tuner.run( strategy )
+
+        self.assertEqual( best_score, tuner.max_score() )
+        self.assertIn( best_params['blur'], self.ranges['blur'] )
+
+        # Only one candidate should survive to the full dataset.
+        self.assertLessEqual( tuner.evaluations, 9 + 3 + 1 )
+
+    def test_perfect_score_stop( self ):
+
+        tuner = Tuner( [self.positive], [self.negative], self.fixed )
+
+        best_params, best_score = tuner.run( GridSearch( self.ranges ) )
+
+        self.assertEqual( best_score, tuner.max_score() )
+        self.assertLess( tuner.evaluations, 7 * 3 )
+
+    def test_patience( self ):
+
+        tuner = Tuner( [self.positive], [self.negative], self.fixed,
+            patience=2 )
+        tuner.max_score = lambda fraction=1.0: 1000
+
+        tuner.run( GridSearch( self.ranges ) )
+
+        self.assertLess( tuner.evaluations, 7 * 3 )
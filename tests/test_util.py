@@ -10,6 +10,8 @@ import logging
 sys.path.insert( 0, os.path.dirname( os.path.dirname( __file__) ) )
 
 from doorbot.util import FPSTimer, RWLock, FrameLock, RWLockWriteException
+from doorbot.portability import parse_cpus, apply_thread_budget, \
+    merge_thread_budgets, cv2, DEFAULT_CPUS, DEFAULT_CVTHREADS
 
 class TestUtil( unittest.TestCase ):
 
@@ -49,6 +51,49 @@ class TestUtil( unittest.TestCase ):
 
             self.assertEqual( duration, 0 )
 
+    def test_parse_cpus( self ):
+
+        self.assertEqual( parse_cpus( '0' ), {0} )
+        self.assertEqual( parse_cpus( '0,2-4' ), {0, 2, 3, 4} )
+        self.assertEqual( parse_cpus( '1, 3,' ), {1, 3} )
+
+    def test_thread_budget( self ):
+
+        threads = cv2.getNumThreads()
+        try:
+            apply_thread_budget( cvthreads='1' )
+            self.assertEqual( cv2.getNumThreads(), 1 )
+            # Unset goes back to the default.
+            apply_thread_budget( cvthreads=str( DEFAULT_CVTHREADS + 1 ) )
+            apply_thread_budget()
+            self.assertEqual( cv2.getNumThreads(), DEFAULT_CVTHREADS )
+        finally:
+            cv2.setNumThreads( threads )
+
+        if hasattr( os, 'sched_getaffinity' ):
+            cpus = os.sched_getaffinity( 0 )
+            try:
+                apply_thread_budget( cpuaffinity=str( min( cpus ) ) )
+                self.assertEqual( os.sched_getaffinity( 0 ), {min( cpus )} )
+                apply_thread_budget()
+                self.assertEqual( os.sched_getaffinity( 0 ), DEFAULT_CPUS )
+            finally:
+                os.sched_setaffinity( 0, cpus )
+
+    def test_merge_thread_budgets( self ):
+
+        self.assertEqual( merge_thread_budgets( [
+            {'cvthreads': '2', 'threshold': '127'},
+            {'cpuaffinity': '0-1'},
+            {'cvthreads': '2', 'cpuaffinity': '0,1'}] ),
+            {'cvthreads': '2', 'cpuaffinity': '0,1'} )
+        self.assertEqual( merge_thread_budgets( [] ), {} )
+
+        with self.assertRaises( ValueError ):
+            merge_thread_budgets( [{'cvthreads': '1'}, {'cvthreads': '2'}] )
+        with self.assertRaises( ValueError ):
+            merge_thread_budgets( [{'cpuaffinity': '0'}, {'cpuaffinity': '1'}] )
+
     def test_rw_lock_writing( self ):
 
         finished = threading.Barrier( 4, timeout=10 )